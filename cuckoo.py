@@ -4,11 +4,13 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import sys
+import signal
 import logging
 import argparse
 
 try:
     from lib.cuckoo.common.logo import logo
+    from lib.cuckoo.common.config import request_reload
     from lib.cuckoo.common.constants import CUCKOO_VERSION
     from lib.cuckoo.common.exceptions import CuckooCriticalError
     from lib.cuckoo.common.exceptions import CuckooDependencyError
@@ -55,6 +57,11 @@ def main():
     init_modules()
     init_tasks()
 
+    # The configuration files are parsed again when changed, SIGHUP forces
+    # it for the ones used from now on.
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: request_reload())
+
     Resultserver()
 
     try:
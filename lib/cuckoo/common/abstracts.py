@@ -586,12 +586,20 @@ class Processing(object):
     """Base abstract class for processing module."""
     order = 1
     enabled = True
+    # Key of the results of the module in the results dict.
+    key = ""
+    # Keys of the results of other modules this module needs.
+    depends = []
+    # Whether the results depend on the analyzed file only, and can be
+    # reused for any analysis of the same file.
+    cacheable = False
 
     def __init__(self):
         self.analysis_path = ""
         self.logs_path = ""
         self.task = None
         self.options = None
+        self.results = {}
 
     def set_options(self, options):
         """Set report options.
@@ -605,6 +613,19 @@ class Processing(object):
         """
         self.task = task
 
+    def set_results(self, results):
+        """Add the results of the modules this one depends on.
+        @param results: results dict.
+        """
+        self.results = results
+
+    def from_cache(self, data):
+        """Adapt cached results to the current analysis.
+        @param data: results of a previous analysis of the same file.
+        @return: results.
+        """
+        return data
+
     def set_path(self, analysis_path):
         """Set paths.
         @param analysis_path: analysis folder path.
@@ -731,6 +752,14 @@ class Signature(object):
                 if item["process_name"] != process:
                     continue
 
+            # The behavior aggregated by the Resultserver only has the
+            # count of calls by API name.
+            for api in item.get("api_calls", {}):
+                if self._check_value(pattern=pattern,
+                                     subject=api,
+                                     regex=regex):
+                    return api
+
             # Loop through API calls.
             for call in item["calls"]:
                 # Check if the name matches.
@@ -918,6 +947,9 @@ class Signature(object):
 class Report(object):
     """Base abstract class for reporting module."""
     order = 1
+    # Whether run() changes the results it is given. The modules sharing an
+    # order which don't are given the same results when run concurrently.
+    mutates_results = False
 
     def __init__(self):
         self.analysis_path = ""
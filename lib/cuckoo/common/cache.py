@@ -0,0 +1,162 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import errno
+import cPickle
+import hashlib
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+class ResultCache(object):
+    """On disk cache of pickled results, shared by the processes using the
+    same folder. Past its maximum size the least recently used results,
+    by modification time, are evicted.
+
+    The size of the folder is computed once and then kept up to date with
+    the results stored by this instance. The results stored by the other
+    processes are only seen when evicting, which takes the cache down to
+    low_water of its maximum size so that evictions stay rare.
+    """
+
+    low_water = 0.9
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path, max_size):
+        """@param path: cache folder.
+        @param max_size: maximum size in bytes.
+        """
+        self.path = path
+        self.max_size = max_size
+        # Tracked size of the folder, None until first computed.
+        self.size = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path, max_size):
+        """Get the instance of a cache folder shared within this process,
+        so that its size is only computed once.
+        @param path: cache folder.
+        @param max_size: maximum size in bytes.
+        @return: ResultCache instance.
+        """
+        with cls._instances_lock:
+            cache = cls._instances.get(path)
+            if not cache:
+                cache = cls._instances[path] = cls(path, max_size)
+            cache.max_size = max_size
+            return cache
+
+    @staticmethod
+    def make_key(*parts):
+        """Make a key out of some strings.
+        @return: key.
+        """
+        return hashlib.sha256("\x00".join(parts)).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Look a result up.
+        @param key: result key.
+        @return: tuple of whether the result was found and the result.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = cPickle.load(f)
+        except IOError:
+            return False, None
+        except Exception as e:
+            log.warning("Unable to load the cached result %s, dropping it: "
+                        "%s", key, e)
+            self._remove(path)
+            return False, None
+
+        # Mark it as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return True, data
+
+    def put(self, key, data):
+        """Store a result and evict the old ones past the maximum size.
+        @param key: result key.
+        @param data: result, it has to be picklable.
+        """
+        folder = os.path.dirname(self._entry_path(key))
+        try:
+            os.makedirs(folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                log.warning("Unable to create the cache folder %s: %s",
+                            folder, e)
+                return
+
+        # Written aside and renamed, readers never see a partial result.
+        path = self._entry_path(key)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.rename(tmp_path, path)
+        except Exception as e:
+            log.warning("Unable to cache the result %s: %s", key, e)
+            self._remove(tmp_path)
+            return
+
+        with self.lock:
+            if self.size is not None:
+                self.size += size - replaced
+                if self.size <= self.max_size:
+                    return
+            self.evict()
+
+    def evict(self):
+        """Compute the size of the cache and, past its maximum size, remove
+        the least recently used results down to low_water of it."""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                # Results being written.
+                if name.startswith("."):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total > self.max_size:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_size * self.low_water:
+                    break
+                self._remove(path)
+                total -= size
+
+        self.size = total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -3,32 +3,128 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import threading
 import ConfigParser
+from collections import OrderedDict
 
 from lib.cuckoo.common.constants import CUCKOO_ROOT
 from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.objects import Dictionary
 
-class Config:
-    """Configuration file parser."""
+# Maximum number of parsed files kept, every analysis has its own
+# analysis.conf.
+CACHE_SIZE = 64
 
-    def __init__(self, cfg=os.path.join(CUCKOO_ROOT, "conf", "cuckoo.conf")):
-        """@param cfg: configuration file path."""
-        config = ConfigParser.ConfigParser()
-        config.read(cfg)
+# Parsed files by path: (file stat, sections dict), least recently used first.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# Reloads requested and reloads done, the requests may come from signal
+# handlers which can't take the lock.
+_reload_requested = 0
+_reload_done = 0
+
+class Section(Dictionary):
+    """Read-only configuration section, shared by the Config instances of
+    the same file."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Configuration sections are read-only, use copy() "
+                        "to get a modifiable one")
+
+    __setattr__ = __setitem__ = __delattr__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
 
-        for section in config.sections():
-            setattr(self, section, Dictionary())
-            for name, raw_value in config.items(section):
+    def copy(self):
+        """@return: modifiable copy of the section."""
+        return Dictionary(self)
+
+    def __reduce__(self):
+        return Section, (dict(self),)
+
+def _stat(cfg):
+    try:
+        st = os.stat(cfg)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size, st.st_ino
+
+def _parse(cfg):
+    """Parse a configuration file.
+    @param cfg: configuration file path.
+    @return: dict of sections.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(cfg)
+
+    sections = {}
+    for section in config.sections():
+        options = {}
+        for name, raw_value in config.items(section):
+            try:
+                value = config.getboolean(section, name)
+            except ValueError:
                 try:
-                    value = config.getboolean(section, name)
+                    value = config.getint(section, name)
                 except ValueError:
-                    try:
-                        value = config.getint(section, name)
-                    except ValueError:
-                        value = config.get(section, name)
+                    value = config.get(section, name)
+
+            options[name] = value
+        sections[section] = Section(options)
+
+    return sections
+
+def load_config(cfg):
+    """Get the sections of a configuration file, parsed once and again only
+    when the file changes.
+    @param cfg: configuration file path.
+    @return: dict of read-only sections.
+    """
+    global _reload_done
 
-                setattr(getattr(self, section), name, value)
+    cfg = os.path.abspath(cfg)
+    stat = _stat(cfg)
+
+    with _cache_lock:
+        requested = _reload_requested
+        if requested != _reload_done:
+            _cache.clear()
+            _reload_done = requested
+
+        entry = _cache.pop(cfg, None)
+        if entry and entry[0] == stat:
+            _cache[cfg] = entry
+            return entry[1]
+
+    # Parsed unlocked, at worst a couple of threads parse the same file.
+    sections = _parse(cfg)
+
+    with _cache_lock:
+        _cache[cfg] = stat, sections
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return sections
+
+def reload_config():
+    """Drop the parsed configuration files, they're parsed again when next
+    used. The Config instances already created are left untouched."""
+    with _cache_lock:
+        _cache.clear()
+
+def request_reload():
+    """Have the parsed configuration files dropped when a file is next
+    loaded. Unlike reload_config() it doesn't lock, so it's safe to call
+    from a signal handler interrupting a thread holding the lock."""
+    global _reload_requested
+    _reload_requested += 1
+
+class Config:
+    """Configuration file parser."""
+
+    def __init__(self, cfg=os.path.join(CUCKOO_ROOT, "conf", "cuckoo.conf")):
+        """@param cfg: configuration file path."""
+        for section, options in load_config(cfg).iteritems():
+            setattr(self, section, options)
 
     def get(self, section):
         """Get option.
@@ -38,6 +38,10 @@ class CuckooReportError(CuckooOperationalError):
     """Error in reporting module."""
     pass
 
+class CuckooModuleLimitError(CuckooOperationalError):
+    """Module killed for exceeding its time or memory limit."""
+    pass
+
 class CuckooGuestError(CuckooOperationalError):
     """Cuckoo guest agent error."""
     pass
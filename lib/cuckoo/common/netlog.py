@@ -0,0 +1,388 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Parsers of the behavior logs streamed by the analyzer.
+
+Both parsers read whole messages through the handler before calling any of
+its log_process(), log_thread() and log_call() methods. A read may raise when
+the message isn't fully received yet, in which case the event driven
+Resultserver parses the message again from its start later on, so nothing
+must have happened in between.
+"""
+
+import struct
+import logging
+import datetime
+
+from lib.cuckoo.common.defines import REG_SZ, REG_EXPAND_SZ
+from lib.cuckoo.common.defines import REG_DWORD, REG_DWORD_BIG_ENDIAN
+from lib.cuckoo.common.exceptions import CuckooResultError
+from lib.cuckoo.common.logtbl import table as LOGTBL
+from lib.cuckoo.common.utils import get_filename_from_path
+
+log = logging.getLogger(__name__)
+
+# Upper bound of the length of a single field or message, anything longer is
+# a corrupted stream.
+MAX_LENGTH = 64 * 1024 * 1024
+
+# Message header: API index, status, return value, thread id and time.
+HEADER = struct.Struct("<BBIII")
+# Process message: FILETIME, pid, ppid and the length of the module path.
+PROCESS = struct.Struct("<IIIII")
+UINT32 = struct.Struct("<I")
+INT32 = struct.Struct("<i")
+INT64 = struct.Struct("<q")
+UINT64 = struct.Struct("<Q")
+DOUBLE = struct.Struct("<d")
+
+FILETIME_EPOCH = datetime.datetime(1601, 1, 1)
+
+# Format specifiers of the fixed size arguments and their struct codes.
+INTEGERS = {
+    "i": "i",
+    "l": "i",
+    "L": "I",
+    "p": "I",
+    "P": "I",
+}
+# Format specifiers of the length prefixed arguments.
+STRINGS = "sSoObB"
+UNICODE_STRINGS = "uU"
+REGISTRY = "rR"
+LISTS = "aA"
+
+
+def expand_format(fmt):
+    """Expand the repeat counts of a format string, e.g. "2pB" to "ppB".
+    @param fmt: format string.
+    @return: expanded format string.
+    """
+    out = []
+    repeat = 1
+    for char in fmt:
+        if char.isdigit():
+            repeat = int(char)
+        else:
+            out.append(char * repeat)
+            repeat = 1
+    return "".join(out)
+
+
+def check_length(length):
+    if length > MAX_LENGTH:
+        raise CuckooResultError("Netlog failure, field length %d exceeds "
+                                "the maximum." % length)
+    return length
+
+
+def read_string(read, length):
+    return read(check_length(length))
+
+
+def read_unicode(read, length):
+    data = read(check_length(length * 2))
+    return data.decode("utf-16-le", "replace").encode("utf-8")
+
+
+def read_registry(read, kind, regtype, length):
+    data = read(check_length(length))
+    if regtype in (REG_SZ, REG_EXPAND_SZ):
+        if kind == "R":
+            data = data.decode("utf-16-le", "replace").encode("utf-8")
+        return data.rstrip("\x00")
+    if regtype == REG_DWORD and length == 4:
+        return UINT32.unpack(data)[0]
+    if regtype == REG_DWORD_BIG_ENDIAN and length == 4:
+        return struct.unpack(">I", data)[0]
+    return data
+
+
+def read_list(read, kind):
+    count = check_length(UINT32.unpack(read(4))[0])
+    values = []
+    for _ in xrange(count):
+        length = UINT32.unpack(read(4))[0]
+        if kind == "A":
+            values.append(read_unicode(read, length))
+        else:
+            values.append(read_string(read, length))
+    return values
+
+
+class ArgumentsDecoder(object):
+    """Decoder of the arguments of an API, compiled from its format.
+
+    Consecutive fixed size arguments are read and unpacked at once together
+    with the length prefix of the argument following them, so that a call
+    takes a read per variable length argument only.
+    """
+
+    def __init__(self, fmt):
+        # List of (struct, specifiers) steps, the last specifier of a step
+        # may be a variable length one.
+        self.steps = []
+
+        codes, kinds = "", ""
+        for kind in expand_format(fmt):
+            if kind in INTEGERS:
+                codes += INTEGERS[kind]
+                kinds += kind
+            elif kind in STRINGS or kind in UNICODE_STRINGS:
+                self._add_step(codes + "I", kinds + kind)
+                codes, kinds = "", ""
+            elif kind in REGISTRY:
+                self._add_step(codes + "II", kinds + kind)
+                codes, kinds = "", ""
+            elif kind in LISTS:
+                # The count comes first, the list is read by its own step.
+                if kinds:
+                    self._add_step(codes, kinds)
+                self.steps.append((None, kind))
+                codes, kinds = "", ""
+            else:
+                raise CuckooResultError("Netlog failure, unknown format "
+                                        "specifier %r" % kind)
+        if kinds:
+            self._add_step(codes, kinds)
+
+    def _add_step(self, codes, kinds):
+        self.steps.append((struct.Struct("<" + codes), kinds))
+
+    def decode(self, read):
+        """Read and decode the arguments.
+        @param read: function reading a number of bytes.
+        @return: list of argument values.
+        """
+        values = []
+        for step, kinds in self.steps:
+            if step is None:
+                values.append(read_list(read, kinds))
+                continue
+
+            fields = step.unpack(read(step.size))
+            index = 0
+            for kind in kinds:
+                if kind in "pP":
+                    values.append("0x%08x" % fields[index])
+                elif kind in INTEGERS:
+                    values.append(fields[index])
+                elif kind in STRINGS:
+                    values.append(read_string(read, fields[index]))
+                elif kind in UNICODE_STRINGS:
+                    values.append(read_unicode(read, fields[index]))
+                else:
+                    values.append(read_registry(read, kind, fields[index],
+                                                fields[index + 1]))
+                    index += 1
+                index += 1
+        return values
+
+
+def compile_table(table):
+    """@return: list of (apiname, category, argument names, decoder) by API
+    index.
+    """
+    apis = []
+    for apiname, category, parseinfo in table:
+        apis.append((apiname, category, parseinfo[1:],
+                     ArgumentsDecoder(parseinfo[0])))
+    return apis
+
+APIS = compile_table(LOGTBL)
+
+
+def filetime_to_datetime(low, high):
+    return FILETIME_EPOCH + datetime.timedelta(
+        microseconds=((high << 32) + low) / 10)
+
+
+class NetlogParser(object):
+    """Parser of the binary NETLOG protocol, its API calls are described by
+    the logtbl table."""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def read_next_message(self):
+        read = self.handler.read
+        apiindex, status, returnval, tid, timediff = \
+            HEADER.unpack(read(HEADER.size))
+        context = (apiindex, status, returnval, tid, timediff)
+
+        if apiindex == 0:
+            # New process message.
+            timelow, timehigh, pid, ppid, length = \
+                PROCESS.unpack(read(PROCESS.size))
+            modulepath = read_string(read, length)
+            vmtime = filetime_to_datetime(timelow, timehigh)
+            procname = get_filename_from_path(modulepath)
+            self.handler.log_process(context, vmtime, pid, ppid, modulepath,
+                                     procname)
+        elif apiindex == 1:
+            # New thread message.
+            pid = UINT32.unpack(read(4))[0]
+            self.handler.log_thread(context, pid)
+        else:
+            try:
+                apiname, category, argnames, decoder = APIS[apiindex]
+            except IndexError:
+                log.error("Netlog LOGTBL lookup error for API index %d "
+                          "(tid=%d)", apiindex, tid)
+                return False
+
+            values = decoder.decode(read)
+            self.handler.log_call(context, apiname, category,
+                                  zip(argnames, values))
+
+        return True
+
+
+def _decode_elements(data, offset, end, array):
+    """Decode the elements of a BSON document.
+    @param data: document data.
+    @param offset: offset of the first element.
+    @param end: offset of the document terminator.
+    @param array: whether to return the values only, as a list.
+    @return: dict or list.
+    """
+    values = [] if array else {}
+
+    while offset < end:
+        kind = data[offset]
+        # Element name, the array indexes aren't needed.
+        name_end = data.index("\x00", offset + 1)
+        if not array:
+            name = data[offset + 1:name_end]
+        offset = name_end + 1
+
+        if kind == "\x02":
+            length = INT32.unpack_from(data, offset)[0]
+            value = data[offset + 4:offset + 3 + length]
+            offset += 4 + length
+        elif kind == "\x10":
+            value = INT32.unpack_from(data, offset)[0]
+            offset += 4
+        elif kind == "\x03" or kind == "\x04":
+            length = INT32.unpack_from(data, offset)[0]
+            value = _decode_elements(data, offset + 4, offset + length - 1,
+                                     kind == "\x04")
+            offset += length
+        elif kind == "\x12":
+            value = INT64.unpack_from(data, offset)[0]
+            offset += 8
+        elif kind == "\x05":
+            length = INT32.unpack_from(data, offset)[0]
+            value = data[offset + 5:offset + 5 + length]
+            offset += 5 + length
+        elif kind == "\x08":
+            value = data[offset] != "\x00"
+            offset += 1
+        elif kind == "\x0a":
+            value = None
+        elif kind == "\x01":
+            value = DOUBLE.unpack_from(data, offset)[0]
+            offset += 8
+        elif kind == "\x09":
+            value = datetime.datetime.utcfromtimestamp(
+                INT64.unpack_from(data, offset)[0] / 1000.0)
+            offset += 8
+        elif kind == "\x11":
+            value = UINT64.unpack_from(data, offset)[0]
+            offset += 8
+        elif kind == "\x07":
+            value = data[offset:offset + 12].encode("hex")
+            offset += 12
+        else:
+            raise CuckooResultError("BSON failure, unsupported element type "
+                                    "0x%02x" % ord(kind))
+
+        if array:
+            values.append(value)
+        else:
+            values[name] = value
+
+    return values
+
+
+def bson_decode(data):
+    """Decode a BSON document.
+    @param data: document data, length prefix and terminator included.
+    @return: dict.
+    """
+    try:
+        return _decode_elements(data, 4, len(data) - 1, False)
+    except (struct.error, ValueError, IndexError) as e:
+        raise CuckooResultError("BSON failure, corrupted document: %s" % e)
+
+
+class BsonParser(object):
+    """Parser of the BSON protocol. The analyzer first describes every API
+    (its name, category and argument names) with an info message, the calls
+    then refer to it by index."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.infomap = {}
+
+    def read_next_message(self):
+        data = self.handler.read(4)
+        length = INT32.unpack(data)[0]
+        if length < 5 or length > MAX_LENGTH:
+            raise CuckooResultError("BSON failure, invalid document length "
+                                    "%d." % length)
+        dec = bson_decode(data + self.handler.read(length - 4))
+
+        mtype = dec.get("type")
+        index = dec.get("I", -1)
+        tid = dec.get("T", 0)
+        timediff = dec.get("t", 0)
+
+        if mtype == "info":
+            # Description of the API with this index.
+            self.infomap[index] = (dec.get("name", "NONAME"),
+                                   dec.get("args", []),
+                                   dec.get("category"))
+            return True
+        elif mtype == "debug":
+            log.info("Debug message from monitor: %s", dec.get("msg", ""))
+            return True
+
+        if index not in self.infomap:
+            log.warning("Got API with unknown index - monitor needs to "
+                        "explain first: %r", dec)
+            return True
+
+        apiname, arginfo, category = self.infomap[index]
+        args = dec.get("args", [])
+        if len(args) != len(arginfo):
+            log.warning("Inconsistent arg count (compared to arg names) on "
+                        "%s: %r names %r", apiname, args, arginfo)
+            return True
+
+        arguments = zip(arginfo, args)
+        # The first two arguments are the call status and return value.
+        context = [index, 1, 0, tid, timediff]
+
+        if apiname == "__process__":
+            argdict = dict(arguments[2:])
+            vmtime = filetime_to_datetime(argdict.get("TimeLow", 0),
+                                          argdict.get("TimeHigh", 0))
+            modulepath = argdict.get("ModulePath", "")
+            self.handler.log_process(context, vmtime,
+                                     argdict.get("ProcessIdentifier"),
+                                     argdict.get("ParentProcessIdentifier"),
+                                     modulepath,
+                                     get_filename_from_path(modulepath))
+        elif apiname == "__thread__":
+            argdict = dict(arguments[2:])
+            self.handler.log_thread(context,
+                                    argdict.get("ProcessIdentifier"))
+        else:
+            if len(arguments) >= 2:
+                context[1] = arguments[0][1]
+                context[2] = arguments[1][1]
+            self.handler.log_call(context, apiname, category, arguments[2:])
+
+        return True
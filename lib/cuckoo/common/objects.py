@@ -41,6 +41,39 @@ class Dictionary(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+class Hasher(object):
+    """Incremental calculation of the hashes of a file."""
+
+    def __init__(self):
+        self.crc32 = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+        self.sha512 = hashlib.sha512()
+
+    def update(self, chunk):
+        """Hash the next chunk of data.
+        @param chunk: data.
+        """
+        self.crc32 = binascii.crc32(chunk, self.crc32)
+        self.md5.update(chunk)
+        self.sha1.update(chunk)
+        self.sha256.update(chunk)
+        self.sha512.update(chunk)
+
+    def hashes(self):
+        """Get the hashes of the data seen so far.
+        @return: dict of hashes.
+        """
+        crc32 = self.crc32
+        return {
+            "crc32": "".join("%02X" % ((crc32>>i)&0xff) for i in [24, 16, 8, 0]),
+            "md5": self.md5.hexdigest(),
+            "sha1": self.sha1.hexdigest(),
+            "sha256": self.sha256.hexdigest(),
+            "sha512": self.sha512.hexdigest(),
+        }
+
 class URL:
     """URL base object."""
 
@@ -56,8 +89,11 @@ class File:
     notified_yara = False
     notified_pydeep = False
 
-    def __init__(self, file_path):
-        """@param file_path: file path."""
+    def __init__(self, file_path, hashes=None):
+        """@param file_path: file path.
+        @param hashes: already known hashes of the file, as returned by
+                       Hasher.hashes().
+        """
         self.file_path = file_path
 
         # these will be populated when first accessed
@@ -68,6 +104,9 @@ class File:
         self._sha256    = None
         self._sha512    = None
 
+        if hashes:
+            self._set_hashes(hashes)
+
     def get_name(self):
         """Get file name.
         @return: file name.
@@ -97,24 +136,18 @@ class File:
 
     def calc_hashes(self):
         """Calculate all possible hashes for this file."""
-        crc     = 0
-        md5     = hashlib.md5()
-        sha1    = hashlib.sha1()
-        sha256  = hashlib.sha256()
-        sha512  = hashlib.sha512()
-        
+        hasher = Hasher()
         for chunk in self.get_chunks():
-            crc = binascii.crc32(chunk, crc)
-            md5.update(chunk)
-            sha1.update(chunk)
-            sha256.update(chunk)
-            sha512.update(chunk)
-
-        self._crc32     = "".join("%02X" % ((crc>>i)&0xff) for i in [24, 16, 8, 0])
-        self._md5       = md5.hexdigest()
-        self._sha1      = sha1.hexdigest()
-        self._sha256    = sha256.hexdigest()
-        self._sha512    = sha512.hexdigest()
+            hasher.update(chunk)
+
+        self._set_hashes(hasher.hashes())
+
+    def _set_hashes(self, hashes):
+        self._crc32     = hashes["crc32"]
+        self._md5       = hashes["md5"]
+        self._sha1      = hashes["sha1"]
+        self._sha256    = hashes["sha256"]
+        self._sha512    = hashes["sha512"]
 
     @property
     def file_data(self):
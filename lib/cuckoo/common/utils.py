@@ -3,7 +3,11 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import json
+import gzip
 import time
+import zlib
+import struct
 import shutil
 import ntpath
 import string
@@ -19,6 +23,18 @@ try:
 except ImportError:
     HAVE_CHARDET = False
 
+# Hashes of the files uploaded by the analysis machine, one JSON object per
+# line, stored in the analysis folder.
+UPLOADS_MANIFEST = "uploads.jsonl"
+BEHAVIOR_SUMMARY = "behavior.json"
+RESULTSERVER_STATS = "resultserver.json"
+
+# Compressed logs are written as a series of independent gzip members of at
+# most this many bytes of data, so that every member fits the 16 bit block
+# size recorded in its header.
+GZIP_BLOCK_SIZE = 0xff00
+GZIP_MAGIC = "\x1f\x8b"
+
 def create_folders(root=".", folders=[]):
     """Create directories.
     @param root: root path.
@@ -60,6 +76,26 @@ def delete_folder(folder):
                                          "{0}".format(folder))
 
 
+def delete_analysis_folder(analysis_path, files_store):
+    """Delete an analysis folder along with the copies of its uploaded
+    files in the files store which no other analysis links to.
+    @param analysis_path: analysis folder path.
+    @param files_store: path of the content addressed files store.
+    @raise CuckooOperationalError: if fails to delete folder.
+    """
+    uploads = read_uploads_manifest(analysis_path)
+    delete_folder(analysis_path)
+
+    for entry in uploads.values():
+        store_path = os.path.join(files_store, entry["sha256"])
+        try:
+            # Only the store itself still links to the file.
+            if os.stat(store_path).st_nlink <= 1:
+                os.unlink(store_path)
+        except OSError:
+            continue
+
+
 # don't allow all characters in "string.printable", as newlines, carriage
 # returns, tabs, \x0b, and \x0c may mess up reports
 PRINTABLE_CHARACTERS = string.letters + string.digits + string.punctuation + " \t\r\n"
@@ -137,6 +173,101 @@ def store_temp_file(filedata, filename):
 
     return tmp_file_path
 
+def read_uploads_manifest(analysis_path):
+    """Read the hashes of the files uploaded by the analysis machine, which
+    the Resultserver records while receiving them.
+    @param analysis_path: analysis folder path.
+    @return: dict of uploaded file details by path relative to the analysis
+             folder.
+    """
+    uploads = {}
+
+    manifest_path = os.path.join(analysis_path, UPLOADS_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return uploads
+
+    with open(manifest_path, "rb") as manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            uploads[entry["path"]] = entry
+
+    return uploads
+
+class BlockGzipFile(object):
+    """Write-only gzip file made of independently compressed blocks.
+    Every block is a complete gzip member carrying its compressed size in a
+    "BC" extra field, the same layout as BGZF, so that the result can be read
+    by any gzip reader and a reader can seek to any block boundary and start
+    decompressing from there.
+    """
+
+    def __init__(self, path, level=6):
+        self.fd = open(path, "wb")
+        self.level = level
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        data = str(data)
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+        if self.pending_size >= GZIP_BLOCK_SIZE:
+            data = "".join(self.pending)
+            end = len(data) - len(data) % GZIP_BLOCK_SIZE
+            for offset in xrange(0, end, GZIP_BLOCK_SIZE):
+                self._write_block(data[offset:offset + GZIP_BLOCK_SIZE])
+            self.pending = [data[end:]]
+            self.pending_size = len(data) - end
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        # Header (18 bytes) and trailer (8 bytes) around the deflated data.
+        block_size = len(deflated) + 26
+        header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 255, 6,
+                             ord("B"), ord("C"), 2, block_size - 1)
+        trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                              len(data))
+        self.fd.write(header + deflated + trailer)
+
+    def flush(self):
+        """Compress the buffered data as a (short) block of its own."""
+        if self.pending_size:
+            self._write_block("".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+        self.fd.flush()
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+def open_log(path, offset=0):
+    """Open a log for reading, whether it was stored compressed or not.
+    @param path: log path, without the ".gz" extension of its compressed
+                 version.
+    @param offset: position to start reading from; for a compressed log this
+                   is the offset of a block in the compressed file.
+    @return: file object of the uncompressed log.
+    """
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        path += ".gz"
+
+    fd = open(path, "rb")
+    compressed = fd.read(2) == GZIP_MAGIC
+    fd.seek(offset)
+    if compressed:
+        gz = gzip.GzipFile(fileobj=fd, mode="rb")
+        # Let the GzipFile close the underlying file as well.
+        gz.myfileobj = fd
+        return gz
+    return fd
+
 class TimeoutServer(xmlrpclib.ServerProxy):
     """Timeout server for XMLRPC.
     XMLRPC + timeout - still a bit ugly - but at least gets rid of setdefaulttimeout
@@ -4,8 +4,12 @@
 
 import os
 import json
+import errno
+import socket
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import Condition
+from multiprocessing.util import register_after_fork
 
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT
@@ -16,13 +20,15 @@ from lib.cuckoo.common.objects import File, URL
 from lib.cuckoo.common.utils import create_folder, Singleton
 
 try:
-    from sqlalchemy import create_engine, Column
+    from sqlalchemy import create_engine, event, inspect, Column
     from sqlalchemy import Integer, String, Boolean, DateTime, Enum
-    from sqlalchemy import ForeignKey, Text, Index, Table
+    from sqlalchemy import ForeignKey, Text, Index, Table, func, or_
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.exc import SQLAlchemyError, IntegrityError
     from sqlalchemy.orm import sessionmaker, relationship, joinedload, backref
-    from sqlalchemy.pool import NullPool
+    from sqlalchemy.engine.url import make_url
+    from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+    from sqlalchemy.schema import CreateTable, CreateIndex
     Base = declarative_base()
 except ImportError:
     raise CuckooDependencyError("Unable to import sqlalchemy "
@@ -37,6 +43,54 @@ TASK_RECOVERED = "recovered"
 TASK_REPORTED = "reported"
 TASK_FAILED_ANALYSIS = "failed_analysis"
 TASK_FAILED_PROCESSING = "failed_processing"
+TASK_STATUSES = (TASK_PENDING,
+                 TASK_RUNNING,
+                 TASK_COMPLETED,
+                 TASK_REPORTED,
+                 TASK_RECOVERED,
+                 TASK_FAILED_ANALYSIS,
+                 TASK_FAILED_PROCESSING)
+
+# Lease duration of the tasks fetched without giving one. The fetching
+# process has to renew it with renew_leases() while it runs them.
+LEASE_SECONDS = 300
+
+POOL_CLASSES = {
+    "null": NullPool,
+    "queue": QueuePool,
+    "static": StaticPool,
+}
+
+def lease_owner():
+    """Identify the current process as a lease owner.
+    @return: lease owner, as "hostname:pid".
+    """
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+def lease_owner_alive(owner):
+    """Check whether the scheduler holding a lease may still be running.
+    Schedulers of other hosts can't be checked and are assumed alive.
+    @param owner: lease owner, as "hostname:pid".
+    @return: False if nobody holds the lease, the owner isn't a
+             "hostname:pid" or the scheduler is gone.
+    """
+    if not owner:
+        return False
+
+    try:
+        host, pid = owner.rsplit(":", 1)
+        pid = int(pid)
+    except ValueError:
+        return False
+
+    if host != socket.gethostname() or pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
 
 # Secondary table used in association Task - Tag.
 tasks_tags = Table("tasks_tags", Base.metadata,
@@ -78,7 +132,12 @@ class Sample(Base):
                             "sha1",
                             "sha256",
                             "sha512",
-                            unique=True), )
+                            unique=True),
+                      # Lookups by a single hash (e.g. find_sample()) can't
+                      # make use of the composite index.
+                      Index("md5_index", "md5"),
+                      Index("sha1_index", "sha1"),
+                      Index("sha256_index", "sha256"))
 
     def __repr__(self):
         return "<Sample('{0}','{1}')>".format(self.id, self.sha256)
@@ -150,6 +209,37 @@ class Error(Base):
     def __repr__(self):
         return "<Error('{0}','{1}','{2}')>".format(self.id, self.message, self.task_id)
 
+class TaskCount(Base):
+    """Number of tasks in a status.
+    Kept up to date by the status transitions, so that counting tasks
+    doesn't scan the tasks table.
+    """
+    __tablename__ = "task_counts"
+
+    status = Column(String(255), primary_key=True)
+    count = Column(Integer(), nullable=False, default=0)
+
+    def __init__(self, status, count=0):
+        self.status = status
+        self.count = count
+
+    def __repr__(self):
+        return "<TaskCount('{0}','{1}')>".format(self.status, self.count)
+
+class Throughput(Base):
+    """Number of tasks completed in an hour."""
+    __tablename__ = "throughput"
+
+    period = Column(DateTime(timezone=False), primary_key=True)
+    completed = Column(Integer(), nullable=False, default=0)
+
+    def __init__(self, period, completed=0):
+        self.period = period
+        self.completed = completed
+
+    def __repr__(self):
+        return "<Throughput('{0}','{1}')>".format(self.period, self.completed)
+
 class Task(Base):
     """Analysis task queue."""
     __tablename__ = "tasks"
@@ -176,17 +266,19 @@ class Task(Base):
                       nullable=False)
     started_on = Column(DateTime(timezone=False), nullable=True)
     completed_on = Column(DateTime(timezone=False), nullable=True)
-    status = Column(Enum(TASK_PENDING,
-                         TASK_RUNNING,
-                         TASK_COMPLETED,
-                         TASK_REPORTED,
-                         TASK_RECOVERED,
-                         name="status_type"),
-                         server_default=TASK_PENDING,
-                         nullable=False)
+    status = Column(Enum(*TASK_STATUSES, name="status_type"),
+                    server_default=TASK_PENDING,
+                    nullable=False)
+    lease_owner = Column(String(255), nullable=True)
+    lease_expires = Column(DateTime(timezone=False), nullable=True)
     sample_id = Column(Integer, ForeignKey("samples.id"), nullable=True)
     sample = relationship("Sample", backref="tasks")
     errors = relationship("Error", backref="tasks", cascade="save-update, delete")
+    # Serves the pending queue lookup done by fetch() and the status filters,
+    # in the same priority DESC, added_on order.
+    __table_args__ = (Index("queue_index", "status", priority.desc(), "added_on"),
+                      # Listings by status walk this index in id order.
+                      Index("status_index", "status"))
 
     def to_dict(self):
         """Converts object to dict.
@@ -230,9 +322,9 @@ class Database(object):
         cfg = Config()
 
         if dsn:
-            self.engine = create_engine(dsn, poolclass=NullPool)
+            self._connect_database(dsn, cfg)
         elif cfg.database.connection:
-            self.engine = create_engine(cfg.database.connection, poolclass=NullPool)
+            self._connect_database(cfg.database.connection, cfg)
         else:
             db_file = os.path.join(CUCKOO_ROOT, "db", "cuckoo.db")
             if not os.path.exists(db_file):
@@ -243,28 +335,262 @@ class Database(object):
                     except CuckooOperationalError as e:
                         raise CuckooDatabaseError("Unable to create database directory: {0}".format(e))
 
-            self.engine = create_engine("sqlite:///{0}".format(db_file), poolclass=NullPool)
+            self._connect_database("sqlite:///{0}".format(db_file), cfg)
 
         # Disable SQL logging. Turn it on for debugging.
         self.engine.echo = False
-        # Connection timeout.
-        if cfg.database.timeout:
-            self.engine.pool_timeout = cfg.database.timeout
-        else:
-            self.engine.pool_timeout = 60
         # Create schema.
         try:
             Base.metadata.create_all(self.engine)
+            self._upgrade_schema()
         except SQLAlchemyError as e:
             raise CuckooDatabaseError("Unable to create or connect to database: {0}".format(e))
 
         # Get db session.
         self.Session = sessionmaker(bind=self.engine)
 
+        # The counters are maintained from here on, they only have to be
+        # computed for databases created by an older version.
+        if not self.count_tasks_by_status():
+            self.rebuild_counters()
+
+        # Bumped whenever the task queue changes (a new task is committed or
+        # an analysis slot is released) so that the scheduler can wake up
+        # immediately instead of polling. The generation seen by the last
+        # wait tells the changes which weren't waited for yet apart.
+        self.queue_changed = Condition()
+        self.queue_generation = 0
+        self.queue_seen = 0
+
     def __del__(self):
         """Disconnects pool."""
         self.engine.dispose()
 
+    def _connect_database(self, connection_string, cfg):
+        """Create the database engine and its connection pool.
+        @param connection_string: database connection string.
+        @param cfg: cuckoo.conf configuration.
+        """
+        url = make_url(connection_string)
+        sqlite = url.drivername.startswith("sqlite")
+        memory = sqlite and url.database in (None, "", ":memory:")
+
+        if cfg.database.timeout:
+            timeout = cfg.database.timeout
+        else:
+            timeout = 60
+
+        # By default connections are kept open and reused. An in-memory SQLite
+        # database only exists as long as its connection, so it gets a single
+        # shared one.
+        pool = cfg.database.pool
+        if pool:
+            if pool not in POOL_CLASSES:
+                raise CuckooDatabaseError("Unknown database connection pool "
+                                          "\"{0}\"".format(pool))
+            poolclass = POOL_CLASSES[pool]
+        elif memory:
+            poolclass = StaticPool
+        else:
+            poolclass = QueuePool
+
+        options = {"poolclass": poolclass}
+        if poolclass is QueuePool:
+            options["pool_size"] = cfg.database.pool_size or 5
+            options["max_overflow"] = options["pool_size"] * 2
+            options["pool_timeout"] = timeout
+            # Avoid reusing connections dropped by the server (e.g. MySQL's
+            # wait_timeout).
+            options["pool_recycle"] = 3600
+
+        if sqlite:
+            # Pooled connections are shared between threads.
+            options["connect_args"] = {"check_same_thread": False}
+
+        self.engine = create_engine(url, **options)
+
+        if sqlite:
+            event.listen(self.engine, "connect", self._sqlite_connect(timeout, memory))
+
+        # Forked children (e.g. processing processes) must not reuse the
+        # connections opened by their parent.
+        register_after_fork(self, Database._after_fork)
+
+    def _sqlite_connect(self, timeout, memory):
+        """Build the callback tuning every new SQLite connection.
+        @param timeout: seconds to wait for a locked database.
+        @param memory: whether the database is in memory.
+        @return: connect event listener.
+        """
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # Write ahead logging lets readers (web interface, API) run
+            # concurrently with the writer (scheduler).
+            if not memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
+            # Durable enough with WAL and way faster than FULL.
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA mmap_size=268435456")
+            cursor.execute("PRAGMA busy_timeout={0}".format(int(timeout * 1000)))
+            cursor.close()
+
+        return on_connect
+
+    def _after_fork(self):
+        """Drop the connections inherited from the parent process."""
+        self.engine.pool = self.engine.pool.recreate()
+
+    def _upgrade_schema(self):
+        """Bring the schema of an existing database up to date.
+
+        create_all() only creates missing tables, so the columns and indexes
+        added to existing tables after the database has been created are
+        added here.
+        """
+        inspector = inspect(self.engine)
+
+        for table in Base.metadata.sorted_tables:
+            existing = [column["name"] for column in inspector.get_columns(table.name)]
+            indexes = [index["name"] for index in inspector.get_indexes(table.name)]
+
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                if not column.nullable:
+                    log.warning("Unable to add column %s.%s to the existing "
+                                "database, please upgrade it manually",
+                                table.name, column.name)
+                    continue
+
+                column_type = column.type.compile(dialect=self.engine.dialect)
+                self.engine.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                    table.name, column.name, column_type))
+                existing.append(column.name)
+                log.info("Added column %s.%s to the database",
+                         table.name, column.name)
+
+            for index in table.indexes:
+                if index.name in indexes and not self._index_outdated(index):
+                    continue
+
+                if [column for column in index.columns if column.name not in existing]:
+                    log.warning("Unable to create index %s on the existing "
+                                "database, please upgrade it manually",
+                                index.name)
+                    continue
+
+                if index.name in indexes:
+                    index.drop(bind=self.engine)
+
+                log.info("Creating index %s on the database, this might take "
+                         "a while on big tables", index.name)
+                index.create(bind=self.engine)
+
+        self._upgrade_status_type()
+
+    def _index_outdated(self, index):
+        """Check whether an existing index has been created without the
+        descending columns it's now declared with.
+        @param index: declared index.
+        @return: whether the index has to be created again.
+        """
+        if "DESC" not in str(CreateIndex(index).compile(dialect=self.engine.dialect)):
+            return False
+
+        dialect = self.engine.dialect.name
+        if dialect == "sqlite":
+            definition = self.engine.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", index.name).scalar()
+        elif dialect == "postgresql":
+            definition = self.engine.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", index.name).scalar()
+        elif dialect == "mysql":
+            # Descending indexes are only built since MySQL 8.0, earlier
+            # versions report every column as ascending.
+            if self.engine.dialect.server_version_info < (8, 0):
+                return False
+            rows = self.engine.execute("SELECT collation FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s", index.table.name, index.name).fetchall()
+            return "D" not in [row[0] for row in rows]
+        else:
+            return False
+
+        return definition is not None and "DESC" not in definition.upper()
+
+    def _upgrade_status_type(self):
+        """Add the task statuses introduced after the database has been
+        created to the constraint or type restricting the status column."""
+        dialect = self.engine.dialect.name
+        status_type = Task.__table__.c.status.type
+
+        if dialect == "sqlite":
+            # The statuses are checked by a CHECK constraint, which SQLite
+            # can't alter: the table has to be created again.
+            row = self.engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'tasks'").fetchone()
+            if not row or "status IN (" not in row[0] or \
+                    not [status for status in TASK_STATUSES if "'{0}'".format(status) not in row[0]]:
+                return
+
+            log.info("Upgrading the task statuses of the database, this "
+                     "might take a while on big tables")
+            table = Task.__table__
+            columns = ", ".join(column.name for column in table.columns)
+            statements = [
+                # Keep the foreign keys of the other tables pointing to
+                # "tasks" while it's renamed.
+                "PRAGMA legacy_alter_table = ON",
+                "BEGIN",
+            ]
+            statements += ["DROP INDEX IF EXISTS {0}".format(index.name)
+                           for index in table.indexes]
+            statements += [
+                "ALTER TABLE tasks RENAME TO tasks_old",
+                str(CreateTable(table).compile(dialect=self.engine.dialect)).strip(),
+            ]
+            statements += [str(CreateIndex(index).compile(dialect=self.engine.dialect))
+                           for index in table.indexes]
+            statements += [
+                "INSERT INTO tasks ({0}) SELECT {0} FROM tasks_old".format(columns),
+                "DROP TABLE tasks_old",
+                "COMMIT",
+                "PRAGMA legacy_alter_table = OFF",
+            ]
+
+            connection = self.engine.raw_connection()
+            try:
+                connection.connection.executescript(";\n".join(statements) + ";")
+            except Exception as e:
+                connection.connection.rollback()
+                raise CuckooDatabaseError("Unable to upgrade the task statuses "
+                                          "of the database: {0}".format(e))
+            finally:
+                connection.close()
+        elif dialect == "postgresql":
+            existing = [row[0] for row in self.engine.execute(
+                "SELECT e.enumlabel FROM pg_enum e JOIN pg_type t ON e.enumtypid = t.oid "
+                "WHERE t.typname = %s", status_type.name)]
+            missing = [status for status in TASK_STATUSES if status not in existing]
+            if not existing or not missing:
+                return
+
+            # ALTER TYPE ... ADD VALUE can't run inside a transaction.
+            connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                for status in missing:
+                    log.info("Adding the task status %s to the database", status)
+                    connection.execute("ALTER TYPE {0} ADD VALUE '{1}'".format(status_type.name, status))
+            finally:
+                connection.close()
+        elif dialect == "mysql":
+            row = self.engine.execute(
+                "SELECT column_type FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = 'tasks' "
+                "AND column_name = 'status'").fetchone()
+            if not row or not [status for status in TASK_STATUSES if "'{0}'".format(status) not in row[0]]:
+                return
+
+            log.info("Upgrading the task statuses of the database")
+            self.engine.execute("ALTER TABLE tasks MODIFY status {0} NOT NULL DEFAULT '{1}'".format(
+                status_type.compile(dialect=self.engine.dialect), TASK_PENDING))
+
     def _get_or_create(self, session, model, **kwargs):
         """Get an ORM instance or create it if not exist.
         @param session: SQLAlchemy session object
@@ -278,53 +604,343 @@ class Database(object):
             instance = model(**kwargs)
             return instance
 
+    def notify(self):
+        """Signal that the task queue changed and should be checked."""
+        with self.queue_changed:
+            self.queue_generation += 1
+            self.queue_changed.notify_all()
+
+    def wait_for_tasks(self, timeout=None):
+        """Wait until the task queue changes or the timeout expires.
+
+        Changes notified since the previous call return immediately, so
+        that a notification landing while the caller checks the queue is
+        never lost.
+        @param timeout: maximum amount of seconds to wait.
+        @return: True if woken up by a notification.
+        """
+        with self.queue_changed:
+            if self.queue_generation == self.queue_seen and timeout != 0:
+                self.queue_changed.wait(timeout)
+            woken = self.queue_generation != self.queue_seen
+            self.queue_seen = self.queue_generation
+        return woken
+
     def set_status(self, task_id, status):
         """Set task status.
         @param task_id: task identifier
         @param status: status string
         @return: operation status
         """
+        for attempt in range(2):
+            session = self.Session()
+            try:
+                row = session.query(Task).get(task_id)
+                self._count_status(session, row.status, status)
+                row.status = status
+
+                if status == TASK_RUNNING:
+                    row.started_on = datetime.now()
+                elif status == TASK_COMPLETED and not row.completed_on:
+                    # Tasks queued again for processing complete again,
+                    # only their first completion is accounted.
+                    row.completed_on = datetime.now()
+                    self._count_completed(session, row.completed_on)
+
+                session.commit()
+                return True
+            except IntegrityError as e:
+                session.rollback()
+                # The first completion in an hour races with other writers
+                # on the creation of its throughput bucket; the retry
+                # updates their bucket. Anything else won't go away.
+                if status != TASK_COMPLETED or attempt:
+                    log.error("Unable to set the status of task #%s to %s: "
+                              "%s", task_id, status, e)
+                    return False
+            except SQLAlchemyError as e:
+                log.error("Unable to set the status of task #%s to %s: %s",
+                          task_id, status, e)
+                session.rollback()
+                return False
+            finally:
+                session.close()
+
+    def _count_status(self, session, old, new, count=1):
+        """Move tasks between the status counters.
+        @param session: SQLAlchemy session object
+        @param old: previous status, None for new tasks
+        @param new: new status, None for deleted tasks
+        @param count: number of tasks
+        """
+        if not count or old == new:
+            return
+
+        if old:
+            session.query(TaskCount).filter(TaskCount.status == old).update(
+                {TaskCount.count: TaskCount.count - count},
+                synchronize_session=False)
+        if new:
+            session.query(TaskCount).filter(TaskCount.status == new).update(
+                {TaskCount.count: TaskCount.count + count},
+                synchronize_session=False)
+
+    def _count_completed(self, session, completed_on):
+        """Account a completed task in its throughput bucket.
+        @param session: SQLAlchemy session object
+        @param completed_on: completion time
+        """
+        period = completed_on.replace(minute=0, second=0, microsecond=0)
+        updated = session.query(Throughput).filter(Throughput.period == period).update(
+            {Throughput.completed: Throughput.completed + 1},
+            synchronize_session=False)
+        if not updated:
+            session.add(Throughput(period, 1))
+
+    def rebuild_counters(self):
+        """Recompute the status counters and throughput from the tasks.
+        Only needed for databases upgraded from an older version or after
+        tasks were changed bypassing this class.
+        """
         session = self.Session()
         try:
-            row = session.query(Task).get(task_id)
-            row.status = status
+            session.query(TaskCount).delete()
+            session.query(Throughput).delete()
 
-            if status == TASK_RUNNING:
-                row.started_on = datetime.now()
-            elif status == TASK_COMPLETED:
-                row.completed_on = datetime.now()
+            counts = dict(session.query(Task.status, func.count(Task.id)).group_by(Task.status))
+            for status in TASK_STATUSES:
+                session.add(TaskCount(status, counts.get(status, 0)))
+
+            periods = {}
+            for completed_on, in session.query(Task.completed_on).filter(Task.completed_on != None):
+                period = completed_on.replace(minute=0, second=0, microsecond=0)
+                periods[period] = periods.get(period, 0) + 1
+            for period, completed in periods.items():
+                session.add(Throughput(period, completed))
 
             session.commit()
         except SQLAlchemyError as e:
-            log.debug("Database error setting status: {0}".format(e))
+            log.debug("Database error rebuilding counters: {0}".format(e))
             session.rollback()
         finally:
             session.close()
 
-    def fetch(self, lock=True):
+    def fetch(self, lock=True, lease_seconds=LEASE_SECONDS):
         """Fetches a task waiting to be processed and locks it for running.
+        @param lock: whether to lease the task to the current process.
+        @param lease_seconds: lease duration, if None the lease never expires.
         @return: None or task
         """
+        if lock:
+            tasks = self.fetch_batch(1, lease_seconds=lease_seconds)
+            if tasks:
+                return tasks[0]
+            return None
+
         session = self.Session()
         row = None
 
         try:
             row = session.query(Task).filter(Task.status == TASK_PENDING).order_by("priority desc, added_on").first()
-
-            if not row:
-                return None
-
-            if lock:
-                self.set_status(task_id=row.id, status=TASK_RUNNING)
-                session.refresh(row)
         except SQLAlchemyError as e:
             log.debug("Database error fetching task: {0}".format(e))
             session.rollback()
+        else:
+            if row:
+                session.expunge(row)
         finally:
             session.close()
 
         return row
 
+    def fetch_batch(self, count, owner=None, lease_seconds=None):
+        """Fetches up to count pending tasks and leases them for running.
+
+        The pending tasks are claimed with a single conditional UPDATE, so
+        concurrent schedulers sharing the same database never get the same
+        task. A lease which is not renewed before its expiration is taken
+        back by release_expired_leases().
+        @param count: maximum number of tasks to fetch.
+        @param owner: unique identifier of the fetching scheduler, as
+                      "hostname:pid", if None the current process.
+        @param lease_seconds: lease duration, if None the lease never expires.
+        @return: list of tasks.
+        """
+        session = self.Session()
+        tasks = []
+
+        if not owner:
+            owner = lease_owner()
+
+        now = datetime.now()
+        if lease_seconds:
+            expires = now + timedelta(seconds=lease_seconds)
+        else:
+            expires = None
+
+        try:
+            candidates = [row.id for row in session.query(Task.id).filter(Task.status == TASK_PENDING).order_by(Task.priority.desc(), Task.added_on).limit(count)]
+            if not candidates:
+                return tasks
+
+            # Only the candidates which are still pending are claimed, the
+            # others have been taken by someone else in the meantime.
+            claimed = session.query(Task).filter(Task.id.in_(candidates),
+                                                 Task.status == TASK_PENDING).update(
+                {Task.status: TASK_RUNNING,
+                 Task.started_on: now,
+                 Task.lease_owner: owner,
+                 Task.lease_expires: expires},
+                synchronize_session=False)
+            self._count_status(session, TASK_PENDING, TASK_RUNNING, claimed)
+            session.commit()
+
+            if claimed:
+                tasks = session.query(Task).filter(Task.id.in_(candidates),
+                                                   Task.status == TASK_RUNNING,
+                                                   Task.lease_owner == owner).order_by(Task.priority.desc(), Task.added_on).all()
+                for task in tasks:
+                    session.expunge(task)
+        except SQLAlchemyError as e:
+            log.debug("Database error fetching tasks: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        return tasks
+
+    def renew_leases(self, owner, lease_seconds, status=TASK_RUNNING):
+        """Extend the leases of all the tasks held by an owner.
+        @param owner: identifier of the scheduler holding the leases.
+        @param lease_seconds: new lease duration.
+        @param status: status of the leased tasks.
+        @return: number of renewed leases.
+        """
+        session = self.Session()
+        renewed = 0
+        try:
+            renewed = session.query(Task).filter(Task.status == status,
+                                                 Task.lease_owner == owner).update(
+                {Task.lease_expires: datetime.now() + timedelta(seconds=lease_seconds)},
+                synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error renewing leases: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+        return renewed
+
+    def release_expired_leases(self):
+        """Put running tasks whose lease expired back in the pending queue.
+        @return: number of released tasks.
+        """
+        session = self.Session()
+        released = 0
+        try:
+            released = session.query(Task).filter(Task.status == TASK_RUNNING,
+                                                  Task.lease_expires < datetime.now()).update(
+                {Task.status: TASK_PENDING,
+                 Task.started_on: None,
+                 Task.lease_owner: None,
+                 Task.lease_expires: None},
+                synchronize_session=False)
+            self._count_status(session, TASK_RUNNING, TASK_PENDING, released)
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error releasing leases: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        if released:
+            self.notify()
+        return released
+
+    def fetch_completed(self, count, owner, lease_seconds):
+        """Fetches up to count completed tasks and leases them for
+        processing.
+
+        Only the completed tasks nobody holds an unexpired lease on are
+        claimed, with a single conditional UPDATE, so concurrent processing
+        workers never get the same task.
+        @param count: maximum number of tasks to fetch.
+        @param owner: unique identifier of the processing worker.
+        @param lease_seconds: lease duration.
+        @return: list of tasks.
+        """
+        session = self.Session()
+        tasks = []
+
+        now = datetime.now()
+        free = or_(Task.lease_owner == None, Task.lease_expires < now)
+
+        try:
+            candidates = [row.id for row in session.query(Task.id).filter(Task.status == TASK_COMPLETED, free).order_by(Task.completed_on).limit(count)]
+            if not candidates:
+                return tasks
+
+            claimed = session.query(Task).filter(Task.id.in_(candidates),
+                                                 Task.status == TASK_COMPLETED,
+                                                 free).update(
+                {Task.lease_owner: owner,
+                 Task.lease_expires: now + timedelta(seconds=lease_seconds)},
+                synchronize_session=False)
+            session.commit()
+
+            if claimed:
+                tasks = session.query(Task).filter(Task.id.in_(candidates),
+                                                   Task.status == TASK_COMPLETED,
+                                                   Task.lease_owner == owner).order_by(Task.completed_on).all()
+                for task in tasks:
+                    session.expunge(task)
+        except SQLAlchemyError as e:
+            log.debug("Database error fetching completed tasks: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        return tasks
+
+    def release_lease(self, task_id):
+        """Drop the lease of a task, e.g. a completed one left for another
+        process to process.
+        @param task_id: ID of the task.
+        """
+        session = self.Session()
+        try:
+            session.query(Task).filter(Task.id == task_id).update(
+                {Task.lease_owner: None, Task.lease_expires: None},
+                synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error releasing lease: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+    def take_over_lease(self, task_id, previous, owner):
+        """Move the lease of a task from a scheduler which went away to
+        another one, unless somebody else took it over already.
+        @param task_id: ID of the task.
+        @param previous: lease owner which went away.
+        @param owner: new lease owner.
+        @return: whether the lease was taken over.
+        """
+        session = self.Session()
+        taken = 0
+        try:
+            taken = session.query(Task).filter(Task.id == task_id,
+                                               Task.lease_owner == previous).update(
+                {Task.lease_owner: owner},
+                synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error taking over lease: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+        return taken == 1
 
     def add_error(self, message, task_id):
         """Add an error related to a task.
@@ -344,20 +960,22 @@ class Database(object):
 
     # The following functions are mostly used by external utils.
 
-    def add(self,
-            obj,
-            timeout=0,
-            package="",
-            options="",
-            priority=1,
-            custom="",
-            platform="",
-            tags=None,
-            memory=False,
-            enforce_timeout=False,
-            clock=None):
-        """Add a task to database.
-        @param obj: object to add (File or URL).
+    def add_many(self,
+                 objs,
+                 timeout=0,
+                 package="",
+                 options="",
+                 priority=1,
+                 custom="",
+                 platform="",
+                 tags=None,
+                 memory=False,
+                 enforce_timeout=False,
+                 clock=None):
+        """Add several tasks to database in a single transaction.
+        Samples are looked up by hash in bulk and only the unknown ones are
+        inserted, tags are resolved with a single query.
+        @param objs: list of objects to add (File or URL).
         @param timeout: selected timeout.
         @param options: analysis options.
         @param priority: analysis priority.
@@ -367,84 +985,172 @@ class Database(object):
         @param memory: toggle full memory dump.
         @param enforce_timeout: toggle full timeout execution.
         @param clock: virtual machine clock time
-        @return: cursor or None.
+        @return: list of task IDs, in the same order as objs, or None.
         """
-        session = self.Session()
-
         # Convert empty strings and None values to a valid int
         if not timeout:
             timeout = 0
         if not priority:
             priority = 1
 
-        if isinstance(obj, File):
-            sample = Sample(md5=obj.get_md5(),
-                            crc32=obj.get_crc32(),
-                            sha1=obj.get_sha1(),
-                            sha256=obj.get_sha256(),
-                            sha512=obj.get_sha512(),
-                            file_size=obj.get_size(),
-                            file_type=obj.get_type(),
-                            ssdeep=obj.get_ssdeep())
-            session.add(sample)
+        if clock and isinstance(clock, basestring):
+            try:
+                clock = datetime.strptime(clock, "%m-%d-%Y %H:%M:%S")
+            except ValueError:
+                log.warning("The date you specified has an invalid format, using current timestamp")
+                clock = datetime.now()
 
+        # Deal with tags format (i.e. foo,bar,baz)
+        tag_names = []
+        if tags:
+            for tag in tags.replace(" ", "").split(","):
+                if tag and tag not in tag_names:
+                    tag_names.append(tag)
+
+        # A concurrent submission of the same sample or tag makes the
+        # transaction fail on the unique constraints; the second attempt
+        # then finds the rows committed by the other writer.
+        for attempt in range(2):
+            session = self.Session()
             try:
+                task_ids = self._add_many(session, objs, tag_names, clock,
+                                          timeout=timeout,
+                                          package=package,
+                                          options=options,
+                                          priority=priority,
+                                          custom=custom,
+                                          platform=platform,
+                                          memory=memory,
+                                          enforce_timeout=enforce_timeout)
                 session.commit()
-            except IntegrityError:
+                break
+            except IntegrityError as e:
                 session.rollback()
-                try:
-                    sample = session.query(Sample).filter(Sample.md5 == obj.get_md5()).first()
-                except SQLAlchemyError:
-                    session.close()
+                if attempt:
+                    log.debug("Database error adding tasks: {0}".format(e))
                     return None
             except SQLAlchemyError as e:
-                log.debug("Database error adding task: {0}".format(e))
-                session.close()
+                log.debug("Database error adding tasks: {0}".format(e))
+                session.rollback()
                 return None
+            finally:
+                session.close()
 
-            task = Task(obj.file_path)
-            task.sample_id = sample.id
-        elif isinstance(obj, URL):
-            task = Task(obj.url)
-
-        task.category = obj.__class__.__name__.lower()
-        task.timeout = timeout
-        task.package = package
-        task.options = options
-        task.priority = priority
-        task.custom = custom
-        task.platform = platform
-        task.memory = memory
-        task.enforce_timeout = enforce_timeout
+        if task_ids:
+            self.notify()
+        return task_ids
 
-        # Deal with tags format (i.e. foo,bar,baz)
-        if tags:
-            for tag in tags.replace(" ","").split(","):
-                task.tags.append(self._get_or_create(session, Tag, name=tag))
-
-        if clock:
-            if isinstance(clock, str) or isinstance(clock, unicode):
-                try:
-                    task.clock = datetime.strptime(clock, "%m-%d-%Y %H:%M:%S")
-                except ValueError:
-                    log.warning("The date you specified has an invalid format, using current timestamp")
-                    task.clock = datetime.now()
+    def _add_many(self, session, objs, tag_names, clock, **columns):
+        """Stage the samples, tasks and tags for add_many().
+        @param session: SQLAlchemy session object
+        @param objs: list of objects to add (File or URL).
+        @param tag_names: list of tag names.
+        @param clock: virtual machine clock time
+        @param columns: values shared by all the tasks.
+        @return: list of task IDs.
+        """
+        files = [obj for obj in objs if isinstance(obj, File)]
+
+        samples = {}
+        hashes = list(set(obj.get_sha256() for obj in files))
+        # Keep the IN clause below the bound parameters limit of SQLite.
+        for i in xrange(0, len(hashes), 500):
+            for sample in session.query(Sample).filter(Sample.sha256.in_(hashes[i:i+500])):
+                samples[sample.sha256] = sample
+
+        for obj in files:
+            sha256 = obj.get_sha256()
+            if sha256 not in samples:
+                samples[sha256] = Sample(md5=obj.get_md5(),
+                                         crc32=obj.get_crc32(),
+                                         sha1=obj.get_sha1(),
+                                         sha256=sha256,
+                                         sha512=obj.get_sha512(),
+                                         file_size=obj.get_size(),
+                                         file_type=obj.get_type(),
+                                         ssdeep=obj.get_ssdeep())
+                session.add(samples[sha256])
+
+        tags = []
+        if tag_names:
+            existing = dict((tag.name, tag) for tag in
+                            session.query(Tag).filter(Tag.name.in_(tag_names)))
+            for name in tag_names:
+                if name not in existing:
+                    existing[name] = Tag(name)
+                    session.add(existing[name])
+                tags.append(existing[name])
+
+        tasks = []
+        for obj in objs:
+            if isinstance(obj, File):
+                task = Task(obj.file_path)
+                task.sample = samples[obj.get_sha256()]
+            elif isinstance(obj, URL):
+                task = Task(obj.url)
             else:
+                raise CuckooOperationalError("Unable to add task for "
+                                             "object {0!r}".format(obj))
+
+            task.category = obj.__class__.__name__.lower()
+            for key, value in columns.items():
+                setattr(task, key, value)
+            if clock:
                 task.clock = clock
+            tasks.append(task)
 
-        session.add(task)
+        session.add_all(tasks)
+        session.flush()
+        self._count_status(session, None, TASK_PENDING, len(tasks))
 
-        try:
-            session.commit()
-            task_id = task.id
-        except SQLAlchemyError as e:
-            log.debug("Database error adding task: {0}".format(e))
-            session.rollback()
-            return None
-        finally:
-            session.close()
+        # The Task.tags relationship only allows a tag to have a single
+        # parent, so the association rows are written directly.
+        if tags:
+            session.execute(tasks_tags.insert(),
+                            [{"task_id": task.id, "tag_id": tag.id}
+                             for task in tasks for tag in tags])
 
-        return task_id
+        return [task.id for task in tasks]
+
+    def add(self,
+            obj,
+            timeout=0,
+            package="",
+            options="",
+            priority=1,
+            custom="",
+            platform="",
+            tags=None,
+            memory=False,
+            enforce_timeout=False,
+            clock=None):
+        """Add a task to database.
+        @param obj: object to add (File or URL).
+        @param timeout: selected timeout.
+        @param options: analysis options.
+        @param priority: analysis priority.
+        @param custom: custom options.
+        @param platform: platform.
+        @param tags: optional tags that must be set for machine selection
+        @param memory: toggle full memory dump.
+        @param enforce_timeout: toggle full timeout execution.
+        @param clock: virtual machine clock time
+        @return: cursor or None.
+        """
+        task_ids = self.add_many([obj],
+                                 timeout,
+                                 package,
+                                 options,
+                                 priority,
+                                 custom,
+                                 platform,
+                                 tags,
+                                 memory,
+                                 enforce_timeout,
+                                 clock)
+        if not task_ids:
+            return None
+        return task_ids[0]
 
     def add_path(self,
                  file_path,
@@ -553,8 +1259,10 @@ class Database(object):
 
         # Change status to recovered.
         session = self.Session()
-        session.query(Task).get(task_id).status = TASK_RECOVERED
         try:
+            row = session.query(Task).get(task_id)
+            self._count_status(session, row.status, TASK_RECOVERED)
+            row.status = TASK_RECOVERED
             session.commit()
         except SQLAlchemyError as e:
             log.debug("Database error rescheduling task: {0}".format(e))
@@ -581,14 +1289,21 @@ class Database(object):
                    task.enforce_timeout,
                    task.clock)
 
-    def list_tasks(self, limit=None, details=False, category=None, offset=None, status=None, not_status=None):
+    def list_tasks(self, limit=None, details=False, category=None, offset=None, status=None, not_status=None, after_id=None, before_id=None, sample=False, task_ids=None):
         """Retrieve list of task.
+        Tasks are returned newest first. For paging through large tables
+        use after_id/before_id instead of offset, they seek straight to the
+        cursor on the primary key index.
         @param limit: specify a limit of entries.
         @param details: if details about must be included
         @param category: filter by category
         @param offset: list offset
         @param status: filter by task status
         @param not_status: exclude this task status from filter
+        @param after_id: only tasks older than this task ID (next page)
+        @param before_id: only tasks newer than this task ID (previous page)
+        @param sample: if the sample of file tasks must be loaded as well
+        @param task_ids: only tasks with these IDs
         @return: list of tasks.
         """
         session = self.Session()
@@ -601,13 +1316,25 @@ class Database(object):
                 search = search.filter(Task.status != not_status)
             if category:
                 search = search.filter(Task.category == category)
+            if task_ids is not None:
+                search = search.filter(Task.id.in_(task_ids))
             if details:
                 search = search.options(joinedload("errors"), joinedload("tags"))
-
-            tasks = search.order_by("added_on desc").limit(limit).offset(offset).all()
+            if sample:
+                search = search.options(joinedload("sample"))
+
+            if before_id is not None:
+                # Take the closest newer tasks and flip them back to the
+                # usual newest first order.
+                search = search.filter(Task.id > before_id)
+                tasks = search.order_by(Task.id.asc()).limit(limit).offset(offset).all()
+                tasks.reverse()
+            else:
+                if after_id is not None:
+                    search = search.filter(Task.id < after_id)
+                tasks = search.order_by(Task.id.desc()).limit(limit).offset(offset).all()
         except SQLAlchemyError as e:
             log.debug("Database error listing tasks: {0}".format(e))
-            print e
             return None
         finally:
             session.close()
@@ -621,27 +1348,64 @@ class Database(object):
         session = self.Session()
         try:
             if status:
-                tasks_count = session.query(Task).filter(Task.status == status).count()
+                tasks_count = session.query(TaskCount.count).filter(TaskCount.status == status).scalar()
             else:
-                tasks_count = session.query(Task).count()
+                tasks_count = session.query(func.sum(TaskCount.count)).scalar()
         except SQLAlchemyError as e:
             log.debug("Database error counting tasks: {0}".format(e))
             return 0
         finally:
             session.close()
-        return tasks_count
+        return tasks_count or 0
+
+    def count_tasks_by_status(self):
+        """Count tasks in the database for each status.
+        @return: dict of status and number of tasks
+        """
+        session = self.Session()
+        try:
+            counts = dict((row.status, row.count) for row in session.query(TaskCount))
+        except SQLAlchemyError as e:
+            log.debug("Database error counting tasks: {0}".format(e))
+            return {}
+        finally:
+            session.close()
+        return counts
+
+    def throughput(self, hours=24):
+        """Retrieve the number of tasks completed in each of the last hours.
+        @param hours: number of hours to look back
+        @return: list of (hour, completed tasks) tuples, oldest first; hours
+                 without completed tasks are left out.
+        """
+        since = datetime.now().replace(minute=0, second=0, microsecond=0)
+        since -= timedelta(hours=hours - 1)
+
+        session = self.Session()
+        try:
+            rows = session.query(Throughput).filter(Throughput.period >= since).order_by(Throughput.period).all()
+        except SQLAlchemyError as e:
+            log.debug("Database error retrieving throughput: {0}".format(e))
+            return []
+        finally:
+            session.close()
+        return [(row.period, row.completed) for row in rows]
 
-    def view_task(self, task_id, details=False):
+    def view_task(self, task_id, details=False, sample=False):
         """Retrieve information on a task.
         @param task_id: ID of the task to query.
+        @param details: if errors and tags must be loaded as well
+        @param sample: if the sample of a file task must be loaded as well
         @return: details on the task.
         """
         session = self.Session()
         try:
+            search = session.query(Task)
             if details:
-                task = session.query(Task).options(joinedload("errors"), joinedload("tags")).get(task_id)
-            else:
-                task = session.query(Task).get(task_id)
+                search = search.options(joinedload("errors"), joinedload("tags"))
+            if sample:
+                search = search.options(joinedload("sample"))
+            task = search.get(task_id)
         except SQLAlchemyError as e:
             log.debug("Database error viewing task: {0}".format(e))
             return None
@@ -660,6 +1424,7 @@ class Database(object):
         session = self.Session()
         try:
             task = session.query(Task).get(task_id)
+            self._count_status(session, task.status, None)
             session.delete(task)
             session.commit()
         except SQLAlchemyError as e:
@@ -3,14 +3,27 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import copy
+import time
+import errno
+import select
+import signal
+import cPickle
+import hashlib
 import pkgutil
 import inspect
+import Queue
 import logging
+import threading
+from itertools import groupby
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import _run_after_forkers
 from distutils.version import StrictVersion
 
 from lib.cuckoo.common.abstracts import Auxiliary, Machinery, Processing
 from lib.cuckoo.common.abstracts import Report, Signature
+from lib.cuckoo.common.cache import ResultCache
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT, CUCKOO_VERSION
 from lib.cuckoo.common.exceptions import CuckooCriticalError
@@ -18,11 +31,15 @@ from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.exceptions import CuckooProcessingError
 from lib.cuckoo.common.exceptions import CuckooReportError
 from lib.cuckoo.common.exceptions import CuckooDependencyError
+from lib.cuckoo.common.exceptions import CuckooModuleLimitError
+from lib.cuckoo.common.objects import File
 from lib.cuckoo.core.database import Database
 
 log = logging.getLogger(__name__)
 
 _modules = defaultdict(dict)
+_module_hashes = {}
+_rss_warned = False
 
 def import_plugin(name):
     try:
@@ -66,6 +83,152 @@ def list_plugins(group=None):
     else:
         return _modules
 
+def module_hash(module):
+    """Get the hash of the code of a module, to tell its versions apart.
+    @param module: module class or instance.
+    @return: SHA1 of the source file of the module.
+    """
+    path = inspect.getsourcefile(inspect.getmodule(module))
+    if path not in _module_hashes:
+        with open(path, "rb") as f:
+            _module_hashes[path] = hashlib.sha1(f.read()).hexdigest()
+    return _module_hashes[path]
+
+def can_measure_rss():
+    """Check whether the resident memory of processes can be measured,
+    which process_rss() does through procfs, i.e. on Linux only.
+    @return: whether process_rss() works on this host.
+    """
+    return os.path.exists("/proc/self/status")
+
+def module_features(module):
+    """Get which optional dependencies of a module could be imported, as
+    told by the HAVE_* flags of its source module.
+    @param module: module class or instance.
+    @return: sorted list of flag names and values.
+    """
+    return sorted((name, bool(value))
+                  for name, value in vars(inspect.getmodule(module)).items()
+                  if name.startswith("HAVE_"))
+
+def process_rss(pid):
+    """Get the resident memory of a process.
+    @param pid: process identifier.
+    @return: resident memory in bytes, 0 if unknown.
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return 0
+
+def run_isolated(function, timeout=0, max_memory=0):
+    """Run a function in a child process, within time and memory limits.
+    The child is forked, so the function and its arguments don't need to be
+    pickled, its return value does.
+    @param function: function to run.
+    @param timeout: seconds the child can run, 0 for no limit.
+    @param max_memory: megabytes of resident memory the child can use, 0 for
+                       no limit.
+    @return: function return value.
+    @raise CuckooModuleLimitError: if the child exceeded a limit or died.
+    """
+    global _rss_warned
+    if max_memory and not can_measure_rss():
+        if not _rss_warned:
+            log.warning("The memory of the isolated modules can't be "
+                        "measured on this host, their max_memory option "
+                        "is ignored")
+            _rss_warned = True
+        max_memory = 0
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+
+    if not pid:
+        # Child process, hand over the outcome and leave without running
+        # any of the parent's cleanup, whatever happens.
+        status = 1
+        try:
+            os.close(rfd)
+
+            # The fork might have happened while another thread was holding
+            # one of the logging locks, make sure we don't inherit it locked.
+            for handler in logging.getLogger().handlers:
+                handler.createLock()
+            # Drop the database connections shared with the parent, as
+            # multiprocessing does for its own processes.
+            _run_after_forkers()
+
+            try:
+                outcome = True, function()
+            except Exception as e:
+                outcome = False, e
+            except BaseException as e:
+                # Don't raise SystemExit and the like in the parent.
+                outcome = False, CuckooOperationalError(
+                    "Exited with %r" % e)
+            try:
+                data = cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                data = cPickle.dumps((False, CuckooOperationalError(
+                    "Unable to pickle the outcome: %s" % e)))
+            with os.fdopen(wfd, "wb") as f:
+                f.write(data)
+            status = 0
+        except BaseException:
+            log.exception("Failure in the isolated child process")
+        finally:
+            os._exit(status)
+
+    os.close(wfd)
+    started = time.time()
+    chunks = []
+    error = None
+
+    try:
+        while True:
+            try:
+                ready = select.select([rfd], [], [], 0.1)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if ready:
+                chunk = os.read(rfd, 1024 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+            if timeout and time.time() - started > timeout:
+                error = "ran longer than %s seconds" % timeout
+            elif max_memory and process_rss(pid) > max_memory * 1024 * 1024:
+                error = "used more than %s MB of memory" % max_memory
+            if error:
+                os.kill(pid, signal.SIGKILL)
+                break
+    finally:
+        os.close(rfd)
+        status = os.waitpid(pid, 0)[1]
+
+    if error:
+        raise CuckooModuleLimitError(error)
+    if not chunks:
+        if os.WIFSIGNALED(status):
+            raise CuckooModuleLimitError("was killed by signal %d" %
+                                         os.WTERMSIG(status))
+        raise CuckooModuleLimitError("died with exit status %d" %
+                                     os.WEXITSTATUS(status))
+
+    success, value = cPickle.loads("".join(chunks))
+    if not success:
+        raise value
+    return value
+
 class RunAuxiliary(object):
     """Auxiliary modules manager."""
 
@@ -130,7 +293,8 @@ class RunProcessing(object):
     """Analysis Results Processing Engine.
 
     This class handles the loading and execution of the processing modules.
-    It executes the enabled ones sequentially and generates a dictionary which
+    It executes the enabled ones on a pool of threads, every module as soon
+    as the modules it depends on are done, and generates a dictionary which
     is then passed over the reporting engine.
     """
 
@@ -140,11 +304,24 @@ class RunProcessing(object):
         self.analysis_path = os.path.join(CUCKOO_ROOT, "storage", "analyses", str(task_id))
         self.cfg = Config(cfg=os.path.join(CUCKOO_ROOT, "conf", "processing.conf"))
 
-    def process(self, module):
-        """Run a processing module.
-        @param module: processing module to run.
-        @param results: results dict.
-        @return: results generated by module.
+        cuckoo = Config()
+        self.threads = cuckoo.processing.threads or 1
+
+        # Results of the modules depending only on the analyzed file.
+        self.cache = None
+        self.sha256 = None
+        if cuckoo.processing.cache_size:
+            self.cache = ResultCache.shared(os.path.join(CUCKOO_ROOT, "storage", "cache", "processing"),
+                                            cuckoo.processing.cache_size * 1024 * 1024)
+
+            binary = os.path.join(self.analysis_path, "binary")
+            if self.task["category"] == "file" and os.path.exists(binary):
+                self.sha256 = File(binary).get_sha256()
+
+    def load(self, module):
+        """Initialize a processing module.
+        @param module: processing module to initialize.
+        @return: processing module instance or None if disabled.
         """
         # Initialize the specified processing module.
         try:
@@ -152,7 +329,7 @@ class RunProcessing(object):
         except:
             log.exception("Failed to load the processing module "
                           "\"{0}\":".format(module))
-            return
+            return None
 
         # Extract the module name.
         module_name = inspect.getmodule(current).__name__
@@ -177,19 +354,67 @@ class RunProcessing(object):
         # Give it the options from the relevant processing.conf section.
         current.set_options(options)
 
+        return current
+
+    def process(self, current, results):
+        """Run a processing module.
+        @param current: processing module instance.
+        @param results: results of the modules it depends on.
+        @return: results generated by module.
+        """
+        current.set_results(results)
+
+        # The cache only saves time, if it fails the module is run.
+        try:
+            cache_key = self.cache_key(current)
+            if cache_key:
+                found, data = self.cache.get(cache_key)
+                if found:
+                    log.debug("Reusing the cached results of processing "
+                              "module \"%s\"", current.__class__.__name__)
+                    return {current.key: current.from_cache(data)}
+        except Exception as e:
+            log.warning("Unable to use the cached results of processing "
+                        "module \"%s\", running it: %s",
+                        current.__class__.__name__, e)
+            cache_key = None
+
         try:
             # Run the processing module and retrieve the generated data to be
             # appended to the general results container.
-            data = current.run()
+            if current.options.isolate:
+                # Modules may set their key within run(), it's lost with
+                # the child otherwise.
+                data, current.key = run_isolated(
+                    lambda: (current.run(), current.key),
+                    timeout=current.options.timeout or 0,
+                    max_memory=current.options.max_memory or 0)
+            else:
+                data = current.run()
 
             log.debug("Executed processing module \"%s\" on analysis at "
                       "\"%s\"", current.__class__.__name__, self.analysis_path)
 
+            # Empty results may only be due to something missing, which
+            # could be there next time.
+            if cache_key and data:
+                try:
+                    self.cache.put(cache_key, data)
+                except Exception as e:
+                    log.warning("Unable to cache the results of processing "
+                                "module \"%s\": %s",
+                                current.__class__.__name__, e)
+
             # If succeeded, return they module's key name and the data to be
             # appended to it.
             return {current.key: data}
         except CuckooDependencyError as e:
             log.warning("The processing module \"%s\" has missing dependencies: %s", current.__class__.__name__, e)
+        except CuckooModuleLimitError as e:
+            message = "The processing module \"%s\" %s and was " \
+                      "killed" % (current.__class__.__name__, e)
+            log.error(message)
+            Database().add_error(message, self.task["id"])
         except CuckooProcessingError as e:
             log.warning("The processing module \"%s\" returned the following "
                         "error: %s", current.__class__.__name__, e)
@@ -199,6 +424,101 @@ class RunProcessing(object):
 
         return None
 
+    def cache_key(self, current):
+        """Get the key of the cached results of a processing module.
+        @param current: processing module instance.
+        @return: cache key or None if its results can't be cached.
+        """
+        if not self.cache or not self.sha256 or not current.cacheable:
+            return None
+
+        # Changes to the module code, its options or the availability of its
+        # optional dependencies invalidate the results.
+        options = sorted((str(key), repr(value))
+                         for key, value in current.options.items())
+        return self.cache.make_key(self.sha256, current.__class__.__name__,
+                                   CUCKOO_VERSION, module_hash(current),
+                                   repr(options),
+                                   repr(module_features(current)))
+
+    def schedule(self, modules, results):
+        """Run processing modules once their dependencies are done. The
+        modules not declaring any wait for the ones with a lower order.
+        @param modules: processing module instances, by order.
+        @param results: results dict to merge the results into.
+        """
+        # Dependencies on keys no enabled module provides are ignored.
+        provided = set(current.key for current in modules if current.key)
+        pending = list(modules)
+        done = set()
+        finished_modules = set()
+        running = 0
+        finished = Queue.Queue()
+
+        if self.threads > 1:
+            pool = ThreadPool(self.threads)
+        else:
+            pool = None
+
+        try:
+            while pending or running:
+                ready = []
+                for current in pending:
+                    if current.depends:
+                        waits = [key for key in current.depends
+                                 if key in provided and key not in done]
+                    else:
+                        waits = [other for other in modules
+                                 if other.order < current.order and
+                                 other not in finished_modules]
+                    if not waits:
+                        ready.append(current)
+
+                if not ready and not running:
+                    for current in pending:
+                        log.warning("The processing module \"%s\" has "
+                                    "circular dependencies, skipped",
+                                    current.__class__.__name__)
+                    break
+
+                for current in ready:
+                    pending.remove(current)
+                    depends = dict((key, results[key])
+                                   for key in current.depends
+                                   if key in results)
+
+                    if pool:
+                        pool.apply_async(self._process, (current, depends),
+                                         callback=finished.put)
+                    else:
+                        finished.put(self._process(current, depends))
+                    running += 1
+
+                # Merge the results of a finished module, this thread is the
+                # only one touching the results dict.
+                current, result = finished.get()
+                running -= 1
+                done.add(current.key)
+                finished_modules.add(current)
+                if result:
+                    results.update(result)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def _process(self, current, results):
+        """Run a processing module for schedule(), which waits for every
+        module it started to be reported as finished: never raises.
+        @return: tuple of the module instance and its results.
+        """
+        try:
+            return current, self.process(current, results)
+        except:
+            log.exception("Failed to run the processing module \"%s\":",
+                          current.__class__.__name__)
+            return current, None
+
     def run(self):
         """Run all processing modules and all signatures.
         @return: processing results.
@@ -220,13 +540,16 @@ class RunProcessing(object):
         if processing_list:
             processing_list.sort(key=lambda module: module.order)
 
-            # Run every loaded processing module.
+            modules = []
             for module in processing_list:
-                result = self.process(module)
-                # If it provided some results, append it to the big results
-                # container.
-                if result:
-                    results.update(result)
+                current = self.load(module)
+                if current:
+                    modules.append(current)
+
+            # Run every enabled processing module, the ones not depending
+            # on each other concurrently. If they provided some results,
+            # they're appended to the big results container.
+            self.schedule(modules, results)
         else:
             log.info("No processing modules loaded")
 
@@ -408,7 +731,8 @@ class RunSignatures(object):
                 # Reset the ParseProcessLog instances after each signature
                 if "behavior" in self.results:
                     for process in self.results["behavior"]["processes"]:
-                        process["calls"].reset()
+                        if hasattr(process["calls"], "reset"):
+                            process["calls"].reset()
 
         if matched:
             # Sort the matched signatures by their severity level.
@@ -416,7 +740,7 @@ class RunSignatures(object):
 
         self.results["signatures"] = matched
 
-class RunReporting:
+class RunReporting(object):
     """Reporting Engine.
 
     This class handles the loading and execution of the enabled reporting
@@ -431,17 +755,21 @@ class RunReporting:
         self.analysis_path = os.path.join(CUCKOO_ROOT, "storage", "analyses", str(task_id))
         self.cfg = Config(cfg=os.path.join(CUCKOO_ROOT, "conf", "reporting.conf"))
 
-    def process(self, module):
-        """Run a single reporting module.
+        cuckoo = Config()
+        self.concurrent = cuckoo.processing.concurrent_reporting
+        self.timeout = cuckoo.processing.reporting_timeout or 0
+
+    def load(self, module):
+        """Initialize a reporting module.
         @param module: reporting module.
-        @param results: results results from analysis.
+        @return: reporting module instance or None if disabled.
         """
         # Initialize current reporting module.
         try:
             current = module()
         except:
             log.exception("Failed to load the reporting module \"{0}\":".format(module))
-            return
+            return None
 
         # Extract the module name.
         module_name = inspect.getmodule(current).__name__
@@ -452,11 +780,11 @@ class RunReporting:
             options = self.cfg.get(module_name)
         except CuckooOperationalError:
             log.debug("Reporting module %s not found in configuration file", module_name)
-            return
+            return None
 
         # If the reporting module is disabled in the config, skip it.
         if not options.enabled:
-            return
+            return None
 
         # Give it the path to the analysis results folder.
         current.set_path(self.analysis_path)
@@ -467,16 +795,108 @@ class RunReporting:
         # Load the content of the analysis.conf file.
         current.cfg = Config(current.conf_path)
 
+        return current
+
+    def process(self, current, results):
+        """Run a single reporting module.
+        @param current: reporting module instance.
+        @param results: results results from analysis.
+        """
         try:
-            current.run(self.results)
+            if current.options.isolate:
+                run_isolated(lambda: current.run(results),
+                             timeout=self.get_timeout(current),
+                             max_memory=current.options.max_memory or 0)
+            else:
+                current.run(results)
             log.debug("Executed reporting module \"%s\"", current.__class__.__name__)
         except CuckooDependencyError as e:
             log.warning("The reporting module \"%s\" has missing dependencies: %s", current.__class__.__name__, e)
+        except CuckooModuleLimitError as e:
+            message = "The reporting module \"%s\" %s and was " \
+                      "killed" % (current.__class__.__name__, e)
+            log.error(message)
+            Database().add_error(message, self.task["id"])
         except CuckooReportError as e:
             log.warning("The reporting module \"%s\" returned the following error: %s", current.__class__.__name__, e)
         except:
             log.exception("Failed to run the reporting module \"%s\":", current.__class__.__name__)
 
+    def start(self, current, results):
+        """Run a reporting module in a thread of its own.
+        @param current: reporting module instance.
+        @param results: results dict to give it.
+        @return: thread and start time.
+        """
+        thread = threading.Thread(target=self.process, args=(current, results),
+                                  name="Reporting-%s" % current.__class__.__name__)
+        thread.start()
+        return thread, time.time()
+
+    def get_timeout(self, current):
+        """Get the timeout of a reporting module.
+        @param current: reporting module instance.
+        @return: timeout in seconds, 0 for none.
+        """
+        # The timeout option of the module section in reporting.conf
+        # overrides the default one.
+        if current.options.timeout is not None:
+            return current.options.timeout
+        return self.timeout
+
+    def wait(self, current, thread, started):
+        """Wait for a reporting module to be done.
+        @param current: reporting module instance.
+        @param thread: thread running it.
+        @param started: start time.
+        """
+        # A thread can't be stopped, leaving it behind would let it go on
+        # reading the results while the next modules change them. Only the
+        # isolated modules are killed on timeout, the others are waited for.
+        thread.join()
+        self.check_timeout(current, started)
+
+    def check_timeout(self, current, started):
+        """Warn about a module which isn't isolated running past its
+        timeout, which can't be enforced.
+        @param current: reporting module instance.
+        @param started: start time.
+        """
+        timeout = self.get_timeout(current)
+        if timeout and not current.options.isolate and \
+                time.time() - started > timeout:
+            log.warning("The reporting module \"%s\" ran longer than its "
+                        "timeout of %d seconds, set its isolate option for "
+                        "the timeout to be enforced",
+                        current.__class__.__name__, timeout)
+
+    def schedule(self, modules):
+        """Run the reporting modules by order.
+        @param modules: reporting module instances, sorted by order.
+        """
+        for order, group in groupby(modules, key=lambda current: current.order):
+            group = list(group)
+
+            if self.concurrent and len(group) > 1:
+                # The modules sharing an order don't depend on each other
+                # and read the same results, only the ones changing them get
+                # a deep copy of their own, nested structures included. The
+                # isolated ones run on the copy of their child process.
+                threads = []
+                for current in group:
+                    if current.mutates_results and not current.options.isolate:
+                        results = copy.deepcopy(self.results)
+                    else:
+                        results = self.results
+                    threads.append(self.start(current, results))
+                for current, (thread, started) in zip(group, threads):
+                    self.wait(current, thread, started)
+            else:
+                for current in group:
+                    started = time.time()
+                    self.process(current, self.results)
+                    self.check_timeout(current, started)
+
     def run(self):
         """Generates all reports.
         @raise CuckooReportError: if a report module fails.
@@ -491,8 +911,13 @@ class RunReporting:
         if reporting_list:
             reporting_list.sort(key=lambda module: module.order)
 
-            # Run every loaded reporting module.
+            modules = []
             for module in reporting_list:
-                self.process(module)
+                current = self.load(module)
+                if current:
+                    modules.append(current)
+
+            # Run every enabled reporting module.
+            self.schedule(modules)
         else:
             log.info("No reporting modules loaded")
@@ -3,12 +3,20 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import json
+import time
+import errno
+import fcntl
 import socket
 import select
+import signal
 import logging
 import datetime
+import itertools
 import SocketServer
-from threading import Event, Thread
+import multiprocessing
+from collections import namedtuple
+from threading import Event, Lock, Thread
 
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT
@@ -16,75 +24,243 @@ from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.exceptions import CuckooCriticalError
 from lib.cuckoo.common.exceptions import CuckooResultError
 from lib.cuckoo.common.netlog import NetlogParser, BsonParser
+from lib.cuckoo.common.objects import Hasher
 from lib.cuckoo.common.utils import create_folder, Singleton, logtime
+from lib.cuckoo.common.utils import UPLOADS_MANIFEST, BEHAVIOR_SUMMARY
+from lib.cuckoo.common.utils import RESULTSERVER_STATS
+from lib.cuckoo.common.utils import BlockGzipFile
 
 log = logging.getLogger(__name__)
 
 BUFSIZE = 16 * 1024
+# Not exposed by the socket module of Python 2, this is its value on Linux.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
 EXTENSIONS = {
     NetlogParser: ".raw",
     BsonParser: ".bson",
 }
 
+# API call arguments collected in the behavior summary, by argument name.
+# Registry handles opened with an OBJECT_ATTRIBUTES are logged by the name of
+# the structure, those are only taken from the registry APIs.
+SUMMARY_ARGUMENTS = {
+    "FileName": "files",
+    "ExistingFileName": "files",
+    "NewFileName": "files",
+    "DirectoryName": "files",
+    "SubKey": "keys",
+    "MutexName": "mutexes",
+}
+
 class Disconnect(Exception):
     pass
 
+class NeedMoreData(Exception):
+    """The buffered data doesn't hold a whole message yet."""
+    pass
+
+
+class ReceiveBuffer(object):
+    """Receive buffer of a connection.
 
-class Resultserver(SocketServer.ThreadingTCPServer, object):
+    Data is received straight into a bytearray with recv_into() and handed
+    out by length or by line, so that small reads don't cost a system call
+    each.
+    """
+
+    def __init__(self, size=BUFSIZE):
+        self.size = size
+        self.buf = bytearray(size)
+        # Unread data is buf[start:end].
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def fill(self, sock):
+        """Receive data from a socket.
+        @param sock: socket to receive from.
+        @return: number of bytes received, 0 if the peer disconnected.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size:
+                self.buf = bytearray(self.size)
+        elif self.end == len(self.buf):
+            if self.start:
+                # Move the unread data to the front.
+                self.buf[:self.end-self.start] = self.buf[self.start:self.end]
+                self.end -= self.start
+                self.start = 0
+            else:
+                # A message larger than the buffer.
+                self.buf.extend(bytearray(len(self.buf)))
+
+        received = sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += received
+        return received
+
+    def find(self, sub):
+        """Find a substring in the unread data.
+        @param sub: substring to look for.
+        @return: offset of the substring from the read position or -1.
+        """
+        offset = self.buf.find(sub, self.start, self.end)
+        if offset < 0:
+            return offset
+        return offset - self.start
+
+    def read(self, length):
+        """Consume data.
+        @param length: number of bytes, at most len(self).
+        @return: data.
+        """
+        data = str(buffer(self.buf, self.start, length))
+        self.start += length
+        return data
+
+    def slice(self, start, end):
+        """Get a read only view on the buffered data, not valid after the
+        next fill().
+        """
+        return buffer(self.buf, start, end - start)
+
+
+class Resultserver(object):
     """Result server. Singleton!
 
-    This class handles results coming back from the analysis machines.
+    This class handles results coming back from the analysis machines,
+    using the engine selected in cuckoo.conf.
     """
 
     __metaclass__ = Singleton
 
-    allow_reuse_address = True
-    daemon_threads = True
-
-    def __init__(self, *args, **kwargs):
+    def __init__(self):
         self.cfg = Config()
+        self.engine = create_engine(self.cfg)
+
+        if self.cfg.resultserver.stats_interval:
+            self.statsthread = Thread(target=self.dump_stats,
+                                      args=(self.cfg.resultserver.stats_interval,))
+            self.statsthread.setDaemon(True)
+            self.statsthread.start()
+
+    def add_task(self, task, machine):
+        """Register a task/machine with the Resultserver."""
+        self.engine.add_task(task, machine)
+
+    def del_task(self, task, machine):
+        """Delete Resultserver state and wait for pending RequestHandlers."""
+        self.engine.del_task(task, machine)
+
+    def stats(self):
+        """@return: current Resultserver statistics."""
+        return self.engine.get_stats()
+
+    def stop(self):
+        """Stop the Resultserver engine."""
+        self.engine.stop()
+
+    def dump_stats(self, interval):
+        """Periodically write the statistics to storage, for the processes
+        other than this one (e.g. the REST API) to read them.
+        @param interval: seconds between two dumps.
+        """
+        path = os.path.join(CUCKOO_ROOT, "storage", RESULTSERVER_STATS)
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    json.dump(self.stats(), f)
+                os.rename(path + ".tmp", path)
+            except (IOError, OSError) as e:
+                log.warning("Unable to write the Resultserver "
+                            "statistics: %s", e)
+
+
+def create_engine(cfg):
+    """Start the Resultserver engine selected in the configuration.
+    @param cfg: Cuckoo configuration.
+    @return: engine.
+    """
+    engine = cfg.resultserver.engine or "threads"
+    if engine not in ENGINES:
+        raise CuckooCriticalError("Unknown result server engine "
+                                  "\"{0}\".".format(engine))
+
+    workers = cfg.resultserver.workers or 1
+    if workers > 1:
+        return ResultserverWorkers(cfg, engine, workers)
+    return ENGINES[engine](cfg)
+
+
+class ResultserverBase(object):
+    """Task bookkeeping shared by the Resultserver engines."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
         self.analysistasks = {}
         self.analysishandlers = {}
-
-        try:
-            server_addr = self.cfg.resultserver.ip, self.cfg.resultserver.port
-            SocketServer.ThreadingTCPServer.__init__(self,
-                                                     server_addr,
-                                                     Resulthandler,
-                                                     *args,
-                                                     **kwargs)
-        except Exception as e:
-            raise CuckooCriticalError("Unable to bind result server on "
-                                      "{0}:{1}: {2}".format(
-                                          self.cfg.resultserver.ip,
-                                          self.cfg.resultserver.port, str(e)))
-        else:
-            self.servethread = Thread(target=self.serve_forever)
-            self.servethread.setDaemon(True)
-            self.servethread.start()
+        self.behaviors = {}
+        self.stats = ResultserverStats()
 
     def add_task(self, task, machine):
         """Register a task/machine with the Resultserver."""
         self.analysistasks[machine.ip] = (task, machine)
         self.analysishandlers[task.id] = []
+        self.stats.add_task(task.id)
+        if self.cfg.resultserver.aggregate_behavior:
+            self.behaviors[task.id] = BehaviorAggregator()
 
     def del_task(self, task, machine):
         """Delete Resultserver state and wait for pending RequestHandlers."""
+        processes = self.end_task(task, machine)
+        if processes is not None:
+            write_behavior_summary(task.id, processes)
+
+    def end_task(self, task, machine):
+        """Delete the task state and wait for its pending RequestHandlers.
+        @return: behavior of the task processes, if aggregated.
+        """
         x = self.analysistasks.pop(machine.ip, None)
         if not x:
             log.warning("Resultserver did not have {0} in its task "
                         "info.".format(machine.ip))
-        handlers = self.analysishandlers.pop(task.id, None)
+        handlers = self.analysishandlers.pop(task.id, None) or []
+        start = time.time()
         for h in handlers:
-            h.end_request.set()
+            h.end()
             h.done_event.wait()
+        self.stats.del_task(task.id, time.time() - start)
+
+        behavior = self.behaviors.pop(task.id, None)
+        if behavior:
+            return behavior.processes_summary()
+        return None
+
+    def get_stats(self):
+        """@return: statistics snapshot."""
+        return self.stats.snapshot()
+
+    def stop(self):
+        """Nothing to stop, the engine runs in daemon threads."""
+        pass
+
+    def reuse_port(self, sock):
+        """Let the worker processes bind the same address."""
+        if (self.cfg.resultserver.workers or 1) > 1:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 
     def register_handler(self, handler):
         """Register a RequestHandler so that we can later wait for it."""
         task, machine = self.get_ctx_for_ip(handler.client_address[0])
+        self.stats.handler_started(task.id if task else None)
         if not task or not machine:
             return False
         self.analysishandlers[task.id].append(handler)
+        handler.task_id = task.id
+        handler.behavior = self.behaviors.get(task.id)
 
     def get_ctx_for_ip(self, ip):
         """Return state for this IP's task."""
@@ -102,68 +278,451 @@ class Resultserver(SocketServer.ThreadingTCPServer, object):
         if not task or not machine:
             return False
 
-        storagepath = os.path.join(CUCKOO_ROOT, "storage",
-                                   "analyses", str(task.id))
-        return storagepath
+        return task_storage_path(task.id)
 
+    def bind_error(self, e):
+        return CuckooCriticalError("Unable to bind result server on "
+                                   "{0}:{1}: {2}".format(
+                                       self.cfg.resultserver.ip,
+                                       self.cfg.resultserver.port, str(e)))
 
-class Resulthandler(SocketServer.BaseRequestHandler):
-    """Result handler.
 
-    This handler speaks our analysis log network protocol.
+class ThreadedResultserver(SocketServer.ThreadingTCPServer, ResultserverBase):
+    """Result server engine running a thread for each connection."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # Listen backlog, as many analysis machines may connect at once.
+    request_queue_size = 128
+
+    def server_bind(self):
+        self.reuse_port(self.socket)
+        SocketServer.ThreadingTCPServer.server_bind(self)
+
+    def __init__(self, cfg):
+        ResultserverBase.__init__(self, cfg)
+
+        try:
+            server_addr = self.cfg.resultserver.ip, self.cfg.resultserver.port
+            SocketServer.ThreadingTCPServer.__init__(self,
+                                                     server_addr,
+                                                     Resulthandler)
+        except Exception as e:
+            raise self.bind_error(e)
+        else:
+            self.servethread = Thread(target=self.serve_forever)
+            self.servethread.setDaemon(True)
+            self.servethread.start()
+
+
+class EventResultserver(ResultserverBase):
+    """Result server engine running all the connections from a single
+    thread, with an epoll (or poll) event loop.
+    """
+
+    def __init__(self, cfg):
+        ResultserverBase.__init__(self, cfg)
+        self.connections = {}
+        # Connections of the tasks removed by del_task(), to be closed.
+        self.ended = []
+
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.reuse_port(self.socket)
+            self.socket.bind((self.cfg.resultserver.ip,
+                              self.cfg.resultserver.port))
+            self.socket.listen(128)
+            self.socket.setblocking(0)
+        except socket.error as e:
+            raise self.bind_error(e)
+
+        # Written to by other threads to interrupt the poll.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.timeout = 1
+        else:
+            self.poller = select.poll()
+            self.timeout = 1000
+
+        self.poller.register(self.socket.fileno(), select.POLLIN)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+
+        self.servethread = Thread(target=self.serve_forever)
+        self.servethread.setDaemon(True)
+        self.servethread.start()
+
+    def wakeup(self):
+        """Interrupt the event loop."""
+        try:
+            os.write(self.wakeup_w, "x")
+        except OSError:
+            # The pipe is full, the loop is going to wake up anyway.
+            pass
+
+    def serve_forever(self):
+        listener = self.socket.fileno()
+        last_tick = time.time()
+
+        while True:
+            try:
+                events = self.poller.poll(self.timeout)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in events:
+                if fd == listener:
+                    self.accept()
+                elif fd == self.wakeup_r:
+                    try:
+                        while os.read(self.wakeup_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    handler = self.connections.get(fd)
+                    if handler:
+                        handler.handle_read()
+
+            while self.ended:
+                self.ended.pop().close()
+
+            if time.time() - last_tick >= 1:
+                last_tick = time.time()
+                for handler in self.connections.values():
+                    handler.tick()
+
+    def accept(self):
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] == errno.EINTR:
+                    continue
+                log.debug("socket.error: {0}".format(e))
+                return
+
+            request.setblocking(0)
+            handler = EventResulthandler(request, client_address, self)
+            if handler.start():
+                self.connections[request.fileno()] = handler
+                self.poller.register(request.fileno(), select.POLLIN)
+
+    def remove(self, handler):
+        """Stop polling a closed connection."""
+        fd = handler.request.fileno()
+        if self.connections.pop(fd, None):
+            self.poller.unregister(fd)
+
+
+# The task and machine details the worker processes get from add_task() and
+# del_task().
+WorkerTask = namedtuple("WorkerTask", "id")
+WorkerMachine = namedtuple("WorkerMachine", "ip")
+
+
+def run_worker(conn, cfg, engine):
+    """Main function of a Resultserver worker process: runs an engine and
+    serves the requests of the main process.
+    @param conn: pipe connection to the main process.
+    @param cfg: Cuckoo configuration.
+    @param engine: name of the engine.
+    """
+    # Interrupting Cuckoo is handled by the main process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        server = ENGINES[engine](cfg)
+    except CuckooCriticalError as e:
+        conn.send(str(e))
+        return
+    conn.send(None)
+
+    lock = Lock()
+
+    def reply(request_id, result):
+        with lock:
+            conn.send((request_id, result))
+
+    def end_task(request_id, task, machine):
+        reply(request_id, server.end_task(task, machine))
+
+    while True:
+        try:
+            command, request_id, args = conn.recv()
+        except (EOFError, IOError):
+            # The main process is gone.
+            return
+
+        if command == "add":
+            server.add_task(WorkerTask(args[0]), WorkerMachine(args[1]))
+            reply(request_id, None)
+        elif command == "del":
+            # Waits for the handlers of the task, don't hold the others.
+            thread = Thread(target=end_task,
+                            args=(request_id, WorkerTask(args[0]),
+                                  WorkerMachine(args[1])))
+            thread.setDaemon(True)
+            thread.start()
+        elif command == "stats":
+            reply(request_id, server.get_stats())
+        elif command == "stop":
+            return
+
+
+class WorkerRequest(object):
+    """Pending request to a worker process."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.event = Event()
+        self.result = None
+        self.failed = False
+
+
+class ResultserverWorkers(object):
+    """Runs the Resultserver engine in several worker processes, to make
+    use of more than one core. All of them bind the same address with
+    SO_REUSEPORT and the kernel spreads the connections over them. Every
+    task is registered with all the workers, as its connections may be
+    accepted by any of them.
+    """
+
+    def __init__(self, cfg, engine, count):
+        self.lock = Lock()
+        self.requests = {}
+        self.request_ids = itertools.count()
+        self.conns = []
+        self.processes = []
+        self.threads = []
+        self.stopping = False
+
+        for i in xrange(count):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(child_conn, cfg, engine),
+                                              name="Resultserver-%d" % i)
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+
+            # Wait for the worker to be listening.
+            try:
+                error = conn.recv()
+            except (EOFError, IOError):
+                error = "worker process exited"
+            if error:
+                raise CuckooCriticalError("Unable to start the result "
+                                          "server workers: %s" % error)
+
+            thread = Thread(target=self.receive, args=(conn,))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+            self.conns.append(conn)
+
+        log.debug("Started %d Resultserver worker processes", count)
+
+    def receive(self, conn):
+        """Hand the replies of a worker to the pending requests."""
+        while True:
+            try:
+                request_id, result = conn.recv()
+            except (EOFError, IOError):
+                break
+
+            with self.lock:
+                request = self.requests.pop(request_id, None)
+            if request:
+                request.result = result
+                request.event.set()
+
+        if not self.stopping:
+            log.critical("A Resultserver worker process exited.")
+        with self.lock:
+            for request_id, request in self.requests.items():
+                if request.conn is conn:
+                    del self.requests[request_id]
+                    request.failed = True
+                    request.event.set()
+
+    def request(self, command, *args):
+        """Send a request to every worker and wait for all the replies.
+        @param command: request name.
+        @return: list of replies of the workers.
+        """
+        pending = []
+        with self.lock:
+            for conn in self.conns:
+                request_id = next(self.request_ids)
+                request = WorkerRequest(conn)
+                try:
+                    conn.send((command, request_id, args))
+                except (IOError, OSError):
+                    continue
+                self.requests[request_id] = request
+                pending.append(request)
+
+        results = []
+        for request in pending:
+            request.event.wait()
+            if not request.failed:
+                results.append(request.result)
+        return results
+
+    def stop(self, timeout=5):
+        """Stop the worker processes, killing those which don't exit within
+        the timeout.
+        @param timeout: seconds to wait for every worker.
+        """
+        self.stopping = True
+        with self.lock:
+            for conn in self.conns:
+                try:
+                    conn.send(("stop", None, ()))
+                except (IOError, OSError):
+                    pass
+
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                log.warning("Resultserver worker process %d didn't exit, "
+                            "terminating it", process.pid)
+                process.terminate()
+                process.join()
+
+        # Their replies are all in once the workers are gone.
+        for thread in self.threads:
+            thread.join(timeout)
+        for conn in self.conns:
+            conn.close()
+
+        log.debug("Stopped %d Resultserver worker processes",
+                  len(self.processes))
+
+    def add_task(self, task, machine):
+        self.request("add", task.id, machine.ip)
+
+    def del_task(self, task, machine):
+        processes = None
+        for result in self.request("del", task.id, machine.ip):
+            if result is not None:
+                processes = (processes or []) + result
+
+        if processes is not None:
+            write_behavior_summary(task.id, processes)
+
+    def get_stats(self):
+        """@return: statistics snapshot of all the workers together."""
+        def add(total, counters):
+            for key, value in counters.items():
+                if isinstance(value, dict):
+                    add(total.setdefault(key, {}), value)
+                else:
+                    total[key] = total.get(key, 0) + value
+
+        snapshots = self.request("stats")
+        stats = {
+            "time": logtime(datetime.datetime.now()),
+            "uptime": max([snapshot["uptime"] for snapshot in snapshots] or [0]),
+            "workers": len(snapshots),
+            "total": {},
+            "tasks": {},
+        }
+        for snapshot in snapshots:
+            add(stats["total"], snapshot["total"])
+            add(stats["tasks"], snapshot["tasks"])
+
+        return stats
+
+
+class ProtocolHandler(object):
+    """Analysis log network protocol state of a connection, shared by the
+    Resultserver engines. The engines provide fill() to receive more data
+    into the receive buffer.
     """
 
     def setup(self):
+        self.rbuf = ReceiveBuffer()
         self.logfd = None
         self.rawlogfd = None
         self.protocol = None
+        self.protocol_name = None
+        self.task_id = None
+        self.started = time.time()
+        # Bytes received before the protocol was known.
+        self.unaccounted = 0
         self.startbuf = ""
         self.end_request = Event()
         self.done_event = Event()
         self.pid, self.ppid, self.procname = (None, None, None)
+        # Behavior aggregates of the task and of this process, if enabled.
+        self.behavior = None
+        self.process = None
         self.server.register_handler(self)
 
-    def finish(self):
+    def end(self):
+        """Ask the connection to stop, del_task() then waits for done_event."""
+        self.end_request.set()
+
+    def finished(self):
+        """The connection is closed."""
+        self.server.stats.handler_finished(self.task_id,
+                                           time.time() - self.started)
+        if self.unaccounted:
+            self.server.stats.received(self.task_id, "UNKNOWN",
+                                       self.unaccounted)
         self.done_event.set()
 
-    def wait_sock_or_end(self):
-        while True:
-            if self.end_request.isSet():
-                return False
-            rs, ws, xs = select.select([self.request], [], [], 1)
-            if rs:
-                return True
+    def account(self, received):
+        """Count received bytes in the statistics of the protocol."""
+        if self.protocol_name:
+            self.server.stats.received(self.task_id, self.protocol_name,
+                                       received)
+        else:
+            self.unaccounted += received
+
+    def tick(self):
+        """Called about every second, for the protocol handlers which have
+        time based work to do."""
+        if hasattr(self.protocol, "tick"):
+            self.protocol.tick()
 
     def read(self, length):
-        buf = ""
-        while len(buf) < length:
-            if not self.wait_sock_or_end():
-                raise Disconnect()
-            tmp = self.request.recv(length-len(buf))
-            if not tmp:
-                raise Disconnect()
-            buf += tmp
+        rbuf = self.rbuf
+        while rbuf.end - rbuf.start < length:
+            self.fill()
+        return rbuf.read(length)
+
+    def read_any(self):
+        if not len(self.rbuf):
+            self.fill()
+        return self.rbuf.read(len(self.rbuf))
 
+    def read_newline(self):
+        offset = self.rbuf.find("\n")
+        while offset < 0:
+            self.fill()
+            offset = self.rbuf.find("\n")
+        return self.read(offset + 1)
+
+    def tee(self, buf):
+        """Keep a copy of the raw behavior log data."""
         if isinstance(self.protocol, (NetlogParser, BsonParser)):
             if self.rawlogfd:
                 self.rawlogfd.write(buf)
             else:
-                self.startbuf += buf
-        return buf
-
-    def read_any(self):
-        if not self.wait_sock_or_end():
-            raise Disconnect()
-        tmp = self.request.recv(BUFSIZE)
-        if not tmp:
-            raise Disconnect()
-        return tmp
-
-    def read_newline(self):
-        buf = ""
-        while not "\n" in buf:
-            buf += self.read(1)
-        return buf
+                self.startbuf += str(buf)
 
     def negotiate_protocol(self):
         # read until newline
@@ -171,47 +730,25 @@ class Resulthandler(SocketServer.BaseRequestHandler):
 
         if "NETLOG" in buf:
             self.protocol = NetlogParser(self)
+            self.protocol_name = "NETLOG"
         elif "BSON" in buf:
             self.protocol = BsonParser(self)
+            self.protocol_name = "BSON"
         elif "FILE" in buf:
             self.protocol = FileUpload(self)
+            self.protocol_name = "FILE"
         elif "LOG" in buf:
             self.protocol = LogHandler(self)
+            self.protocol_name = "LOG"
         else:
             raise CuckooOperationalError("Netlog failure, unknown "
                                          "protocol requested.")
 
-    def handle(self):
-        ip, port = self.client_address
-        self.connect_time = datetime.datetime.now()
-        log.debug("New connection from: {0}:{1}".format(ip, port))
-
-        self.storagepath = self.server.build_storage_path(ip)
-        if not self.storagepath:
-            return
-
-        # create all missing folders for this analysis
-        self.create_folders()
-
-        try:
-            # initialize the protocol handler class for this connection
-            self.negotiate_protocol()
-
-            while True:
-                r = self.protocol.read_next_message()
-                if not r:
-                    break
-        except CuckooResultError as e:
-            log.warning("Resultserver connection stopping because of "
-                        "CuckooResultError: %s.", str(e))
-        except Disconnect:
-            pass
-        except socket.error, e:
-            log.debug("socket.error: {0}".format(e))
-        except:
-            log.exception("FIXME - exception in resultserver connection %s",
-                          str(self.client_address))
+        self.account(self.unaccounted)
+        self.unaccounted = 0
 
+    def close_logs(self):
+        """Close the protocol handler and the log files."""
         try:
             self.protocol.close()
         except:
@@ -221,7 +758,6 @@ class Resulthandler(SocketServer.BaseRequestHandler):
             self.logfd.close()
         if self.rawlogfd:
             self.rawlogfd.close()
-        log.debug("Connection closed: {0}:{1}".format(ip, port))
 
     def log_process(self, ctx, timestring, pid, ppid, modulepath, procname):
         if not self.pid is None:
@@ -241,14 +777,25 @@ class Resulthandler(SocketServer.BaseRequestHandler):
 
         # Raw Bson or Netlog extension
         ext = EXTENSIONS.get(type(self.protocol), ".raw")
-        self.rawlogfd = open(os.path.join(self.storagepath, "logs",
-                                          str(pid) + ext), "wb")
+        path = os.path.join(self.storagepath, "logs", str(pid) + ext)
+        if self.server.cfg.resultserver.compress_logs:
+            self.rawlogfd = BlockGzipFile(path + ".gz")
+        else:
+            self.rawlogfd = open(path, "wb")
         self.rawlogfd.write(self.startbuf)
 
         self.pid, self.ppid, self.procname = pid, ppid, procname
 
+        if self.behavior:
+            if isinstance(timestring, datetime.datetime):
+                timestring = logtime(timestring)
+            self.process = self.behavior.add_process(timestring, pid, ppid,
+                                                     modulepath, procname)
+
     def log_thread(self, context, pid):
         log.debug("New thread (tid={0}, pid={1})".format(context[3], pid))
+        if self.process:
+            self.process.add_thread(context[3])
 
     def log_call(self, context, apiname, modulename, arguments):
         if not self.rawlogfd:
@@ -259,18 +806,21 @@ class Resulthandler(SocketServer.BaseRequestHandler):
 
         #log.debug("log_call> tid:{0} apiname:{1}".format(tid, apiname))
 
-        current_time = self.connect_time + datetime.timedelta(0, 0,
-                                                              timediff*1000)
-        timestring = logtime(current_time)
+        if self.logfd:
+            current_time = self.connect_time + \
+                datetime.timedelta(0, 0, timediff*1000)
+            timestring = logtime(current_time)
 
-        argumentstrings = ["{0}->{1}".format(argname, repr(str(r))[1:-1])
-                           for argname, r in arguments]
+            argumentstrings = ["{0}->{1}".format(argname, repr(str(r))[1:-1])
+                               for argname, r in arguments]
 
-        if self.logfd:
             print >>self.logfd, ",".join("\"{0}\"".format(i) for i in [
                 timestring, self.pid, self.procname, tid, self.ppid,
                 modulename, apiname, status, returnval] + argumentstrings)
 
+        if self.process:
+            self.process.add_call(tid, apiname, arguments)
+
     def log_error(self, emsg):
         log.warning("Resultserver error condition on connection %s "
                     "(pid %s procname %s): %s", str(self.client_address),
@@ -287,14 +837,207 @@ class Resulthandler(SocketServer.BaseRequestHandler):
                 return False
 
 
+class Resulthandler(SocketServer.BaseRequestHandler, ProtocolHandler):
+    """Result handler.
+
+    This handler speaks our analysis log network protocol.
+    """
+
+    def setup(self):
+        ProtocolHandler.setup(self)
+        # Wake up every second to check whether del_task() ended us.
+        self.request.settimeout(1)
+
+    def finish(self):
+        self.finished()
+
+    def fill(self):
+        while True:
+            if self.end_request.isSet():
+                raise Disconnect()
+            try:
+                received = self.rbuf.fill(self.request)
+            except socket.timeout:
+                self.tick()
+                continue
+            if not received:
+                raise Disconnect()
+            self.account(received)
+            return
+
+    def read(self, length):
+        buf = ProtocolHandler.read(self, length)
+        self.tee(buf)
+        return buf
+
+    def handle(self):
+        ip, port = self.client_address
+        self.connect_time = datetime.datetime.now()
+        log.debug("New connection from: {0}:{1}".format(ip, port))
+
+        self.storagepath = self.server.build_storage_path(ip)
+        if not self.storagepath:
+            return
+
+        # create all missing folders for this analysis
+        self.create_folders()
+
+        try:
+            # initialize the protocol handler class for this connection
+            self.negotiate_protocol()
+
+            while True:
+                r = self.protocol.read_next_message()
+                if not r:
+                    break
+        except CuckooResultError as e:
+            log.warning("Resultserver connection stopping because of "
+                        "CuckooResultError: %s.", str(e))
+        except Disconnect:
+            pass
+        except socket.error, e:
+            log.debug("socket.error: {0}".format(e))
+        except:
+            log.exception("FIXME - exception in resultserver connection %s",
+                          str(self.client_address))
+
+        self.close_logs()
+        log.debug("Connection closed: {0}:{1}".format(ip, port))
+
+
+class EventResulthandler(ProtocolHandler):
+    """Result handler for the event loop engine.
+
+    Received data is buffered and handed to the protocol handler one
+    message at a time. The reads raise NeedMoreData when the buffer doesn't
+    hold the whole message yet, in which case the message is parsed again
+    from its beginning once more data has arrived.
+    """
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.closed = False
+
+    def start(self):
+        """Set up the connection.
+        @return: whether the connection belongs to a known task.
+        """
+        ip, port = self.client_address
+        self.connect_time = datetime.datetime.now()
+        log.debug("New connection from: {0}:{1}".format(ip, port))
+
+        self.setup()
+
+        self.storagepath = self.server.build_storage_path(ip)
+        if not self.storagepath:
+            self.request.close()
+            self.finished()
+            return False
+
+        # create all missing folders for this analysis
+        self.create_folders()
+        return True
+
+    def end(self):
+        ProtocolHandler.end(self)
+        self.server.ended.append(self)
+        self.server.wakeup()
+
+    def fill(self):
+        # Only the event loop receives data.
+        raise NeedMoreData()
+
+    def handle_read(self):
+        try:
+            received = self.rbuf.fill(self.request)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            log.debug("socket.error: {0}".format(e))
+            self.close()
+            return
+
+        if not received:
+            self.close()
+            return
+        self.account(received)
+
+        try:
+            self.handle_messages()
+        except NeedMoreData:
+            pass
+        except CuckooResultError as e:
+            log.warning("Resultserver connection stopping because of "
+                        "CuckooResultError: %s.", str(e))
+            self.close()
+        except Disconnect:
+            self.close()
+        except:
+            log.exception("FIXME - exception in resultserver connection %s",
+                          str(self.client_address))
+            self.close()
+
+    def handle_messages(self):
+        """Handle all the complete messages in the buffer."""
+        if not self.protocol:
+            # initialize the protocol handler class for this connection
+            start = self.rbuf.start
+            try:
+                self.negotiate_protocol()
+            except NeedMoreData:
+                self.rbuf.start = start
+                raise
+
+        while not self.closed:
+            start = self.rbuf.start
+            try:
+                r = self.protocol.read_next_message()
+            except NeedMoreData:
+                self.rbuf.start = start
+                raise
+
+            self.tee(self.rbuf.slice(start, self.rbuf.start))
+            if not r:
+                self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.close_logs()
+        self.server.remove(self)
+        self.request.close()
+        self.finished()
+
+        ip, port = self.client_address
+        log.debug("Connection closed: {0}:{1}".format(ip, port))
+
+
 class FileUpload(object):
+    """Receives a file from the analysis machine.
+
+    The file is hashed while being received and its hashes are recorded in
+    the uploads manifest of the analysis. Dropped files already known by
+    their sha256 are replaced by a hard link to the copy in storage/files.
+    """
+
     def __init__(self, handler):
         self.handler = handler
         self.upload_max_size = \
             self.handler.server.cfg.resultserver.upload_max_size
         self.storagepath = self.handler.storagepath
+        self.fd = None
+        self.path = None
+        self.truncated = False
+        self.hasher = Hasher()
 
     def read_next_message(self):
+        if self.fd:
+            return self.read_chunk()
+
         # read until newline for file path
         # e.g. shots/0001.jpg or files/9498687557/libcurl-4.dll.bin
 
@@ -313,42 +1056,363 @@ class FileUpload(object):
                 log.error("Unable to create folder %s" % dir_part)
                 return False
 
-        file_path = os.path.join(self.storagepath, buf.strip())
+        self.path = buf.strip()
+        file_path = os.path.join(self.storagepath, self.path)
+
+        # The file may be a hard link into the files store, never write
+        # through it.
+        if os.path.lexists(file_path):
+            os.unlink(file_path)
 
-        fd = open(file_path, "wb")
+        self.fd = open(file_path, "wb")
+        return True
+
+    def read_chunk(self):
         chunk = self.handler.read_any()
-        while chunk:
-            fd.write(chunk)
+        self.fd.write(chunk)
+        self.hasher.update(chunk)
 
-            if fd.tell() >= self.upload_max_size:
-                fd.write("... (truncated)")
-                break
+        if self.fd.tell() >= self.upload_max_size:
+            self.fd.write("... (truncated)")
+            self.hasher.update("... (truncated)")
+            self.truncated = True
+            return False
+
+        return True
 
-            chunk = self.handler.read_any()
+    def close(self):
+        if not self.fd:
+            return
 
-        log.debug("Uploaded file length: {0}".format(fd.tell()))
-        fd.close()
+        size = self.fd.tell()
+        log.debug("Uploaded file length: {0}".format(size))
+        self.fd.close()
+
+        entry = self.hasher.hashes()
+        entry["path"] = self.path
+        entry["size"] = size
+
+        # Screenshots, memory dumps and the like are hardly ever the same
+        # twice, only the dropped files are worth deduplicating.
+        if self.path.startswith("files/"):
+            self.store(entry["sha256"])
+        self.handler.server.stats.file_uploaded(self.handler.task_id, size,
+                                                self.truncated)
+
+        # A single write in append mode, so that concurrent uploads don't
+        # interleave their lines.
+        fd = os.open(os.path.join(self.storagepath, UPLOADS_MANIFEST),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, json.dumps(entry) + "\n")
+        finally:
+            os.close(fd)
+
+    def store(self, sha256):
+        """Deduplicate the file through the content addressed files store.
+        @param sha256: sha256 of the file.
+        """
+        file_path = os.path.join(self.storagepath, self.path)
+        store_path = os.path.join(CUCKOO_ROOT, "storage", "files", sha256)
+
+        try:
+            if not os.path.exists(os.path.dirname(store_path)):
+                create_folder(folder=os.path.dirname(store_path))
+
+            try:
+                os.link(file_path, store_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                # Already known, keep the stored copy only.
+                tmp_path = file_path + ".tmp"
+                os.link(store_path, tmp_path)
+                os.rename(tmp_path, file_path)
+        except (OSError, CuckooOperationalError) as e:
+            log.debug("Unable to store uploaded file %s: %s", self.path, e)
 
 
 class LogHandler(object):
+    """Receives the live analysis.log of the analyzer.
+
+    Lines are buffered and written once enough of them accumulated or the
+    oldest one waited long enough, and the log of a task can be capped.
+    """
+
     def __init__(self, handler):
         self.handler = handler
         self.logpath = os.path.join(handler.storagepath, "analysis.log")
         self.fd = self._open()
+
+        cfg = handler.server.cfg.resultserver
+        self.flush_size = cfg.log_flush_size or 0
+        self.flush_interval = cfg.log_flush_interval or 0
+        self.max_size = cfg.log_max_size or 0
+
+        self.buf = []
+        self.buffered = 0
+        self.buffered_since = None
+        # The analyzer may have reconnected, account for the lines of the
+        # previous connections of this task too.
+        self.size = os.path.getsize(self.logpath)
         log.debug("LogHandler for live analysis.log initialized.")
 
     def read_next_message(self):
         buf = self.handler.read_newline()
         if not buf:
             return False
-        self.fd.write(buf)
-        self.fd.flush()
+
+        if self.max_size and self.size + len(buf) > self.max_size:
+            if self.size < self.max_size:
+                log.warning("Analysis log of %s exceeds %d bytes, "
+                            "truncating.", self.handler.storagepath,
+                            self.max_size)
+                self.write("... (truncated)\n")
+                self.size = self.max_size
+                self.flush()
+            return True
+
+        self.write(buf)
+        if self.buffered >= self.flush_size:
+            self.flush()
+        else:
+            self.tick()
         return True
 
+    def write(self, buf):
+        if not self.buf:
+            self.buffered_since = time.time()
+        self.buf.append(buf)
+        self.buffered += len(buf)
+        self.size += len(buf)
+
+    def tick(self):
+        """Flush the lines which waited long enough."""
+        if self.buf and time.time() - self.buffered_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.fd.write("".join(self.buf))
+            self.fd.flush()
+            self.buf = []
+            self.buffered = 0
+
     def close(self):
+        self.flush()
         self.fd.close()
 
     def _open(self):
         if os.path.exists(self.logpath):
             return open(self.logpath, "ab")
         return open(self.logpath, "wb")
+
+
+class ProcessAggregator(object):
+    """Behavior aggregates of a process, updated with every API call."""
+
+    def __init__(self, timestring, pid, ppid, modulepath, procname):
+        self.first_seen = timestring
+        self.pid = pid
+        self.ppid = ppid
+        self.modulepath = modulepath
+        self.procname = procname
+        self.threads = set()
+        self.api_calls = {}
+        self.summary = {"files": set(), "keys": set(), "mutexes": set()}
+
+    def add_thread(self, tid):
+        self.threads.add(tid)
+
+    def add_call(self, tid, apiname, arguments):
+        self.threads.add(tid)
+        self.api_calls[apiname] = self.api_calls.get(apiname, 0) + 1
+
+        for argname, value in arguments:
+            category = SUMMARY_ARGUMENTS.get(argname)
+            if not category and argname == "ObjectAttributes" and \
+                    "Key" in apiname:
+                category = "keys"
+            if category and isinstance(value, basestring) and value:
+                self.summary[category].add(value)
+
+    def to_dict(self):
+        return {
+            "process_id": self.pid,
+            "parent_id": self.ppid,
+            "process_name": self.procname,
+            "module_path": self.modulepath,
+            "first_seen": self.first_seen,
+            "threads": sorted(self.threads),
+            "api_calls": self.api_calls,
+            "summary": dict((category, sorted(values))
+                            for category, values in self.summary.items()),
+        }
+
+
+class BehaviorAggregator(object):
+    """Behavior aggregates of a task: the processes which reported to the
+    Resultserver, with the API calls they made and the files, registry keys
+    and mutexes they touched. Written as a summary file by del_task(), so
+    that the processing stage doesn't have to parse the raw logs for these.
+    """
+
+    def __init__(self):
+        self.processes = []
+        self.lock = Lock()
+
+    def add_process(self, timestring, pid, ppid, modulepath, procname):
+        process = ProcessAggregator(timestring, pid, ppid, modulepath,
+                                    procname)
+        with self.lock:
+            self.processes.append(process)
+        return process
+
+    def processes_summary(self):
+        """@return: list of process summary dicts."""
+        with self.lock:
+            return [process.to_dict() for process in self.processes]
+
+
+def task_storage_path(task_id):
+    return os.path.join(CUCKOO_ROOT, "storage", "analyses", str(task_id))
+
+
+def write_behavior_summary(task_id, processes):
+    """Write the behavior summary file of a task.
+    @param task_id: task ID.
+    @param processes: list of process summary dicts.
+    """
+    summary = {"files": set(), "keys": set(), "mutexes": set()}
+    for process in processes:
+        for category, values in process["summary"].items():
+            summary[category].update(values)
+
+    path = os.path.join(task_storage_path(task_id), BEHAVIOR_SUMMARY)
+    try:
+        with open(path, "wb") as f:
+            json.dump({
+                "processes": processes,
+                "summary": dict((category, sorted(values))
+                                for category, values in summary.items()),
+            }, f, separators=(",", ":"))
+    except (IOError, OSError) as e:
+        log.error("Unable to write the behavior summary of task "
+                  "#%d: %s", task_id, e)
+
+
+class ResultserverStats(object):
+    """Registry of the Resultserver counters, globally and for every task
+    being analyzed.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.total = self._counters()
+        self.total["del_task_calls"] = 0
+        self.tasks = {}
+        # Byte counts of the previous snapshot, for the rates.
+        self.last_time = self.started
+        self.last_bytes = {}
+
+    def _counters(self):
+        return {
+            "handlers_active": 0,
+            "handlers": 0,
+            "handlers_lifetime": 0.0,
+            "bytes": {},
+            "files_uploaded": 0,
+            "files_bytes": 0,
+            "files_truncated": 0,
+            "del_task_wait": 0.0,
+        }
+
+    def _update(self, task_id, update):
+        """Apply an update to the global and the task counters."""
+        with self.lock:
+            update(self.total)
+            task = self.tasks.get(task_id)
+            if task:
+                update(task)
+
+    def add_task(self, task_id):
+        with self.lock:
+            self.tasks[task_id] = self._counters()
+            self.tasks[task_id]["added"] = time.time()
+
+    def del_task(self, task_id, waited):
+        """@param waited: seconds del_task() waited for the handlers."""
+        def update(counters):
+            counters["del_task_wait"] += waited
+        self._update(task_id, update)
+
+        with self.lock:
+            self.total["del_task_calls"] += 1
+            task = self.tasks.pop(task_id, None)
+
+        if task:
+            log.debug("Resultserver statistics of task #%s: %s", task_id,
+                      json.dumps(task))
+
+    def handler_started(self, task_id):
+        def update(counters):
+            counters["handlers_active"] += 1
+            counters["handlers"] += 1
+        self._update(task_id, update)
+
+    def handler_finished(self, task_id, lifetime):
+        def update(counters):
+            counters["handlers_active"] -= 1
+            counters["handlers_lifetime"] += lifetime
+        self._update(task_id, update)
+
+    def received(self, task_id, protocol, length):
+        def update(counters):
+            counters["bytes"][protocol] = \
+                counters["bytes"].get(protocol, 0) + length
+        self._update(task_id, update)
+
+    def file_uploaded(self, task_id, size, truncated):
+        def update(counters):
+            counters["files_uploaded"] += 1
+            counters["files_bytes"] += size
+            if truncated:
+                counters["files_truncated"] += 1
+        self._update(task_id, update)
+
+    def snapshot(self):
+        """Copy the counters. The global bytes per second are the rates
+        since the previous snapshot, those of a task since it was added.
+        @return: statistics dict.
+        """
+        now = time.time()
+        with self.lock:
+            total = json.loads(json.dumps(self.total))
+            tasks = json.loads(json.dumps(self.tasks))
+            last_time, self.last_time = self.last_time, now
+            last_bytes, self.last_bytes = self.last_bytes, total["bytes"]
+
+        elapsed = max(now - last_time, 0.001)
+        total["bytes_per_sec"] = dict(
+            (protocol, (length - last_bytes.get(protocol, 0)) / elapsed)
+            for protocol, length in total["bytes"].items())
+
+        for task in tasks.values():
+            elapsed = max(now - task.pop("added"), 0.001)
+            task["bytes_per_sec"] = dict(
+                (protocol, length / elapsed)
+                for protocol, length in task["bytes"].items())
+
+        return {
+            "time": logtime(datetime.datetime.now()),
+            "uptime": now - self.started,
+            "total": total,
+            "tasks": tasks,
+        }
+
+
+ENGINES = {
+    "threads": ThreadedResultserver,
+    "events": EventResultserver,
+}
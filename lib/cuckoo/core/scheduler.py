@@ -5,8 +5,10 @@
 import os
 import time
 import shutil
+import signal
 import logging
 import Queue
+import multiprocessing
 from threading import Thread, Lock
 
 from lib.cuckoo.common.config import Config
@@ -17,7 +19,8 @@ from lib.cuckoo.common.exceptions import CuckooCriticalError
 from lib.cuckoo.common.objects import File
 from lib.cuckoo.common.utils import create_folder
 from lib.cuckoo.core.database import Database, TASK_COMPLETED, TASK_REPORTED
-from lib.cuckoo.core.guest import GuestManager
+from lib.cuckoo.core.database import TASK_FAILED_PROCESSING, lease_owner_alive
+from lib.cuckoo.core.database import lease_owner
 from lib.cuckoo.core.plugins import list_plugins, RunAuxiliary, RunProcessing
 from lib.cuckoo.core.plugins import RunSignatures, RunReporting
 from lib.cuckoo.core.resultserver import Resultserver
@@ -27,8 +30,8 @@ log = logging.getLogger(__name__)
 machinery = None
 machine_lock = Lock()
 
-total_analysis_count = 0
-active_analysis_count = 0
+# Set when processing and reporting run in separate processes.
+processing_pool = None
 
 
 class CuckooDeadMachine(Exception):
@@ -40,7 +43,7 @@ class CuckooDeadMachine(Exception):
     pass
 
 
-class AnalysisManager(Thread):
+class AnalysisManager(object):
     """Analysis Manager.
 
     This class handles the full analysis process for a given task. It takes
@@ -51,9 +54,6 @@ class AnalysisManager(Thread):
 
     def __init__(self, task, error_queue):
         """@param task: task object containing the details for the analysis."""
-        Thread.__init__(self)
-        Thread.daemon = True
-
         self.task = task
         self.errors = error_queue
         self.cfg = Config()
@@ -329,7 +329,6 @@ class AnalysisManager(Thread):
         '''No signatures in lite... yet.'''
         #RunSignatures(results=results).run()
 
-        results[""]
         RunReporting(task_id=self.task.id, results=results).run()
 
         # If the target is a file and the user enabled the option,
@@ -362,9 +361,7 @@ class AnalysisManager(Thread):
         return True
 
     def run(self):
-        """Run manager thread."""
-        global active_analysis_count
-        active_analysis_count += 1
+        """Run the full analysis procedure."""
         try:
             while True:
                 try:
@@ -379,7 +376,14 @@ class AnalysisManager(Thread):
             log.debug("Released database task #%d with status %s",
                       self.task.id, success)
 
-            if self.cfg.cuckoo.process_results:
+            if not self.cfg.cuckoo.process_results:
+                # Left for the "utils/process.py auto" workers to claim.
+                Database().release_lease(self.task.id)
+            elif processing_pool:
+                # Leave the CPU intensive work to the processing pool,
+                # this analysis slot can be used for the next task.
+                processing_pool.submit(self.task, self.storage, self.binary)
+            else:
                 self.process_results()
                 Database().set_status(self.task.id, TASK_REPORTED)
 
@@ -387,7 +391,183 @@ class AnalysisManager(Thread):
         except:
             log.exception("Failure in AnalysisManager.run")
 
-        active_analysis_count -= 1
+class AnalysisPool(object):
+    """Analysis workers pool.
+
+    A fixed amount of worker threads is started once and reused to run the
+    AnalysisManager of every dispatched task. Every task occupies a slot from
+    the moment it's submitted until its analysis procedure is over, so the
+    scheduler can stop fetching tasks while all of them are busy.
+    """
+
+    def __init__(self, size, error_queue):
+        """@param size: amount of worker threads.
+        @param error_queue: queue used to transmit exceptions.
+        """
+        self.size = size
+        self.errors = error_queue
+        self.tasks = Queue.Queue()
+        self.lock = Lock()
+        self._busy = 0
+        self._total = 0
+
+        for index in xrange(size):
+            worker = Thread(target=self._worker,
+                            name="AnalysisWorker-%d" % index)
+            worker.daemon = True
+            worker.start()
+
+    def busy(self):
+        """@return: amount of slots running an analysis."""
+        with self.lock:
+            return self._busy
+
+    def available(self):
+        """@return: amount of free slots."""
+        with self.lock:
+            return self.size - self._busy
+
+    def total(self):
+        """@return: amount of analyses submitted since startup."""
+        with self.lock:
+            return self._total
+
+    def submit(self, task):
+        """Hand a task over to a free worker.
+        @param task: task object.
+        @return: False if all the slots are busy.
+        """
+        with self.lock:
+            if self._busy >= self.size:
+                return False
+
+            self._busy += 1
+            self._total += 1
+
+        self.tasks.put(task)
+        return True
+
+    def _worker(self):
+        """Worker thread loop."""
+        while True:
+            task = self.tasks.get()
+
+            # Nothing may take the worker down, or its slot would be lost
+            # while still counted as available.
+            try:
+                AnalysisManager(task, self.errors).run()
+            except:
+                log.exception("Task #%d: failure in the analysis worker",
+                              task.id)
+
+            with self.lock:
+                self._busy -= 1
+
+            # Wake up the scheduler, a slot just became available.
+            try:
+                Database().notify()
+            except:
+                log.exception("Unable to notify the scheduler")
+
+def _process_task(task, storage, binary):
+    """Process and report an analysis, run inside a processing process.
+    @param task: task object.
+    @param storage: analysis folder path.
+    @param binary: path to the stored copy of the analyzed file.
+    """
+    # A Ctrl-C on the terminal reaches the whole process group, leave it to
+    # the scheduler, which waits for the running tasks to be processed.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The fork might have happened while another thread was holding one of
+    # the logging locks, make sure we don't inherit it locked.
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+    manager = AnalysisManager(task, None)
+    manager.storage = storage
+    manager.binary = binary
+    manager.process_results()
+    Database().set_status(task.id, TASK_REPORTED)
+
+class ProcessingPool(object):
+    """Processing and reporting pool.
+
+    Processing and reporting of every completed analysis is run in a
+    dedicated child process, so that it can use all the available cores and
+    a crash while processing a bad sample doesn't take down the scheduler.
+    At most size processes are running at the same time, further tasks are
+    queued.
+    """
+
+    def __init__(self, size):
+        """@param size: maximum amount of processing processes."""
+        self.size = size
+        self.tasks = Queue.Queue()
+        self.lock = Lock()
+        self._active = 0
+
+        for index in xrange(size):
+            worker = Thread(target=self._worker,
+                            name="ProcessingWorker-%d" % index)
+            worker.daemon = True
+            worker.start()
+
+    def depth(self):
+        """@return: amount of tasks waiting to be processed."""
+        return self.tasks.qsize()
+
+    def active(self):
+        """@return: amount of tasks currently being processed."""
+        with self.lock:
+            return self._active
+
+    def submit(self, task, storage, binary):
+        """Queue a completed analysis for processing.
+        @param task: task object.
+        @param storage: analysis folder path.
+        @param binary: path to the stored copy of the analyzed file.
+        """
+        self.tasks.put((task, storage, binary))
+        log.debug("Task #%d: queued for processing (queue depth %d)",
+                  task.id, self.depth())
+
+    def stop(self):
+        """Wait for the queued and running tasks to be processed."""
+        if self.tasks.unfinished_tasks:
+            log.info("Waiting for %d analyses to be processed...",
+                     self.tasks.unfinished_tasks)
+
+        # Not Queue.join(), a plain wait can't be interrupted.
+        while self.tasks.unfinished_tasks:
+            time.sleep(0.5)
+
+    def _worker(self):
+        """Worker thread loop, supervises one processing process at a time."""
+        while True:
+            task, storage, binary = self.tasks.get()
+
+            with self.lock:
+                self._active += 1
+
+            try:
+                process = multiprocessing.Process(target=_process_task,
+                                                  args=(task, storage, binary),
+                                                  name="Processing-%d" % task.id)
+                process.start()
+                process.join()
+
+                if process.exitcode != 0:
+                    log.error("Task #%d: processing failed (exit code %s)",
+                              task.id, process.exitcode)
+                    Database().set_status(task.id, TASK_FAILED_PROCESSING)
+            except:
+                log.exception("Task #%d: unable to run processing", task.id)
+                Database().set_status(task.id, TASK_FAILED_PROCESSING)
+            finally:
+                with self.lock:
+                    self._active -= 1
+                self.tasks.task_done()
 
 class Scheduler:
     """Tasks Scheduler.
@@ -400,10 +580,23 @@ class Scheduler:
     assigned analysis machine.
     """
 
+    # Maximum amount of seconds to wait for a queue notification before
+    # checking the database for new tasks anyway.
+    poll_interval = 1
+    # Lease duration of the fetched tasks. Leases are renewed while the
+    # scheduler is alive, if it dies its tasks are put back in the queue
+    # once their leases expire.
+    lease_seconds = 300
+    # Amount of completed tasks loaded at a time when queueing them again
+    # for processing.
+    requeue_page = 100
+
     def __init__(self):
         self.running = True
         self.cfg = Config()
         self.db = Database()
+        # Identifies the tasks leased by this scheduler in a shared database.
+        self.owner = lease_owner()
 
     def initialize(self):
         """Initialize the machine manager."""
@@ -447,12 +640,82 @@ class Scheduler:
     def stop(self):
         """Stop scheduler."""
         self.running = False
+        # Don't leave completed analyses unprocessed.
+        if processing_pool:
+            processing_pool.stop()
         # Shutdown machine manager (used to kill machines that still alive).
-        machinery.shutdown()
+        if machinery:
+            machinery.shutdown()
+        Resultserver().stop()
+
+    def requeue_completed(self):
+        """Queue for processing the completed analyses left unprocessed by
+        a scheduler which went away."""
+        last_id = 0
+        while True:
+            # Oldest first, as they would have been.
+            tasks = self.db.list_tasks(status=TASK_COMPLETED, sample=True,
+                                       before_id=last_id,
+                                       limit=self.requeue_page)
+            if not tasks:
+                break
+
+            for task in reversed(tasks):
+                last_id = task.id
+
+                if lease_owner_alive(task.lease_owner):
+                    continue
+
+                # Another scheduler starting at the same time might be there
+                # first.
+                if not self.db.take_over_lease(task.id, task.lease_owner,
+                                               self.owner):
+                    continue
+
+                storage = os.path.join(CUCKOO_ROOT, "storage", "analyses",
+                                       str(task.id))
+                if task.sample:
+                    binary = os.path.join(CUCKOO_ROOT, "storage", "binaries",
+                                          task.sample.sha256)
+                else:
+                    binary = ""
+
+                log.info("Task #%d: queued again for processing", task.id)
+                processing_pool.submit(task, storage, binary)
+
+    def dispatch(self, maxcount=0):
+        """Lease and submit as many pending tasks as there are free analysis
+        workers, in a single pass.
+        @param maxcount: maximum amount of analyses to run, 0 for no limit.
+        """
+        while self.running:
+            # Exits if max_analysis_count is defined in config file and
+            # is reached.
+            if maxcount and self.pool.total() >= maxcount:
+                if self.pool.busy() <= 0:
+                    self.stop()
+                break
+
+            # Don't fetch tasks we wouldn't be able to run right away,
+            # leave them in the queue until a worker becomes free.
+            slots = self.pool.available()
+            if maxcount:
+                slots = min(slots, maxcount - self.pool.total())
+            if slots <= 0:
+                break
+
+            # Lease as many pending analysis tasks as we can run.
+            tasks = self.db.fetch_batch(slots, self.owner,
+                                        self.lease_seconds)
+            if not tasks:
+                break
+
+            for task in tasks:
+                log.debug("Processing task #%s", task.id)
+                self.pool.submit(task)
 
     def start(self):
         """Start scheduler."""
-        global total_analysis_count
         self.initialize()
 
         log.info("Waiting for analysis tasks...")
@@ -462,9 +725,38 @@ class Scheduler:
 
         maxcount = self.cfg.cuckoo.max_analysis_count
 
+        # Start the processing pool, if processing has to be run separately
+        # from the analyses.
+        global processing_pool
+        if self.cfg.cuckoo.process_results and self.cfg.processing.pipeline:
+            size = self.cfg.processing.processes or multiprocessing.cpu_count()
+            processing_pool = ProcessingPool(size)
+            log.info("Started processing pool with %d processes", size)
+            self.requeue_completed()
+
+        # Start the workers which are going to run the analyses.
+        workers = self.cfg.cuckoo.analysis_workers or 4
+        self.pool = AnalysisPool(workers, errors)
+        log.info("Started %d analysis workers", workers)
+
+        last_renewal = 0
+
         # This loop runs forever.
         while self.running:
-            time.sleep(1)
+            # Sleep until a new task gets committed or an analysis finishes.
+            # Tasks submitted from other processes (e.g. the REST API or the
+            # submit utility) can't notify us, so fall back to polling.
+            self.db.wait_for_tasks(timeout=self.poll_interval)
+
+            # Keep our leases alive and take back the tasks leased by
+            # schedulers which went away.
+            if time.time() - last_renewal >= self.lease_seconds / 3:
+                self.db.renew_leases(self.owner, self.lease_seconds)
+                released = self.db.release_expired_leases()
+                if released:
+                    log.warning("Put back %d tasks with an expired lease "
+                                "in the queue", released)
+                last_renewal = time.time()
 
             # If not enough free diskspace is available, then we print an
             # error message and wait another round (this check is ignored
@@ -492,23 +784,7 @@ class Scheduler:
             #if machinery.availables() == 0:
             #    continue
 
-            # Exits if max_analysis_count is defined in config file and
-            # is reached.
-            if maxcount and total_analysis_count >= maxcount:
-                if active_analysis_count <= 0:
-                    self.stop()
-            else:
-                # Fetch a pending analysis task.
-                task = self.db.fetch()
-
-                if task:
-                    log.debug("Processing task #%s", task.id)
-                    total_analysis_count += 1
-
-                    # Initialize the analysis manager.
-                    analysis = AnalysisManager(task, errors)
-                    # Start.
-                    analysis.start()
+            self.dispatch(maxcount)
 
             # Deal with errors.
             try:
@@ -23,6 +23,7 @@ from lib.cuckoo.common.exceptions import CuckooStartupError
 from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.utils import create_folders
 from lib.cuckoo.core.database import Database, TASK_RUNNING
+from lib.cuckoo.core.database import lease_owner_alive
 from lib.cuckoo.core.plugins import import_plugin, import_package, list_plugins
 
 log = logging.getLogger()
@@ -139,9 +140,21 @@ def init_tasks():
     if cfg.cuckoo.reschedule:
         log.debug("Checking for locked tasks...")
 
-        tasks = db.list_tasks(status=TASK_RUNNING)
+        # The tasks of schedulers which stopped renewing their leases are
+        # put back in the queue as they are.
+        released = db.release_expired_leases()
+        if released:
+            log.info("Put back %d tasks with an expired lease in the queue",
+                     released)
+
+        tasks = db.list_tasks(status=TASK_RUNNING) or []
 
         for task in tasks:
+            # Leave alone the tasks being run by the other schedulers
+            # sharing the database.
+            if lease_owner_alive(task.lease_owner):
+                continue
+
             db.reschedule(task.id)
             log.info("Rescheduled task with ID {0} and "
                      "target {1}".format(task.id, task.target))
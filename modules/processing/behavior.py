@@ -0,0 +1,61 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import json
+
+from lib.cuckoo.common.abstracts import Processing
+from lib.cuckoo.common.exceptions import CuckooProcessingError
+from lib.cuckoo.common.utils import BEHAVIOR_SUMMARY
+
+class BehaviorSummary(Processing):
+    """Behavior aggregated by the Resultserver during the analysis."""
+    key = "behavior"
+
+    def process_tree(self, processes):
+        """Build the process tree from the parent ids.
+        @param processes: processes list.
+        @return: list of root process nodes.
+        """
+        nodes = {}
+        for process in processes:
+            nodes[process["process_id"]] = {
+                "name": process["process_name"],
+                "pid": process["process_id"],
+                "parent_id": process["parent_id"],
+                "children": [],
+            }
+
+        tree = []
+        for node in nodes.values():
+            parent = nodes.get(node["parent_id"])
+            if parent and parent is not node:
+                parent["children"].append(node)
+            else:
+                tree.append(node)
+
+        return tree
+
+    def run(self):
+        """Run analysis.
+        @return: behavior summary dict.
+        """
+        summary_path = os.path.join(self.analysis_path, BEHAVIOR_SUMMARY)
+        if not os.path.exists(summary_path):
+            return None
+
+        try:
+            with open(summary_path, "rb") as f:
+                behavior = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            raise CuckooProcessingError("Error reading %s: %s" %
+                                        (summary_path, e))
+
+        # The individual calls aren't kept by the Resultserver, only their
+        # count by API name.
+        for process in behavior["processes"]:
+            process["calls"] = []
+
+        behavior["processtree"] = self.process_tree(behavior["processes"])
+        return behavior
@@ -6,21 +6,30 @@ import os
 
 from lib.cuckoo.common.abstracts import Processing
 from lib.cuckoo.common.objects import File
+from lib.cuckoo.common.utils import read_uploads_manifest
 
 class Dropped(Processing):
     """Dropped files analysis."""
+    key = "dropped"
 
     def run(self):
         """Run analysis.
         @return: list of dropped files with related information.
         """
-        self.key = "dropped"
         dropped_files = []
 
+        # The hashes computed by the Resultserver while receiving the files.
+        uploads = read_uploads_manifest(self.analysis_path)
+
         for dir_name, dir_names, file_names in os.walk(self.dropped_path):
             for file_name in file_names:
                 file_path = os.path.join(dir_name, file_name)
-                file_info = File(file_path=file_path).get_all()
+
+                upload = uploads.get(os.path.relpath(file_path, self.analysis_path))
+                if upload and upload["size"] != os.path.getsize(file_path):
+                    upload = None
+
+                file_info = File(file_path=file_path, hashes=upload).get_all()
                 dropped_files.append(file_info)
 
         return dropped_files
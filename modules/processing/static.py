@@ -235,12 +235,13 @@ class PortableExecutable:
 
 class Static(Processing):
     """Static analysis."""
+    key = "static"
+    cacheable = True
     
     def run(self):
         """Run analysis.
         @return: results dict.
         """
-        self.key = "static"
         static = {}
 
         if HAVE_PEFILE:
@@ -9,13 +9,13 @@ from lib.cuckoo.common.objects import File
 
 class TargetInfo(Processing):
     """General information about a file."""
+    key = "target"
+    cacheable = True
 
     def run(self):
         """Run file information gathering.
         @return: information dict.
         """
-        self.key = "target"
-
         target_info = {"category": self.task["category"]}
 
         if self.task["category"] == "file":
@@ -30,4 +30,13 @@ class TargetInfo(Processing):
         elif self.task["category"] == "url":
             target_info["url"] = self.task["target"]
 
-        return target_info
\ No newline at end of file
+        return target_info
+
+    def from_cache(self, data):
+        """Set the submitted file name and path of this analysis.
+        @param data: information dict of a previous analysis.
+        @return: information dict.
+        """
+        data["file"]["name"] = File(self.task["target"]).get_name()
+        data["file"]["path"] = self.file_path
+        return data
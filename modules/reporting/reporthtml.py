@@ -20,6 +20,8 @@ except ImportError:
 
 class ReportHTML(Report):
     """Stores report in HTML format."""
+    # The screenshots are added to the results.
+    mutates_results = True
 
     def run(self, results):
         """Writes report.
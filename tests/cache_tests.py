@@ -0,0 +1,76 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equal
+
+from lib.cuckoo.common.cache import ResultCache
+
+
+class TestResultCache:
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ResultCache(self.tmp, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_get_put(self):
+        key = self.cache.make_key("foo", "bar")
+        assert_equal((False, None), self.cache.get(key))
+        self.cache.put(key, {"foo": ["bar"]})
+        assert_equal((True, {"foo": ["bar"]}), self.cache.get(key))
+        self.cache.put(key, None)
+        assert_equal((True, None), self.cache.get(key))
+
+    def test_make_key(self):
+        assert self.cache.make_key("a", "bc") != self.cache.make_key("ab", "c")
+
+    def test_corrupted(self):
+        key = self.cache.make_key("foo")
+        self.cache.put(key, "bar")
+        with open(self.cache._entry_path(key), "wb") as f:
+            f.write("garbage")
+        assert_equal((False, None), self.cache.get(key))
+        assert not os.path.exists(self.cache._entry_path(key))
+
+    def test_evict(self):
+        keys = [self.cache.make_key(str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, "x" * 1000)
+            os.utime(self.cache._entry_path(key), (i, i))
+        # The first result was used last, the second one goes.
+        self.cache.get(keys[0])
+        self.cache.max_size = 3500
+        self.cache.put(self.cache.make_key("3"), "x" * 1000)
+        assert self.cache.get(keys[0])[0]
+        assert not self.cache.get(keys[1])[0]
+        assert self.cache.get(keys[2])[0]
+
+    def test_size_tracked(self):
+        scans = []
+        evict = self.cache.evict
+        self.cache.evict = lambda: scans.append(evict())
+        for i in range(5):
+            self.cache.put(self.cache.make_key(str(i)), "x" * 1000)
+        # Only computed on the first result, then kept up to date.
+        assert_equal(1, len(scans))
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, dirs, files in os.walk(self.tmp)
+                   for name in files)
+        assert_equal(size, self.cache.size)
+
+        # Past the maximum size, evicted down to the low water mark.
+        self.cache.max_size = size
+        self.cache.put(self.cache.make_key("5"), "x" * 1000)
+        assert_equal(2, len(scans))
+        assert self.cache.size <= size * self.cache.low_water
+
+    def test_shared(self):
+        cache = ResultCache.shared(self.tmp, 1024)
+        assert cache is ResultCache.shared(self.tmp, 2048)
+        assert_equal(2048, cache.max_size)
+        ResultCache._instances.pop(self.tmp)
@@ -3,10 +3,12 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import pickle
 import tempfile
 from nose.tools import assert_equals, raises
 
-from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.config import Config, reload_config, request_reload
+from lib.cuckoo.common import config
 from lib.cuckoo.common.exceptions import CuckooOperationalError
 
 
@@ -53,3 +55,44 @@ interface = vboxnet0
     def test_get_option_not_found_in_file_not_found(self):
         self.c = Config("bar")
         self.c.get("foo")
+
+    def test_cached(self):
+        assert Config(self.file).cuckoo is self.c.cuckoo
+
+    def test_file_changed(self):
+        self._load_conf(self.CONF_EXAMPLE.replace("120", "1200"))
+        # Same size, a different modification time.
+        os.utime(self.file, (0, 0))
+        assert_equals(Config(self.file).cuckoo.analysis_timeout, 1200)
+        assert_equals(self.c.cuckoo.analysis_timeout, 120)
+
+    def test_reload(self):
+        reload_config()
+        c = Config(self.file)
+        assert c.cuckoo is not self.c.cuckoo
+        assert_equals(c.cuckoo, self.c.cuckoo)
+
+    def test_request_reload(self):
+        # Requested while a thread holds the lock, as from a signal
+        # handler interrupting it.
+        with config._cache_lock:
+            request_reload()
+        c = Config(self.file)
+        assert c.cuckoo is not self.c.cuckoo
+        assert_equals(c.cuckoo, self.c.cuckoo)
+        # Only once.
+        assert Config(self.file).cuckoo is c.cuckoo
+
+    @raises(TypeError)
+    def test_read_only(self):
+        self.c.cuckoo.debug = True
+
+    def test_copy(self):
+        options = self.c.cuckoo.copy()
+        options.debug = True
+        assert_equals(options.debug, True)
+        assert_equals(self.c.cuckoo.debug, False)
+
+    def test_pickle(self):
+        options = pickle.loads(pickle.dumps(self.c.cuckoo, 2))
+        assert_equals(options, self.c.cuckoo)
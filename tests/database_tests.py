@@ -0,0 +1,353 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from nose.tools import assert_equal
+
+from lib.cuckoo.common.objects import Dictionary, File, URL
+from lib.cuckoo.common.utils import Singleton
+from lib.cuckoo.core.database import Database, TASK_PENDING, TASK_RUNNING
+from lib.cuckoo.core.database import TASK_COMPLETED, TASK_FAILED_PROCESSING
+from lib.cuckoo.core.database import TASK_RECOVERED
+from lib.cuckoo.core.database import lease_owner_alive
+from lib.cuckoo.core import startup
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+class TestDatabase:
+    def setUp(self):
+        self.tmp = tempfile.mkstemp(suffix=".db")[1]
+        # Database is a singleton, drop the previous instance so that every
+        # test gets its own empty database file.
+        Singleton._instances.pop(Database, None)
+        self.d = Database(dsn="sqlite:///%s" % self.tmp)
+
+    def tearDown(self):
+        self.d.engine.dispose()
+        Singleton._instances.pop(Database, None)
+        os.remove(self.tmp)
+
+    def test_add_url(self):
+        task_id = self.d.add_url("http://www.cuckoosandbox.org")
+        task = self.d.view_task(task_id)
+        assert_equal("http://www.cuckoosandbox.org", task.target)
+        assert_equal(TASK_PENDING, task.status)
+
+    def test_add_many(self):
+        sample = tempfile.mkstemp()[1]
+        with open(sample, "wb") as f:
+            f.write("foo")
+        try:
+            ids = self.d.add_many([File(sample), URL("http://a.example.com"),
+                                   File(sample)], tags="foo,bar", priority=2)
+        finally:
+            os.remove(sample)
+        assert_equal(3, len(ids))
+        first, url, second = [self.d.view_task(i) for i in ids]
+        assert_equal("url", url.category)
+        assert_equal(2, url.priority)
+        assert_equal(first.sample_id, second.sample_id)
+        assert_equal(["bar", "foo"], sorted(tag.name for tag in url.tags))
+
+    def test_load_sample(self):
+        sample = tempfile.mkstemp()[1]
+        with open(sample, "wb") as f:
+            f.write("foo")
+        try:
+            task_id = self.d.add_path(sample)
+        finally:
+            os.remove(sample)
+        md5 = "acbd18db4cc2f85cedef654fccc4a4d8"
+        assert_equal(md5, self.d.view_task(task_id, sample=True).sample.md5)
+        tasks = self.d.list_tasks(sample=True, task_ids=[task_id])
+        assert_equal(md5, tasks[0].sample.md5)
+        assert_equal([], self.d.list_tasks(task_ids=[task_id + 1]))
+
+    def test_add_many_existing(self):
+        self.d.add_url("http://a.example.com", tags="foo")
+        ids = self.d.add_many([URL("http://b.example.com")], tags="foo")
+        assert_equal(["foo"], [tag.name for tag in self.d.view_task(ids[0]).tags])
+        assert_equal(1, self.d.engine.execute("SELECT COUNT(*) FROM tags").scalar())
+
+    def test_add_notifies(self):
+        assert not self.d.wait_for_tasks(timeout=0)
+        self.d.add_url("http://www.cuckoosandbox.org")
+        assert self.d.wait_for_tasks(timeout=0)
+        # The notification is consumed by the first waiter.
+        assert not self.d.wait_for_tasks(timeout=0)
+
+    def test_notify_between_waits(self):
+        # A change notified while the scheduler checks the queue, i.e. not
+        # while it waits, must still wake up the next wait.
+        self.d.notify()
+        assert self.d.wait_for_tasks(timeout=0)
+        self.d.notify()
+        start = time.time()
+        assert self.d.wait_for_tasks(timeout=5)
+        assert time.time() - start < 1
+
+    def test_notify_wakes_waiter(self):
+        timer = threading.Timer(0.1, self.d.notify)
+        timer.start()
+        try:
+            assert self.d.wait_for_tasks(timeout=5)
+        finally:
+            timer.join()
+
+    def test_fetch(self):
+        low = self.d.add_url("http://low.example.com", priority=1)
+        high = self.d.add_url("http://high.example.com", priority=5)
+        task = self.d.fetch()
+        assert_equal(high, task.id)
+        assert_equal(TASK_RUNNING, self.d.view_task(high).status)
+        assert_equal(low, self.d.fetch().id)
+        assert_equal(None, self.d.fetch())
+
+    def test_fetch_lease_expires(self):
+        task_id = self.d.add_url("http://1.example.com")
+        self.d.fetch(lease_seconds=-1)
+        assert self.d.view_task(task_id).lease_expires
+        assert_equal(1, self.d.release_expired_leases())
+
+    def test_fetch_completed(self):
+        ids = [self.d.add_url("http://%d.example.com" % i) for i in range(3)]
+        for task_id in ids:
+            self.d.set_status(task_id, TASK_COMPLETED)
+        tasks = self.d.fetch_completed(2, "node1", 60)
+        assert_equal(ids[:2], [task.id for task in tasks])
+        assert_equal(ids[2:], [task.id for task in
+                               self.d.fetch_completed(2, "node2", 60)])
+        assert_equal([], self.d.fetch_completed(2, "node3", 60))
+
+        # Taken over once the lease expired.
+        self.d.renew_leases("node1", -1, status=TASK_COMPLETED)
+        assert_equal(ids[:2], [task.id for task in
+                               self.d.fetch_completed(2, "node3", 60)])
+
+    def test_release_lease(self):
+        task_id = self.d.add_url("http://1.example.com")
+        self.d.fetch_batch(1, "node1", 60)
+        self.d.set_status(task_id, TASK_COMPLETED)
+        assert_equal([], self.d.fetch_completed(1, "node2", 60))
+        self.d.release_lease(task_id)
+        assert_equal([task_id], [task.id for task in
+                                 self.d.fetch_completed(1, "node2", 60)])
+
+    def test_fetch_batch(self):
+        ids = [self.d.add_url("http://%d.example.com" % i) for i in range(5)]
+        tasks = self.d.fetch_batch(3, "node1", 60)
+        assert_equal(ids[:3], [task.id for task in tasks])
+        assert_equal("node1", tasks[0].lease_owner)
+        tasks = self.d.fetch_batch(3, "node2", 60)
+        assert_equal(ids[3:], [task.id for task in tasks])
+        assert_equal([], self.d.fetch_batch(3, "node3", 60))
+
+    def test_release_expired_leases(self):
+        first = self.d.add_url("http://1.example.com")
+        second = self.d.add_url("http://2.example.com")
+        self.d.fetch_batch(1, "alive", 60)
+        self.d.fetch_batch(1, "dead", -1)
+        assert_equal(1, self.d.release_expired_leases())
+        assert_equal(TASK_RUNNING, self.d.view_task(first).status)
+        assert_equal(TASK_PENDING, self.d.view_task(second).status)
+        assert_equal(None, self.d.view_task(second).lease_owner)
+
+    def test_renew_leases(self):
+        self.d.add_url("http://1.example.com")
+        self.d.fetch_batch(1, "node1", -1)
+        assert_equal(1, self.d.renew_leases("node1", 60))
+        assert_equal(0, self.d.release_expired_leases())
+
+    def test_take_over_lease(self):
+        task = self.d.add_url("http://1.example.com")
+        self.d.fetch_batch(1, "dead", 60)
+        assert self.d.take_over_lease(task, "dead", "node1")
+        assert not self.d.take_over_lease(task, "dead", "node2")
+        assert_equal("node1", self.d.view_task(task).lease_owner)
+
+    def test_lease_owner_alive(self):
+        host = socket.gethostname()
+        assert lease_owner_alive("%s:%d" % (host, os.getpid()))
+        assert lease_owner_alive("%s:%d" % (host, os.getppid()))
+        assert lease_owner_alive("%s.other:1" % host)
+        assert not lease_owner_alive(None)
+        assert not lease_owner_alive("c0ffee")
+
+        # The pid of a process which exited.
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert not lease_owner_alive("%s:%d" % (host, pid))
+
+    def test_reschedule_crashed_fetch(self):
+        task = self.d.add_url("http://1.example.com")
+
+        # A process which fetched the task without a lease and crashed.
+        pid = os.fork()
+        if not pid:
+            try:
+                self.d.fetch()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        owner = self.d.view_task(task).lease_owner
+        assert_equal("%s:%d" % (socket.gethostname(), pid), owner)
+
+        cfg = Dictionary()
+        cfg.cuckoo = Dictionary(reschedule=True)
+        config = startup.Config
+        startup.Config = lambda: cfg
+        try:
+            startup.init_tasks()
+        finally:
+            startup.Config = config
+
+        assert_equal(TASK_RECOVERED, self.d.view_task(task).status)
+        assert_equal(["http://1.example.com"],
+                     [t.target for t in self.d.list_tasks(status=TASK_PENDING)])
+
+    def test_list_tasks_cursor(self):
+        ids = [self.d.add_url("http://%d.example.com" % i) for i in range(5)]
+        page = self.d.list_tasks(limit=2)
+        assert_equal([ids[4], ids[3]], [task.id for task in page])
+        page = self.d.list_tasks(limit=2, after_id=page[-1].id)
+        assert_equal([ids[2], ids[1]], [task.id for task in page])
+        page = self.d.list_tasks(limit=2, before_id=page[0].id)
+        assert_equal([ids[4], ids[3]], [task.id for task in page])
+        assert_equal([], self.d.list_tasks(limit=2, after_id=ids[0]))
+
+    def test_count_tasks(self):
+        first = self.d.add_url("http://1.example.com")
+        self.d.add_many([URL("http://2.example.com"), URL("http://3.example.com")])
+        assert_equal(3, self.d.count_tasks())
+        self.d.fetch_batch(2, "node1", -1)
+        self.d.release_expired_leases()
+        self.d.fetch_batch(1, "node1", 60)
+        self.d.set_status(first, TASK_COMPLETED)
+        self.d.delete_task(self.d.list_tasks(status=TASK_PENDING)[0].id)
+        assert_equal({TASK_PENDING: 1, TASK_COMPLETED: 1},
+                     dict((k, v) for k, v in self.d.count_tasks_by_status().items() if v))
+        assert_equal(2, self.d.count_tasks())
+        assert_equal(1, self.d.count_tasks(TASK_PENDING))
+
+    def test_rebuild_counters(self):
+        task_id = self.d.add_url("http://1.example.com")
+        self.d.set_status(task_id, TASK_COMPLETED)
+        self.d.engine.execute("DELETE FROM task_counts")
+        self.d.engine.execute("DELETE FROM throughput")
+        self.d.rebuild_counters()
+        assert_equal(1, self.d.count_tasks(TASK_COMPLETED))
+        assert_equal(0, self.d.count_tasks(TASK_PENDING))
+        assert_equal([1], [completed for _, completed in self.d.throughput()])
+
+    def test_throughput(self):
+        for i in range(3):
+            self.d.set_status(self.d.add_url("http://%d.example.com" % i), TASK_COMPLETED)
+        throughput = self.d.throughput(hours=1)
+        assert_equal(1, len(throughput))
+        assert_equal(3, throughput[0][1])
+
+    def test_throughput_completed_again(self):
+        task_id = self.d.add_url("http://1.example.com")
+        self.d.set_status(task_id, TASK_COMPLETED)
+        self.d.set_status(task_id, TASK_RUNNING)
+        self.d.set_status(task_id, TASK_COMPLETED)
+        assert_equal([1], [completed for _, completed in self.d.throughput()])
+
+    def test_upgrade_schema(self):
+        self.d.engine.execute("DROP TABLE tasks")
+        self.d.engine.execute("CREATE TABLE tasks (id INTEGER PRIMARY KEY, "
+                              "target TEXT NOT NULL, status VARCHAR(17), "
+                              "priority INTEGER, added_on DATETIME)")
+        self.d._upgrade_schema()
+        columns = [row[1] for row in self.d.engine.execute("PRAGMA table_info(tasks)")]
+        assert "lease_owner" in columns
+        assert "lease_expires" in columns
+        indexes = [row[1] for row in self.d.engine.execute("PRAGMA index_list(tasks)")]
+        assert "queue_index" in indexes
+
+    def test_upgrade_status_type(self):
+        # Tasks table of a database created before the failed statuses.
+        self.d.engine.dispose()
+        os.remove(self.tmp)
+        db = sqlite3.connect(self.tmp)
+        db.executescript("""
+            CREATE TABLE tasks (id INTEGER NOT NULL, target TEXT NOT NULL,
+                category VARCHAR(255) NOT NULL,
+                timeout INTEGER DEFAULT '0' NOT NULL,
+                priority INTEGER DEFAULT '1' NOT NULL, custom VARCHAR(255),
+                package VARCHAR(255), options VARCHAR(255),
+                platform VARCHAR(255), memory BOOLEAN NOT NULL,
+                enforce_timeout BOOLEAN NOT NULL, clock DATETIME NOT NULL,
+                added_on DATETIME NOT NULL, started_on DATETIME,
+                completed_on DATETIME,
+                status VARCHAR(9) DEFAULT 'pending' NOT NULL,
+                sample_id INTEGER, PRIMARY KEY (id),
+                CONSTRAINT status_type CHECK (status IN ('pending',
+                    'running', 'completed', 'reported', 'recovered')));
+            CREATE TABLE errors (id INTEGER NOT NULL,
+                message VARCHAR(255) NOT NULL, task_id INTEGER NOT NULL,
+                PRIMARY KEY (id), FOREIGN KEY(task_id) REFERENCES tasks (id));
+            INSERT INTO tasks (id, target, category, memory, enforce_timeout,
+                clock, added_on, status) VALUES (1, 'http://a.example.com',
+                'url', 0, 0, '2014-01-01 00:00:00', '2014-01-01 00:00:00',
+                'completed');
+        """)
+        db.close()
+
+        Singleton._instances.pop(Database, None)
+        self.d = Database(dsn="sqlite:///%s" % self.tmp)
+        assert self.d.set_status(1, TASK_FAILED_PROCESSING)
+        assert_equal(TASK_FAILED_PROCESSING, self.d.view_task(1).status)
+        assert_equal("http://a.example.com", self.d.view_task(1).target)
+        self.d.add_error("foo", 1)
+        assert_equal(["foo"], [error.message for error in self.d.view_errors(1)])
+        sql = self.d.engine.execute("SELECT sql FROM sqlite_master WHERE "
+                                    "name = 'errors'").scalar()
+        assert "REFERENCES tasks " in sql
+        indexes = [row[1] for row in self.d.engine.execute("PRAGMA index_list(tasks)")]
+        assert "queue_index" in indexes
+
+    def test_set_status_error(self):
+        assert not self.d.set_status(self.d.add_url("http://a.example.com"),
+                                     "foo")
+
+    def test_queue_index(self):
+        plan = self.d.engine.execute("EXPLAIN QUERY PLAN SELECT id FROM tasks "
+                                     "WHERE status = 'pending' ORDER BY "
+                                     "priority DESC, added_on").fetchall()
+        assert "queue_index" in str(plan)
+        assert "TEMP B-TREE" not in str(plan)
+
+    def test_upgrade_queue_index(self):
+        # Index of a database created before it was made descending.
+        self.d.engine.execute("DROP INDEX queue_index")
+        self.d.engine.execute("CREATE INDEX queue_index ON tasks "
+                              "(status, priority, added_on)")
+        self.d._upgrade_schema()
+        sql = self.d.engine.execute("SELECT sql FROM sqlite_master WHERE "
+                                    "name = 'queue_index'").scalar()
+        assert "priority DESC" in sql
+
+    def test_sqlite_pool(self):
+        assert isinstance(self.d.engine.pool, QueuePool)
+        journal_mode = self.d.engine.execute("PRAGMA journal_mode").scalar()
+        assert_equal("wal", journal_mode)
+        synchronous = self.d.engine.execute("PRAGMA synchronous").scalar()
+        assert_equal(1, synchronous)
+
+    def test_sqlite_memory(self):
+        Singleton._instances.pop(Database, None)
+        d = Database(dsn="sqlite://")
+        assert isinstance(d.engine.pool, StaticPool)
+        task_id = d.add_url("http://www.cuckoosandbox.org")
+        assert_equal(task_id, d.view_task(task_id).id)
+        d.engine.dispose()
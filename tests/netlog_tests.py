@@ -0,0 +1,217 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import struct
+import datetime
+from nose.tools import assert_equal, raises
+
+from lib.cuckoo.common.exceptions import CuckooResultError
+from lib.cuckoo.common.logtbl import table
+from lib.cuckoo.common.netlog import NetlogParser, BsonParser
+from lib.cuckoo.common.netlog import bson_decode, expand_format
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+class HandlerMock(object):
+    """Records the parsed messages, reads raise NeedMoreData past the end of
+    the received data like the event driven Resultserver does."""
+
+    def __init__(self, data=""):
+        self.data = data
+        self.offset = 0
+        self.messages = []
+
+    def read(self, length):
+        if self.offset + length > len(self.data):
+            raise NeedMoreData()
+        self.offset += length
+        return self.data[self.offset - length:self.offset]
+
+    def log_process(self, context, vmtime, pid, ppid, modulepath, procname):
+        self.messages.append(("process", vmtime, pid, ppid, modulepath,
+                              procname))
+
+    def log_thread(self, context, pid):
+        self.messages.append(("thread", context[3], pid))
+
+    def log_call(self, context, apiname, category, arguments):
+        self.messages.append(("call", apiname, category, context[1],
+                              context[2], list(arguments)))
+
+
+def api_index(apiname):
+    return [entry[0] for entry in table].index(apiname)
+
+
+def netlog_string(value):
+    return struct.pack("<I", len(value)) + value
+
+
+def bson(values):
+    def element(name, value):
+        if isinstance(value, int):
+            return "\x10" + name + "\x00" + struct.pack("<i", value)
+        elif isinstance(value, str):
+            return "\x02" + name + "\x00" + \
+                struct.pack("<i", len(value) + 1) + value + "\x00"
+        elif isinstance(value, list):
+            return "\x04" + name + "\x00" + \
+                bson(dict((str(i), v) for i, v in enumerate(value)))
+    elements = "".join(element(name, value)
+                       for name, value in sorted(values.items()))
+    return struct.pack("<i", len(elements) + 5) + elements + "\x00"
+
+
+class TestNetlogParser:
+    def test_expand_format(self):
+        assert_equal("ppB", expand_format("2pB"))
+        assert_equal("pSLLLLLL", expand_format("pS6L"))
+
+    def test_process_thread(self):
+        # 2014-01-01 00:00:00 as a FILETIME.
+        filetime = 130330080000000000
+        handler = HandlerMock(
+            struct.pack("<BBIIIIIII", 0, 1, 0, 5, 0, filetime & 0xffffffff,
+                        filetime >> 32, 1234, 4) +
+            netlog_string("C:\\WINDOWS\\a.exe") +
+            struct.pack("<BBIIII", 1, 1, 0, 6, 0, 1234))
+        parser = NetlogParser(handler)
+        assert parser.read_next_message()
+        assert parser.read_next_message()
+        assert_equal([
+            ("process", datetime.datetime(2014, 1, 1), 1234, 4,
+             "C:\\WINDOWS\\a.exe", "a.exe"),
+            ("thread", 6, 1234),
+        ], handler.messages)
+
+    def test_call(self):
+        handler = HandlerMock(
+            struct.pack("<BBIII", api_index("LdrGetDllHandle"), 1, 0, 5, 0) +
+            netlog_string("kernel32.dll") + struct.pack("<I", 0x7c800000) +
+            struct.pack("<BBIII", api_index("DeleteFileW"), 0, 2, 5, 0) +
+            struct.pack("<I", 3) + u"a\xe9b".encode("utf-16-le") +
+            struct.pack("<BBIII", api_index("NtReadVirtualMemory"), 1, 0, 5, 0) +
+            struct.pack("<III", 0x7c, 0x400000, 3) + "MZ\x90")
+        parser = NetlogParser(handler)
+        for _ in range(3):
+            assert parser.read_next_message()
+        assert_equal([
+            ("call", "LdrGetDllHandle", "system", 1, 0,
+             [("FileName", "kernel32.dll"), ("ModuleHandle", "0x7c800000")]),
+            ("call", "DeleteFileW", "filesystem", 0, 2,
+             [("FileName", "a\xc3\xa9b")]),
+            ("call", "NtReadVirtualMemory", "process", 1, 0,
+             [("ProcessHandle", "0x0000007c"), ("BaseAddress", "0x00400000"),
+              ("Buffer", "MZ\x90")]),
+        ], handler.messages)
+
+    def test_registry_list(self):
+        handler = HandlerMock(
+            struct.pack("<BBIII", api_index("RegSetValueExA"), 1, 0, 5, 0) +
+            struct.pack("<I", 0x80) + netlog_string("Run") +
+            struct.pack("<iII", 4, 4, 4) + struct.pack("<I", 42) +
+            struct.pack("<BBIII", api_index("StartServiceA"), 1, 0, 5, 0) +
+            struct.pack("<II", 0x10, 2) + netlog_string("a") +
+            netlog_string("bc"))
+        parser = NetlogParser(handler)
+        assert parser.read_next_message()
+        assert parser.read_next_message()
+        assert_equal([("Handle", "0x00000080"), ("ValueName", "Run"),
+                      ("Type", 4), ("Buffer", 42)], handler.messages[0][5])
+        assert_equal([("ServiceHandle", "0x00000010"),
+                      ("Arguments", ["a", "bc"])], handler.messages[1][5])
+
+    def test_partial_message(self):
+        data = struct.pack("<BBIII", api_index("LdrGetDllHandle"), 1, 0, 5, 0) + \
+            netlog_string("kernel32.dll") + struct.pack("<I", 0x7c800000)
+        handler = HandlerMock()
+        parser = NetlogParser(handler)
+        # Parse the message again from its start with more data every time,
+        # as the event driven Resultserver does.
+        for end in range(len(data)):
+            handler.data, handler.offset = data[:end], 0
+            try:
+                parser.read_next_message()
+            except NeedMoreData:
+                pass
+            assert_equal([], handler.messages)
+        handler.data, handler.offset = data, 0
+        assert parser.read_next_message()
+        assert_equal(1, len(handler.messages))
+
+    def test_unknown_api(self):
+        handler = HandlerMock(struct.pack("<BBIII", 255, 1, 0, 5, 0))
+        assert not NetlogParser(handler).read_next_message()
+
+    @raises(CuckooResultError)
+    def test_corrupted_length(self):
+        handler = HandlerMock(
+            struct.pack("<BBIII", api_index("DeleteFileA"), 1, 0, 5, 0) +
+            struct.pack("<I", 0xffffffff))
+        NetlogParser(handler).read_next_message()
+
+
+class TestBsonParser:
+    def stream(self):
+        return "".join([
+            bson({"I": 0, "type": "info", "name": "__process__",
+                  "category": "__notification__",
+                  "args": ["is_success", "retval", "TimeLow", "TimeHigh",
+                           "ProcessIdentifier", "ParentProcessIdentifier",
+                           "ModulePath"]}),
+            bson({"I": 1, "type": "info", "name": "__thread__",
+                  "category": "__notification__",
+                  "args": ["is_success", "retval", "ProcessIdentifier"]}),
+            bson({"I": 2, "type": "info", "name": "NtClose",
+                  "category": "system",
+                  "args": ["is_success", "retval", "Handle"]}),
+            bson({"I": 0, "T": 5, "t": 0,
+                  "args": [1, 0, 0, 0, 1234, 4, "C:\\a.exe"]}),
+            bson({"I": 1, "T": 6, "t": 0, "args": [1, 0, 1234]}),
+            bson({"I": 2, "T": 6, "t": 10, "args": [0, 5, "0x000007ec"]}),
+        ])
+
+    def test_bson_decode(self):
+        assert_equal({"a": 1, "b": "foo", "c": [1, "x", [2]]},
+                     bson_decode(bson({"a": 1, "b": "foo",
+                                       "c": [1, "x", [2]]})))
+
+    def test_messages(self):
+        handler = HandlerMock(self.stream())
+        parser = BsonParser(handler)
+        while handler.offset < len(handler.data):
+            assert parser.read_next_message()
+        assert_equal([
+            ("process", datetime.datetime(1601, 1, 1), 1234, 4, "C:\\a.exe",
+             "a.exe"),
+            ("thread", 6, 1234),
+            ("call", "NtClose", "system", 0, 5, [("Handle", "0x000007ec")]),
+        ], handler.messages)
+
+    def test_partial_message(self):
+        data = self.stream()
+        handler = HandlerMock()
+        parser = BsonParser(handler)
+        offset = 0
+        for end in range(len(data) + 1):
+            handler.data, handler.offset = data[:end], offset
+            try:
+                parser.read_next_message()
+            except NeedMoreData:
+                continue
+            offset = handler.offset
+        assert_equal(len(data), offset)
+        assert_equal(3, len(handler.messages))
+
+    def test_unknown_index(self):
+        handler = HandlerMock(bson({"I": 7, "T": 5, "t": 0, "args": []}))
+        assert BsonParser(handler).read_next_message()
+        assert_equal([], handler.messages)
+
+    @raises(CuckooResultError)
+    def test_corrupted_length(self):
+        BsonParser(HandlerMock(struct.pack("<i", 2))).read_next_message()
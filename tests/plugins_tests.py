@@ -0,0 +1,450 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import sys
+import time
+import logging
+import shutil
+import tempfile
+import threading
+from nose.tools import assert_equal, raises
+
+from lib.cuckoo.common.abstracts import Processing, Report
+from lib.cuckoo.common.cache import ResultCache
+from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.constants import CUCKOO_ROOT
+from lib.cuckoo.common.exceptions import CuckooModuleLimitError
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.exceptions import CuckooProcessingError
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.core.plugins import RunProcessing, RunReporting
+from lib.cuckoo.common.utils import Singleton
+from lib.cuckoo.core.database import Database
+from lib.cuckoo.core.plugins import run_isolated
+from lib.cuckoo.core import plugins
+
+# Optional dependency flag of the mock modules.
+HAVE_FOO = False
+
+
+class ProcessingMock(Processing):
+    key = "mock"
+    delay = 0
+
+    def run(self):
+        time.sleep(self.delay)
+        return {"thread": threading.current_thread().name,
+                "results": self.results}
+
+
+class TargetMock(ProcessingMock):
+    key = "target"
+    delay = 0.2
+
+
+class BehaviorMock(ProcessingMock):
+    key = "behavior"
+    depends = ["target", "virustotal"]
+
+
+class StringsMock(ProcessingMock):
+    key = "strings"
+
+
+class LaterMock(ProcessingMock):
+    key = "later"
+    order = 2
+
+    def run(self):
+        return {"started": time.time(), "results": self.results}
+
+
+class FirstMock(ProcessingMock):
+    key = "first"
+    depends = ["second"]
+
+
+class SecondMock(ProcessingMock):
+    key = "second"
+    depends = ["first"]
+
+
+class FailingMock(ProcessingMock):
+    key = "failing"
+
+    def run(self):
+        raise Exception("Failed")
+
+
+class DependingOnFailingMock(ProcessingMock):
+    key = "depending"
+    depends = ["failing"]
+
+
+class BrokenMock(ProcessingMock):
+    key = "broken"
+
+    def set_results(self, results):
+        raise Exception("Broken")
+
+
+class CachedMock(ProcessingMock):
+    key = "cached"
+    cacheable = True
+    runs = 0
+
+    def run(self):
+        CachedMock.runs += 1
+        return {"runs": CachedMock.runs}
+
+    def from_cache(self, data):
+        data["cached"] = True
+        return data
+
+
+class EmptyCachedMock(CachedMock):
+    key = "empty_cached"
+
+    def run(self):
+        CachedMock.runs += 1
+        return {}
+
+
+class BrokenCachedMock(CachedMock):
+    key = "broken_cached"
+
+    def from_cache(self, data):
+        raise Exception("Broken")
+
+
+class BrokenCache(ResultCache):
+    def get(self, key):
+        raise Exception("Broken")
+
+    def put(self, key, data):
+        raise Exception("Broken")
+
+
+class TestRunProcessing:
+    def setUp(self):
+        # Don't touch the database, the modules are given directly.
+        self.p = RunProcessing.__new__(RunProcessing)
+        self.p.analysis_path = ""
+        self.p.cache = None
+        self.p.sha256 = None
+
+    def schedule(self, modules, threads, options={}):
+        self.p.threads = threads
+        results = {}
+        instances = []
+        for module in modules:
+            current = module()
+            current.set_options(Dictionary(options))
+            instances.append(current)
+        self.p.schedule(instances, results)
+        return results
+
+    def test_dependencies(self):
+        for threads in (1, 4):
+            results = self.schedule([BehaviorMock, TargetMock, StringsMock],
+                                    threads)
+            assert_equal(["behavior", "strings", "target"], sorted(results))
+            assert_equal({"target": results["target"]},
+                         results["behavior"]["results"])
+            assert_equal({}, results["strings"]["results"])
+
+    def test_concurrency(self):
+        results = self.schedule([TargetMock, StringsMock], 4)
+        assert results["target"]["thread"] != results["strings"]["thread"]
+
+    def test_order(self):
+        # Without depends, the modules with a lower order are waited for.
+        start = time.time()
+        results = self.schedule([TargetMock, LaterMock, StringsMock], 4)
+        assert results["later"]["started"] - start >= TargetMock.delay
+        assert_equal({}, results["later"]["results"])
+
+    def test_circular_dependencies(self):
+        results = self.schedule([FirstMock, SecondMock, StringsMock], 2)
+        assert_equal(["strings"], sorted(results))
+
+    def test_failed_dependency(self):
+        results = self.schedule([DependingOnFailingMock, FailingMock], 2)
+        assert_equal(["depending"], sorted(results))
+        assert_equal({}, results["depending"]["results"])
+
+    def test_unexpected_error(self):
+        for threads in (1, 2):
+            results = self.schedule([BrokenMock, StringsMock], threads)
+            assert_equal(["strings"], sorted(results))
+
+    def test_cache(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            self.p.cache = ResultCache(tmp, 1024 * 1024)
+            self.p.sha256 = "a" * 64
+            first = self.schedule([CachedMock, StringsMock], 1)
+            second = self.schedule([CachedMock, StringsMock], 1)
+            assert_equal({"runs": 1}, first["cached"])
+            assert_equal({"runs": 1, "cached": True}, second["cached"])
+
+            # Another file or other options.
+            self.p.sha256 = "b" * 64
+            assert_equal({"runs": 2}, self.schedule([CachedMock], 1)["cached"])
+            assert_equal({"runs": 3}, self.schedule([CachedMock], 1,
+                                                    {"foo": 1})["cached"])
+
+            # An optional dependency which became available.
+            global HAVE_FOO
+            HAVE_FOO = True
+            try:
+                assert_equal({"runs": 4},
+                             self.schedule([CachedMock], 1)["cached"])
+            finally:
+                HAVE_FOO = False
+
+            # Empty results aren't cached.
+            runs = CachedMock.runs
+            self.schedule([EmptyCachedMock], 1)
+            self.schedule([EmptyCachedMock], 1)
+            assert_equal(runs + 2, CachedMock.runs)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_cache_error(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            self.p.sha256 = "c" * 64
+            self.p.cache = ResultCache(tmp, 1024 * 1024)
+            self.schedule([BrokenCachedMock], 1)
+            runs = CachedMock.runs
+            # Run again instead of failing.
+            assert_equal({"runs": runs + 1},
+                         self.schedule([BrokenCachedMock], 1)["broken_cached"])
+
+            self.p.cache = BrokenCache(tmp, 1024 * 1024)
+            assert_equal({"runs": runs + 2},
+                         self.schedule([CachedMock], 1)["cached"])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_isolated(self):
+        results = self.schedule([BehaviorMock, TargetMock], 2,
+                                {"isolate": True, "timeout": 10})
+        assert_equal(["behavior", "target"], sorted(results))
+        assert_equal({"target": results["target"]},
+                     results["behavior"]["results"])
+
+
+class ReportMock(Report):
+    delay = 0
+    mutates_results = True
+
+    def run(self, results):
+        time.sleep(self.delay)
+        results[self.__class__.__name__] = True
+        self.seen = sorted(results)
+        self.thread = threading.current_thread().name
+
+
+class SlowReportMock(ReportMock):
+    delay = 0.2
+
+
+class HangingReportMock(ReportMock):
+    delay = 5
+
+
+class LaterReportMock(ReportMock):
+    order = 2
+
+
+class NestedReportMock(ReportMock):
+    def run(self, results):
+        results["info"]["altered"] = True
+        ReportMock.run(self, results)
+
+
+class ReaderReportMock(ReportMock):
+    mutates_results = False
+
+    def run(self, results):
+        self.results = results
+
+
+class TestRunReporting:
+    def setUp(self):
+        # Don't touch the database, the modules are given directly.
+        self.r = RunReporting.__new__(RunReporting)
+        self.r.results = {"info": {}}
+        self.r.timeout = 0
+
+    def schedule(self, modules, concurrent, timeout=None, isolate=False):
+        self.r.concurrent = concurrent
+        instances = []
+        for module in modules:
+            current = module()
+            current.set_options(Dictionary())
+            current.options.timeout = timeout
+            current.options.isolate = isolate
+            instances.append(current)
+        self.r.schedule(instances)
+        return instances
+
+    def test_concurrent(self):
+        slow, fast, later = self.schedule([SlowReportMock, ReportMock,
+                                           LaterReportMock], True)
+        # Every module changing the results gets its own copy.
+        assert_equal(["SlowReportMock", "info"], slow.seen)
+        assert_equal(["ReportMock", "info"], fast.seen)
+        assert_equal(["LaterReportMock", "info"], later.seen)
+        assert slow.thread != fast.thread
+        assert "SlowReportMock" not in self.r.results
+        assert "ReportMock" not in self.r.results
+
+    def test_concurrent_nested(self):
+        self.schedule([NestedReportMock, SlowReportMock], True)
+        assert_equal({"info": {}}, self.r.results)
+
+    def test_concurrent_shared(self):
+        first, second, copied = self.schedule([ReaderReportMock,
+                                               ReaderReportMock,
+                                               ReportMock], True)
+        assert first.results is self.r.results
+        assert second.results is self.r.results
+        assert_equal(["ReportMock", "info"], copied.seen)
+        assert "ReportMock" not in self.r.results
+
+    def test_sequential(self):
+        first, second = self.schedule([ReportMock, SlowReportMock], False)
+        assert_equal(["ReportMock", "info"], first.seen)
+        assert_equal(["ReportMock", "SlowReportMock", "info"], second.seen)
+        # Run inline, one after another.
+        assert_equal(threading.current_thread().name, first.thread)
+        assert_equal(threading.current_thread().name, second.thread)
+
+    def test_network_sinks_isolated(self):
+        # Their timeouts are only enforced when isolated.
+        cfg = Config(os.path.join(CUCKOO_ROOT, "conf", "reporting.conf"))
+        for name in ("mongodb", "hpfclient"):
+            assert cfg.get(name).isolate
+            assert cfg.get(name).timeout
+
+    def test_timeout(self):
+        tmp = tempfile.mkstemp(suffix=".db")[1]
+        Singleton._instances.pop(Database, None)
+        db = Database(dsn="sqlite:///%s" % tmp)
+        try:
+            self.r.task = {"id": db.add_url("http://www.cuckoosandbox.org")}
+            start = time.time()
+            self.schedule([HangingReportMock, SlowReportMock], True,
+                          timeout=0.5, isolate=True)
+            assert time.time() - start < 2
+            errors = db.view_errors(self.r.task["id"])
+            assert_equal(1, len(errors))
+            assert "HangingReportMock" in errors[0].message
+        finally:
+            db.engine.dispose()
+            Singleton._instances.pop(Database, None)
+            os.remove(tmp)
+
+    def test_timeout_not_isolated(self):
+        # A module which isn't isolated can't be stopped, the later ones
+        # mustn't run along with it on the same results.
+        for concurrent in (True, False):
+            self.r.results = {"info": {}}
+            slow, later = self.schedule([SlowReportMock, LaterReportMock],
+                                        concurrent, timeout=0.05)
+            assert_equal(["SlowReportMock", "info"], slow.seen)
+            assert_equal(["LaterReportMock", "SlowReportMock", "info"],
+                         later.seen)
+
+
+class TestRunIsolated:
+    def test_result(self):
+        assert_equal({"foo": [1, 2]}, run_isolated(lambda: {"foo": [1, 2]}))
+
+    @raises(CuckooProcessingError)
+    def test_exception(self):
+        def fail():
+            raise CuckooProcessingError("Failed")
+        run_isolated(fail)
+
+    @raises(CuckooModuleLimitError)
+    def test_timeout(self):
+        run_isolated(lambda: time.sleep(5), timeout=0.2)
+
+    @raises(CuckooModuleLimitError)
+    def test_max_memory(self):
+        def allocate():
+            data = []
+            for _ in range(100):
+                data.append(" " * 1024 * 1024)
+                time.sleep(0.01)
+        run_isolated(allocate, max_memory=16)
+
+    def test_max_memory_unmeasurable(self):
+        can_measure_rss = plugins.can_measure_rss
+        plugins.can_measure_rss = lambda: False
+        plugins._rss_warned = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        plugins.log.addHandler(handler)
+        try:
+            for _ in range(2):
+                assert_equal(1, run_isolated(lambda: 1, max_memory=16))
+        finally:
+            plugins.can_measure_rss = can_measure_rss
+            plugins.log.removeHandler(handler)
+        # Warned about once only.
+        assert_equal([logging.WARNING], [record.levelno for record in records])
+
+    @raises(CuckooModuleLimitError)
+    def test_died(self):
+        run_isolated(lambda: os._exit(1))
+
+    @raises(CuckooOperationalError)
+    def test_system_exit(self):
+        run_isolated(lambda: sys.exit(1))
+
+    def test_logging_lock(self):
+        # Another thread holds the lock of a handler while forking.
+        handler = logging.StreamHandler(open(os.devnull, "w"))
+        logging.getLogger().addHandler(handler)
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            with handler.lock:
+                locked.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        try:
+            assert_equal(1, run_isolated(lambda: logging.getLogger().error("foo") or 1,
+                                         timeout=5))
+        finally:
+            release.set()
+            thread.join()
+            logging.getLogger().removeHandler(handler)
+            handler.stream.close()
+
+    def test_database_connections(self):
+        tmp = tempfile.mkstemp(suffix=".db")[1]
+        Singleton._instances.pop(Database, None)
+        db = Database(dsn="sqlite:///%s" % tmp)
+        try:
+            task_id = db.add_url("http://www.cuckoosandbox.org")
+            # The child doesn't use the connections of the parent's pool.
+            pool = id(db.engine.pool)
+            assert pool != run_isolated(lambda: id(db.engine.pool))
+            assert_equal("http://www.cuckoosandbox.org",
+                         run_isolated(lambda: db.view_task(task_id).target))
+        finally:
+            db.engine.dispose()
+            Singleton._instances.pop(Database, None)
+            os.remove(tmp)
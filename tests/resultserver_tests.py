@@ -0,0 +1,676 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import json
+import time
+import signal
+import logging
+import shutil
+import socket
+import struct
+import tempfile
+from nose.tools import assert_equal
+
+from lib.cuckoo.common.logtbl import table
+from lib.cuckoo.common.objects import Dictionary, File, Hasher
+from lib.cuckoo.common.utils import UPLOADS_MANIFEST, BEHAVIOR_SUMMARY
+from lib.cuckoo.common.utils import delete_analysis_folder
+from lib.cuckoo.core import resultserver
+from lib.cuckoo.core.resultserver import ReceiveBuffer, ResultserverBase
+from lib.cuckoo.core.resultserver import EventResulthandler
+from lib.cuckoo.core.resultserver import EventResultserver
+from lib.cuckoo.core.resultserver import ProcessAggregator, BehaviorAggregator
+from lib.cuckoo.core.resultserver import ResultserverStats
+from lib.cuckoo.core.resultserver import ResultserverWorkers
+
+
+def make_cfg(**options):
+    cfg = Dictionary()
+    cfg.resultserver = Dictionary(options)
+    return cfg
+
+
+class SocketMock(object):
+    """Hands out the given chunks one recv_into() at a time, then reports
+    the connection as closed."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.closed = False
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        if len(chunk) > len(view):
+            self.chunks.insert(0, chunk[len(view):])
+            chunk = chunk[:len(view)]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        self.closed = True
+
+
+class TaskMock(object):
+    id = 1
+
+
+class MachineMock(object):
+    ip = "127.0.0.1"
+
+
+class ServerMock(ResultserverBase):
+    """Event loop engine without the event loop, the connections are fed
+    by hand and the analysis is stored in a temporary folder."""
+
+    def __init__(self, cfg, storagepath):
+        ResultserverBase.__init__(self, cfg)
+        self.storagepath = storagepath
+        self.ended = []
+        self.removed = []
+        self.add_task(TaskMock(), MachineMock())
+
+    def build_storage_path(self, ip):
+        if not self.get_ctx_for_ip(ip)[0]:
+            return False
+        return self.storagepath
+
+    def remove(self, handler):
+        self.removed.append(handler)
+
+    def wakeup(self):
+        pass
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+
+def netlog_string(value):
+    return struct.pack("<I", len(value)) + value
+
+
+def api_index(apiname):
+    return [entry[0] for entry in table].index(apiname)
+
+
+# 2014-01-01 00:00:00 as a FILETIME.
+FILETIME = 130330080000000000
+
+NETLOG = (
+    struct.pack("<BBIIIIIII", 0, 1, 0, 5, 0, FILETIME & 0xffffffff,
+                FILETIME >> 32, 1234, 4) +
+    netlog_string("C:\\WINDOWS\\a.exe") +
+    struct.pack("<BBIIII", 1, 1, 0, 6, 0, 1234) +
+    struct.pack("<BBIII", api_index("LdrGetDllHandle"), 1, 0, 6, 0) +
+    netlog_string("kernel32.dll") + struct.pack("<I", 0x7c800000))
+
+
+class TestReceiveBuffer:
+    def test_partial_reads(self):
+        rbuf = ReceiveBuffer(size=8)
+        sock = SocketMock(["ab", "c\nde"])
+        rbuf.fill(sock)
+        assert_equal(-1, rbuf.find("\n"))
+        rbuf.fill(sock)
+        assert_equal(3, rbuf.find("\n"))
+        assert_equal("abc\n", rbuf.read(4))
+        assert_equal(2, len(rbuf))
+        assert_equal("de", rbuf.read(2))
+
+    def test_compaction(self):
+        rbuf = ReceiveBuffer(size=8)
+        sock = SocketMock(["abcdefgh", "ijkl"])
+        rbuf.fill(sock)
+        assert_equal("abcde", rbuf.read(5))
+        # The unread data is moved to the front instead of growing.
+        rbuf.fill(sock)
+        assert_equal(8, len(rbuf.buf))
+        assert_equal(0, rbuf.start)
+        assert_equal("fghijk", rbuf.read(6))
+        assert_equal("l", rbuf.read(1))
+
+    def test_large_message(self):
+        rbuf = ReceiveBuffer(size=8)
+        sock = SocketMock(["abcdefgh", "ijkl", "m"])
+        rbuf.fill(sock)
+        rbuf.fill(sock)
+        assert_equal(16, len(rbuf.buf))
+        assert_equal("abcdefghijkl", rbuf.read(12))
+        # Back to its usual size once it's been read.
+        rbuf.fill(sock)
+        assert_equal(8, len(rbuf.buf))
+        assert_equal("m", rbuf.read(1))
+
+
+class TestEventResulthandler:
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = ServerMock(make_cfg(aggregate_behavior=True),
+                                 self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def connect(self, chunks):
+        handler = EventResulthandler(SocketMock(chunks),
+                                     ("127.0.0.1", 1024), self.server)
+        assert handler.start()
+        while not handler.closed:
+            handler.handle_read()
+        return handler
+
+    def test_message_cut_everywhere(self):
+        data = "NETLOG\n" + NETLOG
+        for offset in xrange(1, len(data)):
+            self.server = ServerMock(make_cfg(aggregate_behavior=True),
+                                     self.tmp)
+            handler = self.connect([data[:offset], data[offset:]])
+            assert handler.done_event.isSet()
+
+            # Every message handled once, whatever the cut.
+            processes = self.server.behaviors[1].processes_summary()
+            assert_equal(1, len(processes))
+            assert_equal([6], processes[0]["threads"])
+            assert_equal({"LdrGetDllHandle": 1}, processes[0]["api_calls"])
+            with open(os.path.join(self.tmp, "logs", "1234.raw"), "rb") as f:
+                assert_equal(NETLOG, f.read())
+
+    def test_closed_mid_message(self):
+        data = "NETLOG\n" + NETLOG
+        handler = self.connect([data[:-3]])
+        assert handler.request.closed
+        assert handler.done_event.isSet()
+        assert_equal([handler], self.server.removed)
+        # The complete messages have been handled, the last one is dropped.
+        process = self.server.behaviors[1].processes_summary()[0]
+        assert_equal({}, process["api_calls"])
+        assert_equal(0, self.server.stats.snapshot()["total"]["handlers_active"])
+
+    def test_unknown_machine(self):
+        handler = EventResulthandler(SocketMock([]), ("127.0.0.2", 1024),
+                                     self.server)
+        assert not handler.start()
+        assert handler.request.closed
+
+
+class TestHasher:
+    def setUp(self):
+        self.tmp = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.tmp[1])
+
+    def test_hashes(self):
+        hasher = Hasher()
+        hasher.update("foo")
+        hasher.update("bar")
+        hashes = hasher.hashes()
+        assert_equal("3858f62230ac3c915f300c664312c63f", hashes["md5"])
+        with open(self.tmp[1], "wb") as f:
+            f.write("foobar")
+        assert_equal(hashes["sha512"], File(self.tmp[1]).get_sha512())
+        assert_equal(hashes["crc32"], File(self.tmp[1]).get_crc32())
+
+    def test_preloaded_hashes(self):
+        hashes = dict(crc32="a", md5="b", sha1="c", sha256="d", sha512="e")
+        assert_equal("d", File(self.tmp[1], hashes=hashes).get_sha256())
+
+
+class TestFileUpload:
+    def setUp(self):
+        # The files store lives in CUCKOO_ROOT/storage/files.
+        self.root = tempfile.mkdtemp()
+        self.cuckoo_root = resultserver.CUCKOO_ROOT
+        resultserver.CUCKOO_ROOT = self.root
+        self.tmp = os.path.join(self.root, "analysis")
+        os.mkdir(self.tmp)
+        self.server = ServerMock(make_cfg(upload_max_size=1024), self.tmp)
+
+    def tearDown(self):
+        resultserver.CUCKOO_ROOT = self.cuckoo_root
+        shutil.rmtree(self.root)
+
+    def upload(self, path, data, server=None):
+        handler = EventResulthandler(SocketMock(["FILE\n%s\n" % path, data]),
+                                     ("127.0.0.1", 1024),
+                                     server or self.server)
+        assert handler.start()
+        while not handler.closed:
+            handler.handle_read()
+
+    def manifest(self):
+        with open(os.path.join(self.tmp, UPLOADS_MANIFEST), "rb") as f:
+            return [json.loads(line) for line in f]
+
+    def test_manifest(self):
+        self.upload("files/1/a.bin", "foobar")
+        self.upload("files\\2\\b.bin", "foo")
+        entries = self.manifest()
+        assert_equal(["files/1/a.bin", "files/2/b.bin"],
+                     [entry["path"] for entry in entries])
+        assert_equal([6, 3], [entry["size"] for entry in entries])
+
+        hasher = Hasher()
+        hasher.update("foobar")
+        for name, value in hasher.hashes().items():
+            assert_equal(value, entries[0][name])
+        with open(os.path.join(self.tmp, "files", "2", "b.bin"), "rb") as f:
+            assert_equal("foo", f.read())
+
+        snapshot = self.server.stats.snapshot()["total"]
+        assert_equal(2, snapshot["files_uploaded"])
+        assert_equal(9, snapshot["files_bytes"])
+
+    def test_truncated(self):
+        self.upload("files/a.bin", "x" * 2048)
+        entry = self.manifest()[0]
+        assert entry["size"] >= 1024
+        with open(os.path.join(self.tmp, "files", "a.bin"), "rb") as f:
+            assert f.read().endswith("... (truncated)")
+        assert_equal(1, self.server.stats.snapshot()["total"]["files_truncated"])
+
+    def test_dedupe(self):
+        self.upload("files/a.bin", "foobar")
+        self.upload("files/b.bin", "foobar")
+        self.upload("files/c.bin", "other")
+        sha256 = self.manifest()[0]["sha256"]
+
+        stored = os.stat(os.path.join(self.root, "storage", "files", sha256))
+        assert_equal(3, stored.st_nlink)
+        for name in ("a.bin", "b.bin"):
+            path = os.path.join(self.tmp, "files", name)
+            assert_equal(stored.st_ino, os.stat(path).st_ino)
+        assert_equal(2, len(os.listdir(os.path.join(self.root, "storage",
+                                                    "files"))))
+
+    def test_dedupe_dropped_only(self):
+        self.upload("shots/0001.jpg", "foobar")
+        self.upload("memory/1.dmp", "foobar")
+        assert not os.path.exists(os.path.join(self.root, "storage", "files"))
+
+    def test_delete_analysis_folder(self):
+        other = os.path.join(self.root, "other")
+        os.mkdir(other)
+        self.upload("files/a.bin", "foobar")
+        self.upload("files/b.bin", "other")
+        self.upload("files/a.bin", "foobar",
+                    ServerMock(make_cfg(upload_max_size=1024), other))
+        store = os.path.join(self.root, "storage", "files")
+        sha256 = self.manifest()[0]["sha256"]
+
+        # The file dropped by the other analysis too is kept.
+        delete_analysis_folder(self.tmp, store)
+        assert not os.path.exists(self.tmp)
+        assert_equal([sha256], os.listdir(store))
+        assert_equal(2, os.stat(os.path.join(store, sha256)).st_nlink)
+
+        delete_analysis_folder(other, store)
+        assert_equal([], os.listdir(store))
+
+    def test_overwrite_stored(self):
+        # Uploading again to the same path must not write through the
+        # hard link into the files store.
+        self.upload("files/a.bin", "foobar")
+        self.upload("files/a.bin", "other")
+        sha256 = self.manifest()[0]["sha256"]
+        with open(os.path.join(self.root, "storage", "files", sha256),
+                  "rb") as f:
+            assert_equal("foobar", f.read())
+        with open(os.path.join(self.tmp, "files", "a.bin"), "rb") as f:
+            assert_equal("other", f.read())
+
+    def test_banned_path(self):
+        self.upload("../a.bin", "foobar")
+        assert not os.path.exists(os.path.join(self.root, "a.bin"))
+        assert not os.path.exists(os.path.join(self.tmp, UPLOADS_MANIFEST))
+
+
+class TestLogHandler:
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def connect(self, chunks, **options):
+        server = ServerMock(make_cfg(**options), self.tmp)
+        handler = EventResulthandler(SocketMock(chunks), ("127.0.0.1", 1024),
+                                     server)
+        assert handler.start()
+        return handler
+
+    def read_log(self):
+        with open(os.path.join(self.tmp, "analysis.log"), "rb") as f:
+            return f.read()
+
+    def test_flush_size(self):
+        handler = self.connect(["LOG\nfoo\n", "bar\n", "foobar\n"],
+                               log_flush_size=10, log_flush_interval=60)
+        handler.handle_read()
+        assert_equal("", self.read_log())
+        handler.handle_read()
+        assert_equal("", self.read_log())
+        handler.handle_read()
+        assert_equal("foo\nbar\nfoobar\n", self.read_log())
+
+    def test_flush_interval(self):
+        handler = self.connect(["LOG\nfoo\n"], log_flush_size=1024,
+                               log_flush_interval=1)
+        handler.handle_read()
+        assert_equal("", self.read_log())
+        handler.protocol.buffered_since -= 1
+        handler.tick()
+        assert_equal("foo\n", self.read_log())
+
+    def test_close(self):
+        handler = self.connect(["LOG\nfoo\n"], log_flush_size=1024,
+                               log_flush_interval=60)
+        handler.handle_read()
+        handler.handle_read()
+        assert handler.closed
+        assert_equal("foo\n", self.read_log())
+
+    def test_max_size(self):
+        handler = self.connect(["LOG\nfoo\nbar\n", "foobar\n", "baz\n"],
+                               log_max_size=10)
+        while not handler.closed:
+            handler.handle_read()
+        assert_equal("foo\nbar\n... (truncated)\n", self.read_log())
+
+        # The cap holds for the task across reconnections.
+        handler = self.connect(["LOG\nfoo\n"], log_max_size=10)
+        while not handler.closed:
+            handler.handle_read()
+        assert_equal("foo\nbar\n... (truncated)\n", self.read_log())
+
+
+class TestBehaviorAggregator:
+    def test_process(self):
+        process = ProcessAggregator("2014-01-01 00:00:00,000", 1234, 4,
+                                    "C:\\a.exe", "a.exe")
+        process.add_thread(6)
+        process.add_call(7, "NtCreateFile", [("FileName", "C:\\b.txt"),
+                                             ("FileHandle", "0x10")])
+        process.add_call(7, "NtCreateFile", [("FileName", "C:\\b.txt")])
+        process.add_call(6, "RegOpenKeyExA", [("SubKey", "Software")])
+        process.add_call(6, "NtOpenKey", [("ObjectAttributes", "HKLM\\a")])
+        process.add_call(6, "NtOpenFile", [("ObjectAttributes", "C:\\c")])
+        process.add_call(6, "NtCreateMutant", [("MutexName", "")])
+        summary = process.to_dict()
+        assert_equal([6, 7], summary["threads"])
+        assert_equal({"NtCreateFile": 2, "RegOpenKeyExA": 1, "NtOpenKey": 1,
+                      "NtOpenFile": 1, "NtCreateMutant": 1},
+                     summary["api_calls"])
+        assert_equal({"files": ["C:\\b.txt"],
+                      "keys": ["HKLM\\a", "Software"],
+                      "mutexes": []}, summary["summary"])
+        json.dumps(summary)
+
+    def test_processes(self):
+        behavior = BehaviorAggregator()
+        behavior.add_process("", 1, 0, "a.exe", "a.exe")
+        behavior.add_process("", 2, 1, "b.exe", "b.exe")
+        assert_equal([1, 2], [process["process_id"]
+                              for process in behavior.processes_summary()])
+
+
+class TestBehaviorSummary:
+    def setUp(self):
+        # The summary is written to CUCKOO_ROOT/storage/analyses/<id>.
+        self.root = tempfile.mkdtemp()
+        self.cuckoo_root = resultserver.CUCKOO_ROOT
+        resultserver.CUCKOO_ROOT = self.root
+        self.tmp = os.path.join(self.root, "storage", "analyses", "1")
+        os.makedirs(self.tmp)
+
+    def tearDown(self):
+        resultserver.CUCKOO_ROOT = self.cuckoo_root
+        shutil.rmtree(self.root)
+
+    def test_del_task(self):
+        server = ServerMock(make_cfg(aggregate_behavior=True), self.tmp)
+        handler = EventResulthandler(SocketMock(["NETLOG\n" + NETLOG]),
+                                     ("127.0.0.1", 1024), server)
+        assert handler.start()
+        while not handler.closed:
+            handler.handle_read()
+        server.del_task(TaskMock(), MachineMock())
+        assert_equal({}, server.behaviors)
+
+        with open(os.path.join(self.tmp, BEHAVIOR_SUMMARY), "rb") as f:
+            behavior = json.load(f)
+        assert_equal(1, len(behavior["processes"]))
+        process = behavior["processes"][0]
+        assert_equal(1234, process["process_id"])
+        assert_equal("a.exe", process["process_name"])
+        assert_equal("2014-01-01 00:00:00,000", process["first_seen"])
+        assert_equal({"LdrGetDllHandle": 1}, process["api_calls"])
+        assert_equal(["kernel32.dll"], behavior["summary"]["files"])
+
+    def test_disabled(self):
+        server = ServerMock(make_cfg(), self.tmp)
+        server.del_task(TaskMock(), MachineMock())
+        assert not os.path.exists(os.path.join(self.tmp, BEHAVIOR_SUMMARY))
+
+
+class TestResultserverStats:
+    def setUp(self):
+        self.stats = ResultserverStats()
+
+    def test_counters(self):
+        self.stats.add_task(1)
+        self.stats.handler_started(1)
+        self.stats.handler_started(None)
+        self.stats.received(1, "BSON", 100)
+        self.stats.received(1, "BSON", 50)
+        self.stats.received(None, "UNKNOWN", 10)
+        self.stats.file_uploaded(1, 1000, False)
+        self.stats.file_uploaded(1, 2000, True)
+        self.stats.handler_finished(1, 2.5)
+
+        snapshot = self.stats.snapshot()
+        total = snapshot["total"]
+        assert_equal(1, total["handlers_active"])
+        assert_equal(2, total["handlers"])
+        assert_equal(2.5, total["handlers_lifetime"])
+        assert_equal({"BSON": 150, "UNKNOWN": 10}, total["bytes"])
+        assert_equal(2, total["files_uploaded"])
+        assert_equal(3000, total["files_bytes"])
+        assert_equal(1, total["files_truncated"])
+
+        # Connections of unknown machines only count globally.
+        task = snapshot["tasks"]["1"]
+        assert_equal(0, task["handlers_active"])
+        assert_equal({"BSON": 150}, task["bytes"])
+        assert "added" not in task
+
+    def test_rates(self):
+        def rate(snapshot):
+            return round(snapshot["bytes_per_sec"]["BSON"])
+
+        self.stats.add_task(1)
+        self.stats.received(1, "BSON", 100)
+        self.stats.last_time -= 10
+        assert_equal(10, rate(self.stats.snapshot()["total"]))
+
+        # Since the previous snapshot.
+        self.stats.received(1, "BSON", 100)
+        self.stats.last_time -= 10
+        assert_equal(10, rate(self.stats.snapshot()["total"]))
+
+        # Since the task was added.
+        self.stats.tasks[1]["added"] -= 20
+        assert_equal(10, rate(self.stats.snapshot()["tasks"]["1"]))
+
+    def test_del_task(self):
+        self.stats.add_task(1)
+        self.stats.del_task(1, 1.5)
+        self.stats.del_task(2, 0.5)
+        snapshot = self.stats.snapshot()
+        assert_equal({}, snapshot["tasks"])
+        assert_equal(2, snapshot["total"]["del_task_calls"])
+        assert_equal(2.0, snapshot["total"]["del_task_wait"])
+
+    def test_handler(self):
+        server = ServerMock(make_cfg(), tempfile.mkdtemp())
+        try:
+            handler = EventResulthandler(SocketMock(["LO", "G\nfoo\n"]),
+                                         ("127.0.0.1", 1024), server)
+            assert handler.start()
+            while not handler.closed:
+                handler.handle_read()
+        finally:
+            shutil.rmtree(server.storagepath)
+
+        task = server.stats.snapshot()["tasks"]["1"]
+        assert_equal({"LOG": 8}, task["bytes"])
+        assert_equal(1, task["handlers"])
+        assert_equal(0, task["handlers_active"])
+
+
+class EventResultserverMock(EventResultserver):
+    def __init__(self, cfg, storagepath):
+        self.storagepath = storagepath
+        EventResultserver.__init__(self, cfg)
+
+    def build_storage_path(self, ip):
+        if not self.get_ctx_for_ip(ip)[0]:
+            return False
+        return self.storagepath
+
+
+class TestEventResultserver:
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cfg = make_cfg(ip="127.0.0.1", port=free_port())
+        self.server = EventResultserverMock(self.cfg, self.tmp)
+        self.server.add_task(TaskMock(), MachineMock())
+
+    def tearDown(self):
+        self.server.socket.close()
+        shutil.rmtree(self.tmp)
+
+    def connect(self, data):
+        client = socket.create_connection(("127.0.0.1",
+                                           self.cfg.resultserver.port))
+        client.sendall(data)
+        wait_for(lambda: self.server.analysishandlers[1])
+        return client, self.server.analysishandlers[1][-1]
+
+    def read_log(self):
+        with open(os.path.join(self.tmp, "analysis.log"), "rb") as f:
+            return f.read()
+
+    def test_disconnect(self):
+        client, handler = self.connect("LOG\nfoo\n")
+        wait_for(lambda: handler.protocol)
+        client.close()
+        wait_for(handler.done_event.isSet)
+        assert_equal({}, self.server.connections)
+        assert_equal("foo\n", self.read_log())
+
+    def test_del_task(self):
+        client, handler = self.connect("LOG\nfoo\n")
+        wait_for(lambda: handler.protocol)
+        # The connection is still open, del_task() has to end it.
+        self.server.del_task(TaskMock(), MachineMock())
+        assert handler.done_event.isSet()
+        client.settimeout(5)
+        assert_equal("", client.recv(1))
+        client.close()
+        assert_equal({}, self.server.connections)
+        assert_equal("foo\n", self.read_log())
+
+    def test_unknown_machine(self):
+        self.server.del_task(TaskMock(), MachineMock())
+        client = socket.create_connection(("127.0.0.1",
+                                           self.cfg.resultserver.port))
+        client.settimeout(5)
+        assert_equal("", client.recv(1))
+        client.close()
+        assert_equal({}, self.server.connections)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestResultserverWorkers:
+    def setUp(self):
+        # The workers store the analyses in CUCKOO_ROOT/storage/analyses.
+        self.root = tempfile.mkdtemp()
+        self.cuckoo_root = resultserver.CUCKOO_ROOT
+        resultserver.CUCKOO_ROOT = self.root
+        os.makedirs(resultserver.task_storage_path(1))
+
+        self.log = RecordingHandler()
+        resultserver.log.addHandler(self.log)
+
+        self.cfg = make_cfg(ip="127.0.0.1", port=free_port(), workers=2)
+        self.workers = ResultserverWorkers(self.cfg, "events", 2)
+
+    def tearDown(self):
+        self.workers.stop()
+        resultserver.log.removeHandler(self.log)
+        resultserver.CUCKOO_ROOT = self.cuckoo_root
+        shutil.rmtree(self.root)
+
+    def critical(self):
+        return [record for record in self.log.records
+                if record.levelno == logging.CRITICAL]
+
+    def test_task(self):
+        self.workers.add_task(TaskMock(), MachineMock())
+        stats = self.workers.get_stats()
+        assert_equal(2, stats["workers"])
+        assert_equal(["1"], stats["tasks"].keys())
+
+        client = socket.create_connection(("127.0.0.1",
+                                           self.cfg.resultserver.port))
+        client.sendall("LOG\nfoo\n")
+        client.close()
+        wait_for(lambda: self.workers.get_stats()["total"]["bytes"])
+        self.workers.del_task(TaskMock(), MachineMock())
+
+        stats = self.workers.get_stats()
+        assert_equal({}, stats["tasks"])
+        assert_equal({"LOG": 8}, stats["total"]["bytes"])
+        assert_equal(2, stats["total"]["del_task_calls"])
+        path = os.path.join(resultserver.task_storage_path(1), "analysis.log")
+        with open(path, "rb") as f:
+            assert_equal("foo\n", f.read())
+
+    def test_stop(self):
+        self.workers.stop()
+        for process in self.workers.processes:
+            assert not process.is_alive()
+        assert_equal([], self.critical())
+        assert_equal(0, self.workers.get_stats()["workers"])
+
+    def test_worker_exited(self):
+        os.kill(self.workers.processes[0].pid, signal.SIGKILL)
+        wait_for(lambda: self.critical())
+        assert_equal(1, self.workers.get_stats()["workers"])
@@ -0,0 +1,212 @@
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import time
+import Queue
+import signal
+import tempfile
+import threading
+from nose.tools import assert_equal
+
+from lib.cuckoo.common.utils import Singleton
+from lib.cuckoo.core import scheduler
+from lib.cuckoo.core.database import Database, TASK_PENDING, TASK_RUNNING
+from lib.cuckoo.core.database import TASK_COMPLETED, TASK_REPORTED
+from lib.cuckoo.core.database import TASK_FAILED_PROCESSING, lease_owner
+from lib.cuckoo.core.scheduler import AnalysisPool, ProcessingPool, Scheduler
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+
+class ManagerMock(object):
+    """Runs no analysis, only holds its slot until released."""
+
+    release = None
+    started = []
+
+    def __init__(self, task, error_queue):
+        self.task = task
+
+    def run(self):
+        ManagerMock.started.append(self.task.id)
+        ManagerMock.release.wait(5)
+
+
+class BrokenManagerMock(ManagerMock):
+    def __init__(self, task, error_queue):
+        raise Exception("Broken")
+
+
+class ProcessingManagerMock(object):
+    """Fails processing the tasks of failing targets, the others get a
+    Ctrl-C while being processed."""
+
+    def __init__(self, task, error_queue):
+        self.task = task
+
+    def process_results(self):
+        if "fail" in self.task.target:
+            raise Exception("Failed")
+        os.kill(os.getpid(), signal.SIGINT)
+
+
+class ProcessingPoolMock(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, task, storage, binary):
+        self.submitted.append(task.id)
+
+
+class TaskMock(object):
+    def __init__(self, task_id):
+        self.id = task_id
+
+
+class DatabaseTest(object):
+    def setUp(self):
+        self.tmp = tempfile.mkstemp(suffix=".db")[1]
+        Singleton._instances.pop(Database, None)
+        self.db = Database(dsn="sqlite:///%s" % self.tmp)
+
+        ManagerMock.release = threading.Event()
+        ManagerMock.started = []
+        self.manager = scheduler.AnalysisManager
+
+        self.pools = []
+
+    def pool(self, size):
+        pool = AnalysisPool(size, Queue.Queue())
+        self.pools.append(pool)
+        return pool
+
+    def tearDown(self):
+        ManagerMock.release.set()
+        for pool in self.pools:
+            wait_for(lambda: pool.available() == pool.size)
+        scheduler.AnalysisManager = self.manager
+        self.db.engine.dispose()
+        # Left as the singleton, the late notifications of the workers go to
+        # it instead of creating a default database.
+        os.remove(self.tmp)
+
+
+class TestAnalysisPool(DatabaseTest):
+    def test_slots(self):
+        scheduler.AnalysisManager = ManagerMock
+        pool = self.pool(2)
+        assert pool.submit(TaskMock(1))
+        assert pool.submit(TaskMock(2))
+        assert not pool.submit(TaskMock(3))
+        assert_equal(2, pool.busy())
+        assert_equal(0, pool.available())
+        assert_equal(2, pool.total())
+
+        wait_for(lambda: len(ManagerMock.started) == 2)
+        ManagerMock.release.set()
+        wait_for(lambda: pool.available() == 2)
+        assert_equal(0, pool.busy())
+        # The scheduler is woken up for the free slots.
+        assert self.db.wait_for_tasks(timeout=5)
+
+    def test_broken_manager(self):
+        scheduler.AnalysisManager = BrokenManagerMock
+        pool = self.pool(1)
+        for task_id in range(3):
+            assert pool.submit(TaskMock(task_id))
+            wait_for(lambda: pool.available() == 1)
+
+        # The worker survived and still runs analyses.
+        scheduler.AnalysisManager = ManagerMock
+        assert pool.submit(TaskMock(3))
+        wait_for(lambda: ManagerMock.started == [3])
+
+
+class TestDispatch(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        scheduler.AnalysisManager = ManagerMock
+        # Not started, the tasks are dispatched by hand.
+        self.s = Scheduler()
+        self.s.pool = self.pool(2)
+
+    def test_backpressure(self):
+        ids = [self.db.add_url("http://%d.example.com" % i) for i in range(5)]
+        self.s.dispatch()
+        # Only as many tasks as there are free workers are leased.
+        assert_equal(ids[:2], [task.id for task in
+                               self.db.list_tasks(status=TASK_RUNNING)][::-1])
+        assert_equal(3, self.db.count_tasks(TASK_PENDING))
+        wait_for(lambda: len(ManagerMock.started) == 2)
+
+        self.s.dispatch()
+        assert_equal(3, self.db.count_tasks(TASK_PENDING))
+
+        ManagerMock.release.set()
+        wait_for(lambda: self.s.pool.available() == 2)
+        ManagerMock.release.clear()
+        self.s.dispatch()
+        assert_equal(1, self.db.count_tasks(TASK_PENDING))
+
+    def test_maxcount(self):
+        for i in range(3):
+            self.db.add_url("http://%d.example.com" % i)
+        self.s.dispatch(maxcount=1)
+        assert_equal(1, self.s.pool.total())
+        assert_equal(2, self.db.count_tasks(TASK_PENDING))
+
+
+class TestProcessingPool(DatabaseTest):
+    def test_process(self):
+        scheduler.AnalysisManager = ProcessingManagerMock
+        ok = self.db.add_url("http://ok.example.com")
+        failing = self.db.add_url("http://fail.example.com")
+        pool = ProcessingPool(2)
+        for task_id in (ok, failing):
+            self.db.set_status(task_id, TASK_COMPLETED)
+            pool.submit(self.db.view_task(task_id), "", "")
+
+        # Drained on stop.
+        pool.stop()
+        assert_equal(0, pool.depth())
+        assert_equal(0, pool.active())
+        assert_equal(TASK_REPORTED, self.db.view_task(ok).status)
+        assert_equal(TASK_FAILED_PROCESSING,
+                     self.db.view_task(failing).status)
+
+
+class TestRequeueCompleted(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        scheduler.processing_pool = ProcessingPoolMock()
+
+    def tearDown(self):
+        scheduler.processing_pool = None
+        DatabaseTest.tearDown(self)
+
+    def test_requeue(self):
+        ids = [self.db.add_url("http://%d.example.com" % i) for i in range(5)]
+        # Still being processed by this very process.
+        self.db.fetch_batch(2, lease_owner())
+        # Left behind by a scheduler which went away.
+        self.db.fetch_batch(3, "gone")
+        for task_id in ids:
+            self.db.set_status(task_id, TASK_COMPLETED)
+
+        s = Scheduler()
+        s.requeue_page = 2
+        s.requeue_completed()
+        assert_equal(ids[2:], scheduler.processing_pool.submitted)
+        for task_id in ids[2:]:
+            assert_equal(s.owner, self.db.view_task(task_id).lease_owner)
+
+        # Taken over already.
+        s.requeue_completed()
+        assert_equal(ids[2:], scheduler.processing_pool.submitted)
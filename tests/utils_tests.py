@@ -3,6 +3,7 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import struct
 import tempfile
 from nose.tools import assert_equal, raises, assert_not_equal
 from lib.cuckoo.common.objects import File
@@ -127,3 +128,38 @@ class TestFile:
 
     def tearDown(self):
         os.remove(self.tmp[1])
+
+class TestOpenLog:
+    def setUp(self):
+        self.path = tempfile.mkstemp()[1]
+        self.data = "".join(chr(i % 7 + 65) * (i % 13) for i in range(30000))
+
+    def test_plain(self):
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        assert_equal(self.data, utils.open_log(self.path).read())
+
+    def test_compressed(self):
+        os.remove(self.path)
+        f = utils.BlockGzipFile(self.path + ".gz")
+        f.write(self.data[:100])
+        f.write(self.data[100:])
+        f.close()
+        assert_equal(self.data, utils.open_log(self.path).read())
+
+    def test_block_offset(self):
+        os.remove(self.path)
+        f = utils.BlockGzipFile(self.path + ".gz")
+        f.write(self.data)
+        f.close()
+        with open(self.path + ".gz", "rb") as f:
+            f.seek(16)
+            offset = struct.unpack("<H", f.read(2))[0] + 1
+        log = utils.open_log(self.path, offset)
+        assert_equal(self.data[utils.GZIP_BLOCK_SIZE:], log.read())
+        log.close()
+
+    def tearDown(self):
+        for path in (self.path, self.path + ".gz"):
+            if os.path.exists(path):
+                os.remove(path)
@@ -19,7 +19,9 @@ except ImportError:
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
 
 from lib.cuckoo.common.constants import CUCKOO_VERSION, CUCKOO_ROOT
-from lib.cuckoo.common.utils import store_temp_file, delete_folder
+from lib.cuckoo.common.objects import File
+from lib.cuckoo.common.utils import store_temp_file, delete_analysis_folder
+from lib.cuckoo.common.utils import RESULTSERVER_STATS
 from lib.cuckoo.core.database import Database
 
 # Global DB pointer.
@@ -84,6 +86,50 @@ def tasks_create_file():
     response["task_id"] = task_id
     return jsonize(response)
 
+@route("/tasks/create/files", method="POST")
+def tasks_create_files():
+    response = {}
+
+    package = request.forms.get("package", "")
+    timeout = request.forms.get("timeout", "")
+    priority = request.forms.get("priority", 1)
+    options = request.forms.get("options", "")
+    platform = request.forms.get("platform", "")
+    tags = request.forms.get("tags", None)
+    custom = request.forms.get("custom", "")
+    memory = request.forms.get("memory", False)
+    clock = request.forms.get("clock", None)
+    if memory:
+        memory = True
+    enforce_timeout = request.forms.get("enforce_timeout", False)
+    if enforce_timeout:
+        enforce_timeout = True
+
+    files = []
+    for data in request.files.getall("file"):
+        temp_file_path = store_temp_file(data.file.read(), data.filename)
+        files.append(File(temp_file_path))
+
+    if not files:
+        return HTTPError(400, "No files were provided")
+
+    task_ids = db.add_many(
+        files,
+        package=package,
+        timeout=timeout,
+        priority=priority,
+        options=options,
+        platform=platform,
+        tags=tags,
+        custom=custom,
+        memory=memory,
+        enforce_timeout=enforce_timeout,
+        clock=clock
+    )
+
+    response["task_ids"] = task_ids
+    return jsonize(response)
+
 @route("/tasks/create/url", method="POST")
 def tasks_create_url():
     response = {}
@@ -131,7 +177,14 @@ def tasks_list(limit=None, offset=None):
 
     response["tasks"] = []
 
-    for row in db.list_tasks(limit=limit, details=True, offset=offset):
+    try:
+        after_id = int(request.query.get("after_id", 0)) or None
+        before_id = int(request.query.get("before_id", 0)) or None
+    except ValueError:
+        return HTTPError(400, "Invalid task ID cursor")
+
+    for row in db.list_tasks(limit=limit, details=True, offset=offset,
+                             after_id=after_id, before_id=before_id):
         task = row.to_dict()
         task["guest"] = {}
         if row.guest:
@@ -192,8 +245,10 @@ def tasks_delete(task_id):
                                   "processed, cannot delete")
 
         if db.delete_task(task_id):
-            delete_folder(os.path.join(CUCKOO_ROOT, "storage",
-                                       "analyses", task_id))
+            delete_analysis_folder(os.path.join(CUCKOO_ROOT, "storage",
+                                                "analyses", task_id),
+                                   os.path.join(CUCKOO_ROOT, "storage",
+                                                "files"))
             response["status"] = "OK"
         else:
             return HTTPError(500, "An error occurred while trying to "
@@ -288,6 +343,7 @@ def machines_list():
 
 @route("/cuckoo/status", method="GET")
 def cuckoo_status():
+    counts = db.count_tasks_by_status()
     response = dict(
         version=CUCKOO_VERSION,
         hostname=socket.gethostname(),
@@ -296,16 +352,25 @@ def cuckoo_status():
             available=db.count_machines_available()
         ),
         tasks=dict(
-            total=db.count_tasks(),
-            pending=db.count_tasks("pending"),
-            running=db.count_tasks("running"),
-            completed=db.count_tasks("completed"),
-            reported=db.count_tasks("reported")
+            total=sum(counts.values()),
+            pending=counts.get("pending", 0),
+            running=counts.get("running", 0),
+            completed=counts.get("completed", 0),
+            reported=counts.get("reported", 0)
         ),
     )
 
     return jsonize(response)
 
+@route("/cuckoo/resultserver", method="GET")
+def cuckoo_resultserver():
+    stats_path = os.path.join(CUCKOO_ROOT, "storage", RESULTSERVER_STATS)
+    if not os.path.exists(stats_path):
+        return HTTPError(404, "Resultserver statistics not available")
+
+    response.content_type = "application/json; charset=UTF-8"
+    return open(stats_path, "rb").read()
+
 @route("/machines/view/<name>", method="GET")
 def machines_view(name=None):
     response = {}
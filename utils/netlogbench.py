@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Behavior log parsers benchmark.
+
+Parses recorded raw behavior logs (the logs/<pid>.bson and logs/<pid>.raw
+files of an analysis, compressed or not) or generated ones, and reports the
+parsing throughput.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+from lib.cuckoo.common.netlog import NetlogParser, BsonParser
+from lib.cuckoo.common.utils import open_log
+
+import rsbench
+
+
+class NullHandler(object):
+    """Feeds a recorded log to a parser and counts the messages."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.messages = 0
+
+    def read(self, length):
+        end = self.offset + length
+        if end > len(self.data):
+            raise EOFError()
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+
+    def log_process(self, context, vmtime, pid, ppid, modulepath, procname):
+        self.messages += 1
+
+    def log_thread(self, context, pid):
+        self.messages += 1
+
+    def log_call(self, context, apiname, modulename, arguments):
+        self.messages += 1
+
+
+def parse(parser_class, data, rounds):
+    """Parse a log a few times.
+    @return: best time and messages count.
+    """
+    best = None
+    for _ in xrange(rounds):
+        handler = NullHandler(data)
+        parser = parser_class(handler)
+        start = time.time()
+        try:
+            while parser.read_next_message():
+                pass
+        except EOFError:
+            pass
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, handler.messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="*",
+                        help="Raw behavior logs (.bson or .raw, optionally "
+                             "gzip compressed)")
+    parser.add_argument("--generate", type=int, default=0,
+                        help="Also parse generated BSON and NETLOG logs of "
+                             "this size in bytes")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Parse every log this many times and keep the "
+                             "best time")
+    args = parser.parse_args()
+
+    logs = []
+    for path in args.logs:
+        name = path[:-3] if path.endswith(".gz") else path
+        parser_class = BsonParser if name.endswith(".bson") else NetlogParser
+        with open_log(name) as f:
+            logs.append((path, parser_class, f.read()))
+
+    if args.generate:
+        logs.append(("generated BSON", BsonParser,
+                     rsbench.bson_stream(1000, args.generate)))
+        logs.append(("generated NETLOG", NetlogParser,
+                     rsbench.netlog_stream(1000, args.generate)))
+
+    if not logs:
+        parser.error("no logs to parse, give some or use --generate")
+
+    for name, parser_class, data in logs:
+        elapsed, messages = parse(parser_class, data, args.rounds)
+        elapsed = max(elapsed, 0.000001)
+        print("%s: %d bytes, %d messages in %.3f seconds, %.2f MB/s, "
+              "%d messages/s" % (name, len(data), messages, elapsed,
+                                 len(data) / elapsed / 1024 / 1024,
+                                 messages / elapsed))
+
+if __name__ == "__main__":
+    main()
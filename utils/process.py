@@ -8,6 +8,7 @@ import sys
 import time
 import logging
 import argparse
+import threading
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger()
@@ -16,7 +17,8 @@ sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
 
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.core.database import Database, TASK_REPORTED, TASK_COMPLETED
-from lib.cuckoo.core.database import TASK_FAILED_PROCESSING
+from lib.cuckoo.core.database import TASK_FAILED_PROCESSING, LEASE_SECONDS
+from lib.cuckoo.core.database import lease_owner
 from lib.cuckoo.core.plugins import RunProcessing, RunSignatures, RunReporting
 from lib.cuckoo.core.startup import init_modules
 
@@ -28,6 +30,15 @@ def do(aid, report=False):
         RunReporting(task_id=aid, results=results).run()
         Database().set_status(aid, TASK_REPORTED)
 
+def renew_leases(db, owner, stop):
+    """Keep the leases of the tasks being processed alive.
+    @param db: Database instance.
+    @param owner: lease owner of this worker.
+    @param stop: event set once done.
+    """
+    while not stop.wait(LEASE_SECONDS / 3):
+        db.renew_leases(owner, LEASE_SECONDS, status=TASK_COMPLETED)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("id", type=str, help="ID of the analysis to process")
@@ -45,8 +56,19 @@ def main():
         maxcount = cfg.cuckoo.max_analysis_count
         count = 0
         db = Database()
+
+        # Several workers may run at the same time, the tasks are leased to
+        # the one processing them. The lease is kept alive while it does,
+        # if it dies the task is taken by another worker once it expires.
+        owner = lease_owner()
+        stop = threading.Event()
+        renewer = threading.Thread(target=renew_leases,
+                                   args=(db, owner, stop))
+        renewer.daemon = True
+        renewer.start()
+
         while count < maxcount or not maxcount:
-            tasks = db.list_tasks(status=TASK_COMPLETED, limit=1)
+            tasks = db.fetch_completed(1, owner, LEASE_SECONDS)
 
             for task in tasks:
                 log.info("Processing analysis data for Task #%d", task.id)
@@ -63,6 +85,8 @@ def main():
             if not tasks:
                 time.sleep(5)
 
+        stop.set()
+
     else:
         do(args.id, report=args.report)
 
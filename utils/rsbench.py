@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# Copyright (C) 2010-2014 Cuckoo Sandbox Developers.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Result server benchmark.
+
+Runs the result server against a temporary storage folder and drives it with
+simulated analysis machines over the loopback interface, each one of them
+connecting from its own 127.0.0.x address as a task of its own.
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+import lib.cuckoo.core.resultserver as resultserver
+from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.logtbl import table as LOGTBL
+
+PROTOCOLS = ("LOG", "FILE", "BSON", "NETLOG")
+
+# API calls of the generated behavior logs.
+CALLS = [
+    ("NtDeleteFile", ["C:\\Documents and Settings\\User\\Local Settings\\Temp\\%d.tmp"]),
+    ("LdrGetDllHandle", ["kernel32.dll", 0x7c800000]),
+    ("NtClose", [0x7ec]),
+    ("DeleteFileW", [u"C:\\WINDOWS\\Temp\\%d.dat"]),
+]
+
+
+class Task(object):
+    def __init__(self, task_id):
+        self.id = task_id
+
+
+class Machine(object):
+    def __init__(self, ip):
+        self.ip = ip
+
+
+def bson_element(name, value):
+    if isinstance(value, bool):
+        return "\x08" + name + "\x00" + chr(value)
+    elif isinstance(value, (int, long)):
+        if -2**31 <= value < 2**31:
+            return "\x10" + name + "\x00" + struct.pack("<i", value)
+        return "\x12" + name + "\x00" + struct.pack("<q", value)
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return "\x02" + name + "\x00" + struct.pack("<i", len(value) + 1) + \
+            value + "\x00"
+    elif isinstance(value, dict):
+        return "\x03" + name + "\x00" + bson_document(value)
+    elif isinstance(value, (list, tuple)):
+        return "\x04" + name + "\x00" + \
+            bson_document(dict((str(i), v) for i, v in enumerate(value)))
+    raise TypeError("Unsupported BSON value %r" % (value,))
+
+
+def bson_document(values):
+    elements = "".join(bson_element(name, value)
+                       for name, value in sorted(values.items()))
+    return struct.pack("<i", len(elements) + 5) + elements + "\x00"
+
+
+def netlog_value(fmt, value):
+    if fmt in "pPilL":
+        return struct.pack("<I", value & 0xffffffff)
+    elif fmt in "uU":
+        return struct.pack("<I", len(value)) + value.encode("utf-16-le")
+    return struct.pack("<I", len(value)) + value
+
+
+def netlog_stream(pid, size):
+    """Generate a NETLOG behavior log.
+    @param pid: process identifier.
+    @param size: approximate size in bytes.
+    @return: log data.
+    """
+    indexes = dict((entry[0], index) for index, entry in enumerate(LOGTBL))
+    modulepath = "C:\\WINDOWS\\system32\\bench.exe"
+    data = [struct.pack("<BBIIIIIII", 0, 1, 0, 1, 0, 0, 0, pid, 4),
+            netlog_value("s", modulepath),
+            struct.pack("<BBIIII", 1, 1, 0, 1, 0, pid)]
+    length = sum(len(chunk) for chunk in data)
+
+    n = 0
+    while length < size:
+        apiname, values = CALLS[n % len(CALLS)]
+        fmts = LOGTBL[indexes[apiname]][2][0]
+        message = struct.pack("<BBIII", indexes[apiname], 1, 0, 1, n)
+        for fmt, value in zip(fmts, values):
+            if isinstance(value, basestring) and "%d" in value:
+                value = value % n
+            message += netlog_value(fmt, value)
+        data.append(message)
+        length += len(message)
+        n += 1
+
+    return "".join(data)
+
+
+def bson_stream(pid, size):
+    """Generate a BSON behavior log.
+    @param pid: process identifier.
+    @param size: approximate size in bytes.
+    @return: log data.
+    """
+    infos = [
+        ("__process__", "__notification__",
+         ["TimeLow", "TimeHigh", "ProcessIdentifier",
+          "ParentProcessIdentifier", "ModulePath"]),
+        ("__thread__", "__notification__", ["ProcessIdentifier"]),
+    ]
+    for apiname, values in CALLS:
+        entry = [entry for entry in LOGTBL if entry[0] == apiname][0]
+        infos.append((apiname, entry[1], list(entry[2][1:])))
+
+    data = []
+    for index, (name, category, args) in enumerate(infos):
+        data.append(bson_document({"I": index, "type": "info", "name": name,
+                                   "category": category,
+                                   "args": ["is_success", "retval"] + args}))
+    data.append(bson_document({"I": 0, "T": 1, "t": 0, "args": [
+        1, 0, 0, 0, pid, 4, "C:\\WINDOWS\\system32\\bench.exe"]}))
+    data.append(bson_document({"I": 1, "T": 1, "t": 0, "args": [1, 0, pid]}))
+    length = sum(len(chunk) for chunk in data)
+
+    n = 0
+    while length < size:
+        index = 2 + n % len(CALLS)
+        values = [value % n if isinstance(value, basestring) and "%d" in value
+                  else value for value in CALLS[n % len(CALLS)][1]]
+        message = bson_document({"I": index, "T": 1, "t": n,
+                                 "args": [1, 0] + values})
+        data.append(message)
+        length += len(message)
+        n += 1
+
+    return "".join(data)
+
+
+def payload(protocol, guest, size):
+    """Generate the data of a connection, preamble included."""
+    if protocol == "LOG":
+        line = "2014-01-01 00:00:00,000 [lib.core.bench] INFO: guest %d " \
+               "is doing fine\n" % guest
+        return "LOG\n" + line * (size / len(line) + 1)
+    elif protocol == "FILE":
+        return "FILE\nfiles/bench/%d.bin\n" % guest + os.urandom(size)
+    elif protocol == "BSON":
+        return "BSON\n" + bson_stream(1000 + guest, size)
+    return "NETLOG\n" + netlog_stream(1000 + guest, size)
+
+
+def guest_ip(guest):
+    return "127.0.%d.%d" % (1 + guest / 250, 2 + guest % 250)
+
+
+def run_connection(guest, protocol, args, data, totals, lock):
+    """Simulate a connection of an analysis machine.
+    @param guest: number of the guest.
+    @param protocol: protocol of the connection.
+    @param data: data to send by protocol.
+    @param totals: bytes sent, latencies and errors of the client.
+    @param lock: lock of the totals.
+    """
+    try:
+        start = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((guest_ip(guest), 0))
+        sock.connect(("127.0.0.1", args.port))
+        with lock:
+            totals["latencies"].append(time.time() - start)
+
+        view = memoryview(data[protocol])
+        chunk = 64 * 1024
+        for offset in xrange(0, len(view), chunk):
+            sock.sendall(view[offset:offset + chunk])
+            with lock:
+                totals["sent"] += min(chunk, len(view) - offset)
+            if args.rate:
+                # Keep the pace of the connection.
+                delay = float(offset + chunk) / args.rate - \
+                    (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        sock.close()
+    except socket.error as e:
+        print("Guest %d %s connection error: %s" % (guest, protocol, e))
+        with lock:
+            totals["errors"] += 1
+
+
+def run_guests(guests, args, data, results):
+    """Simulate some analysis machines, one connection per protocol each.
+    All the connections are open at the same time, as they are during real
+    analyses, each one from its own thread.
+    @param guests: numbers of the guests to simulate.
+    @param data: data to send by protocol.
+    @param results: queue to put the results on.
+    """
+    totals = {"sent": 0, "latencies": [], "errors": 0}
+    lock = threading.Lock()
+
+    threads = []
+    for guest in guests:
+        for protocol in args.protocols:
+            thread = threading.Thread(target=run_connection,
+                                      args=(guest, protocol, args, data,
+                                            totals, lock))
+            thread.start()
+            threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    results.put((totals["sent"], totals["latencies"], totals["errors"]))
+
+
+def cpu_time(pid):
+    """@return: user and system CPU seconds used by a process."""
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / \
+        float(os.sysconf("SC_CLK_TCK"))
+
+
+def thread_count(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=sorted(resultserver.ENGINES),
+                        default="threads", help="Result server engine")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Result server worker processes")
+    parser.add_argument("--port", type=int, default=12042,
+                        help="Port to run the result server on")
+    parser.add_argument("--guests", type=int, default=16,
+                        help="Number of simulated analysis machines")
+    parser.add_argument("--clients", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Processes running the simulated machines")
+    parser.add_argument("--protocols", default="LOG,FILE,BSON",
+                        help="Comma separated protocols every machine uses "
+                             "(%s)" % ", ".join(PROTOCOLS))
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024,
+                        help="Bytes sent on every connection")
+    parser.add_argument("--rate", type=int, default=0,
+                        help="Bytes per second of every connection, "
+                             "0 for no limit")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the temporary storage folder")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    args.protocols = [protocol.strip().upper()
+                      for protocol in args.protocols.split(",")]
+    for protocol in args.protocols:
+        if protocol not in PROTOCOLS:
+            parser.error("unknown protocol %s" % protocol)
+
+    root = tempfile.mkdtemp(prefix="rsbench-")
+    # Everything the result server stores goes to the temporary folder.
+    resultserver.CUCKOO_ROOT = root
+
+    cfg = Config()
+    cfg.resultserver = cfg.resultserver.copy()
+    cfg.resultserver.ip = "0.0.0.0"
+    cfg.resultserver.port = args.port
+    cfg.resultserver.engine = args.engine
+    cfg.resultserver.workers = args.workers
+    cfg.resultserver.upload_max_size = args.size * 2
+    cfg.resultserver.log_max_size = 0
+    cfg.resultserver.stats_interval = 0
+
+    server = resultserver.create_engine(cfg)
+    pids = [os.getpid()]
+    pids += [process.pid for process in getattr(server, "processes", [])]
+
+    tasks = []
+    for guest in xrange(args.guests):
+        task, machine = Task(guest + 1), Machine(guest_ip(guest))
+        os.makedirs(resultserver.task_storage_path(task.id))
+        server.add_task(task, machine)
+        tasks.append((task, machine))
+
+    threads = [0]
+    running = threading.Event()
+    running.set()
+
+    def monitor():
+        while running.isSet():
+            threads[0] = max(threads[0], sum(thread_count(pid)
+                                             for pid in pids))
+            time.sleep(0.1)
+
+    monitor_thread = threading.Thread(target=monitor)
+    monitor_thread.setDaemon(True)
+    monitor_thread.start()
+
+    print("Running %d guests (%s, %d bytes a connection) against the %s "
+          "engine with %d worker(s)" % (args.guests, ",".join(args.protocols),
+                                       args.size, args.engine, args.workers))
+
+    # Generated upfront, it takes a while for the behavior logs.
+    data = dict((protocol, payload(protocol, 0, args.size))
+                for protocol in args.protocols)
+
+    cpu = sum(cpu_time(pid) for pid in pids)
+    start = time.time()
+
+    results = multiprocessing.Queue()
+    clients = []
+    for i in xrange(min(args.clients, args.guests)):
+        guests = range(i, args.guests, args.clients)
+        client = multiprocessing.Process(target=run_guests,
+                                         args=(guests, args, data, results))
+        client.start()
+        clients.append(client)
+
+    sent, latencies, errors = 0, [], 0
+    for client in clients:
+        client_sent, client_latencies, client_errors = results.get()
+        sent += client_sent
+        latencies += client_latencies
+        errors += client_errors
+    for client in clients:
+        client.join()
+
+    # Wait for the result server to have accepted and read everything.
+    connections = args.guests * len(args.protocols) - errors
+    while True:
+        stats = server.get_stats()["total"]
+        if stats["handlers"] >= connections and not stats["handlers_active"]:
+            break
+        time.sleep(0.01)
+
+    elapsed = time.time() - start
+    cpu = sum(cpu_time(pid) for pid in pids) - cpu
+    running.clear()
+
+    for task, machine in tasks:
+        server.del_task(task, machine)
+    server.stop()
+
+    received = sum(stats["bytes"].values())
+    print("sent %d bytes, received %d bytes in %.2f seconds" %
+          (sent, received, elapsed))
+    print("throughput: %.2f MB/s" % (received / elapsed / 1024 / 1024))
+    for protocol, length in sorted(stats["bytes"].items()):
+        print("  %s: %d bytes" % (protocol, length))
+    print("connect latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies or [0]) * 1000))
+    print("result server CPU: %.2f seconds (%.0f%% of one core)" %
+          (cpu, 100 * cpu / elapsed))
+    print("result server threads: %d at most" % threads[0])
+    if errors:
+        print("%d connection errors" % errors)
+
+    if args.keep:
+        print("Results stored in %s" % root)
+    else:
+        shutil.rmtree(root)
+
+    if errors or received < sent:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
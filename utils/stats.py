@@ -30,29 +30,20 @@ def main():
         TASK_FAILED_ANALYSIS, TASK_FAILED_PROCESSING,
     )
 
+    counts = db.count_tasks_by_status()
     for state in states:
-        print("%s %d tasks" % (state, db.count_tasks(state)))
+        print("%s %d tasks" % (state, counts.get(state, 0)))
 
-    # Later on we might be interested in only calculating stats for all
-    # tasks starting at a certain offset, because the Cuckoo daemon may
-    # have been restarted at some point in time.
-    offset = None
-
-    # For the following stats we're only interested in completed tasks.
-    tasks = db.list_tasks(offset=offset, status=TASK_COMPLETED)
-    tasks += db.list_tasks(offset=offset, status=TASK_REPORTED)
-
-    if tasks:
-        # Get the time when the first task started.
-        started = min(timestamp(task.started_on) for task in tasks)
-
-        # Get the time when the last task completed.
-        completed = max(timestamp(task.completed_on) for task in tasks)
+    # Completed tasks per hour over the last day.
+    throughput = db.throughput(hours=24)
 
+    if throughput:
         # Get the amount of tasks that actually completed.
-        finished = len(tasks)
+        finished = sum(completed for period, completed in throughput)
 
-        hourly = 60 * 60 * finished / (completed - started)
+        # Hours from the first to the last one with completed tasks.
+        hours = (timestamp(throughput[-1][0]) - timestamp(throughput[0][0])) / 3600.0 + 1
+        hourly = finished / float(hours)
 
         print("roughly %d tasks an hour" % int(hourly))
         print("roughly %d tasks a day" % int(24 * hourly))
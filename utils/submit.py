@@ -38,6 +38,7 @@ def main():
     parser.add_argument("--pattern", type=str, action="store", default=None, help="Pattern of files to submit", required=False)
     parser.add_argument("--shuffle", action="store_true", default=False, help="Shuffle samples before submitting them", required=False)
     parser.add_argument("--unique", action="store_true", default=False, help="Only submit new samples, ignore duplicates", required=False)
+    parser.add_argument("--batch", type=int, action="store", default=1000, help="Number of samples to add to the database in a single transaction", required=False)
     parser.add_argument("--quiet", action="store_true", default=False, help="Only print text on failure", required=False)
 
     try:
@@ -102,20 +103,43 @@ def main():
         if args.shuffle:
             random.shuffle(files)
 
+        def submit(batch):
+            task_ids = db.add_many(batch,
+                                   package=args.package,
+                                   timeout=args.timeout,
+                                   options=args.options,
+                                   priority=args.priority,
+                                   platform=args.platform,
+                                   custom=args.custom,
+                                   memory=args.memory,
+                                   enforce_timeout=args.enforce_timeout,
+                                   clock=args.clock,
+                                   tags=args.tags)
+
+            if task_ids:
+                if not args.quiet:
+                    for obj, task_id in zip(batch, task_ids):
+                        print(bold(green("Success")) + u": File \"{0}\" added as task with ID {1}".format(obj.file_path, task_id))
+            else:
+                print(bold(red("Error")) + ": adding {0} tasks to database".format(len(batch)))
+
+        batch, seen = [], set()
         for file_path in files:
-            if not File(file_path).get_size():
+            obj = File(file_path)
+            if not obj.get_size():
                 msg = ": Sample {0} (skipping file)".format(file_path)
                 if not args.quiet:
                     print(bold(yellow("Empty") + msg))
                 continue
 
             if args.unique:
-                sha256 = File(file_path).get_sha256()
-                if not db.find_sample(sha256=sha256) is None:
+                sha256 = obj.get_sha256()
+                if sha256 in seen or not db.find_sample(sha256=sha256) is None:
                     msg = ": Sample {0} (skipping file)".format(file_path)
                     if not args.quiet:
                         print(bold(yellow("Duplicate")) + msg)
                     continue
+                seen.add(sha256)
 
             if not args.max is None:
                 # Break if the maximum number of samples has been reached.
@@ -124,24 +148,13 @@ def main():
 
                 args.max -= 1
 
-            task_id = db.add_path(file_path=file_path,
-                                  package=args.package,
-                                  timeout=args.timeout,
-                                  options=args.options,
-                                  priority=args.priority,
-                                  machine=args.machine,
-                                  platform=args.platform,
-                                  custom=args.custom,
-                                  memory=args.memory,
-                                  enforce_timeout=args.enforce_timeout,
-                                  clock=args.clock,
-                                  tags=args.tags)
-
-            if task_id:
-                if not args.quiet:
-                    print(bold(green("Success")) + u": File \"{0}\" added as task with ID {1}".format(file_path, task_id))
-            else:
-                print(bold(red("Error")) + ": adding task to database")
+            batch.append(obj)
+            if len(batch) >= args.batch:
+                submit(batch)
+                batch = []
+
+        if batch:
+            submit(batch)
 
 if __name__ == "__main__":
     main()
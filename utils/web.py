@@ -37,7 +37,7 @@ db = Database()
 
 def parse_tasks(rows):
     """Parse tasks from DB and prepare them to be shown in the output table.
-    @params rows: data from DB
+    @params rows: data from DB, with the samples loaded
     @return: task list
     """
     tasks = []
@@ -56,8 +56,7 @@ def parse_tasks(rows):
                 task["processed"] = True
 
             if row.category == "file":
-                sample = db.view_sample(row.sample_id)
-                task["md5"] = sample.md5
+                task["md5"] = row.sample.md5
 
             tasks.append(task)
     return tasks
@@ -111,13 +110,39 @@ def index():
 
 @route("/browse")
 def browse():
-    rows = db.list_tasks()
+    try:
+        new_limit = int(request.query.get("limit", -1))
+        after_id = int(request.query.get("after", 0)) or None
+        before_id = int(request.query.get("before", 0)) or None
+    except ValueError:
+        return HTTPError(400, "Invalid pagination parameters")
+
+    limit = get_pagination_limit(new_limit)
+
+    # Fetch one row more than shown to know whether there's a further page.
+    rows = db.list_tasks(limit=limit + 1, after_id=after_id, before_id=before_id,
+                        sample=True) or []
+
+    if before_id:
+        has_newer = len(rows) > limit
+        has_older = True
+        rows = rows[-limit:]
+    else:
+        has_newer = after_id is not None
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+
+    cursor = {
+        "limit" : limit,
+        "newer" : rows[0].id if rows and has_newer else None,
+        "older" : rows[-1].id if rows and has_older else None
+    }
 
     tasks = parse_tasks(rows)
 
     template = env.get_template("browse.html")
 
-    return template.render({"rows" : tasks, "os" : os})
+    return template.render({"rows" : tasks, "os" : os, "cursor" : cursor})
 
 @route("/browse/page")
 @route("/browse/page/")
@@ -138,7 +163,7 @@ def browse_page(page_id=1, new_limit=-1):
         page_id = tot_pages
     
     offset = (page_id - 1) * limit
-    rows = db.list_tasks(limit=limit, offset=offset)
+    rows = db.list_tasks(limit=limit, offset=offset, sample=True)
     
     tasks = parse_tasks(rows)
     
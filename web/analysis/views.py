@@ -36,11 +36,41 @@ def _get_name(task_id):
     else:
         return report["target"]["url"]
 
+def _get_page(request, prefix, limit=50, **kwargs):
+    """Fetch a page of tasks from the cursor in the query string.
+    @param request: request with the "<prefix>after" or "<prefix>before"
+                    task ID cursor.
+    @param prefix: query string parameters prefix.
+    @param limit: number of tasks in a page.
+    @return: tuple of tasks and ID cursors to the newer and older pages.
+    """
+    try:
+        after_id = int(request.GET.get(prefix + "after", 0)) or None
+        before_id = int(request.GET.get(prefix + "before", 0)) or None
+    except ValueError:
+        after_id, before_id = None, None
+
+    # Fetch one task more than shown to know whether there's a further page.
+    tasks = Database().list_tasks(limit=limit + 1, after_id=after_id,
+                                  before_id=before_id, **kwargs) or []
+
+    if before_id:
+        has_newer, has_older = len(tasks) > limit, True
+        tasks = tasks[-limit:]
+    else:
+        has_newer, has_older = after_id is not None, len(tasks) > limit
+        tasks = tasks[:limit]
+
+    page = {
+        "newer": tasks[0].id if tasks and has_newer else None,
+        "older": tasks[-1].id if tasks and has_older else None,
+    }
+    return tasks, page
+
 @require_safe
 def index(request):
-    db = Database()
-    tasks_files = db.list_tasks(limit=50, category="file", not_status=TASK_PENDING)
-    tasks_urls = db.list_tasks(limit=50, category="url", not_status=TASK_PENDING)
+    tasks_files, files_page = _get_page(request, "files_", category="file", not_status=TASK_PENDING, details=True, sample=True)
+    tasks_urls, urls_page = _get_page(request, "urls_", category="url", not_status=TASK_PENDING, details=True)
 
     analyses_files = []
     analyses_urls = []
@@ -48,8 +78,8 @@ def index(request):
     if tasks_files:
         for task in tasks_files:
             new = task.to_dict()
-            new["sample"] = db.view_sample(new["sample_id"]).to_dict()
-            if db.view_errors(task.id):
+            new["sample"] = task.sample.to_dict()
+            if task.errors:
                 new["errors"] = True
 
             new["name"] = _get_name(task.id)
@@ -59,26 +89,26 @@ def index(request):
         for task in tasks_urls:
             new = task.to_dict()
 
-            if db.view_errors(task.id):
+            if task.errors:
                 new["errors"] = True
             new["name"] = _get_name(task.id)
             analyses_urls.append(new)
 
     return render_to_response("analysis/index.html",
-                              {"files": analyses_files, "urls": analyses_urls},
+                              {"files": analyses_files, "urls": analyses_urls,
+                               "files_page": files_page, "urls_page": urls_page},
                               context_instance=RequestContext(request))
 
 @require_safe
 def pending(request):
-    db = Database()
-    tasks = db.list_tasks(status=TASK_PENDING)
+    tasks, page = _get_page(request, "", limit=100, status=TASK_PENDING)
 
     pending = []
     for task in tasks:
         pending.append(task.to_dict())
 
     return render_to_response("analysis/pending.html",
-                              {"tasks" : pending},
+                              {"tasks" : pending, "page" : page},
                               context_instance=RequestContext(request))
 
 @require_safe
@@ -224,19 +254,25 @@ def search(request):
         db = Database()
         analyses = []
 
+        records = list(records)
+        task_ids = [result["info"]["id"] for result in records]
+        tasks = {}
+        # Keep the IN clause below the bound parameters limit of SQLite.
+        for i in xrange(0, len(task_ids), 500):
+            for task in db.list_tasks(task_ids=task_ids[i:i+500], sample=True) or []:
+                tasks[task.id] = task
+
         for result in records:
-            new = db.view_task(result["info"]["id"])
-            
-            if not new:
+            task = tasks.get(result["info"]["id"])
+
+            if not task:
                 continue
 
-            new = new.to_dict()
+            new = task.to_dict()
 
             if result["info"]["category"] == "file":
-                if new["sample_id"]:
-                    sample = db.view_sample(new["sample_id"])
-                    if sample:
-                        new["sample"] = sample.to_dict()
+                if task.sample:
+                    new["sample"] = task.sample.to_dict()
             new["name"] = _get_name(result["info"]["id"])
             analyses.append(new)
 
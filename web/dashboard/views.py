@@ -45,27 +45,20 @@ def index(request):
         TASK_FAILED_PROCESSING,
     )
 
+    counts = db.count_tasks_by_status()
     for state in states:
-        report["states_count"][state] = db.count_tasks(state)
+        report["states_count"][state] = counts.get(state, 0)
 
-    offset = None
-
-    # For the following stats we're only interested in completed tasks.
-    tasks = db.list_tasks(offset=offset, status=TASK_COMPLETED)
-    tasks += db.list_tasks(offset=offset, status=TASK_REPORTED)
-
-    if tasks:
-        # Get the time when the first task started.
-        started = min(timestamp(task.started_on) for task in tasks)
-
-        # Get the time when the last task completed.
-        completed = max(timestamp(task.completed_on) for task in tasks)
+    # Completed tasks per hour over the last day.
+    throughput = db.throughput(hours=24)
 
+    if throughput:
         # Get the amount of tasks that actually completed.
-        finished = len(tasks)
+        finished = sum(completed for period, completed in throughput)
 
-        processing_time = (completed - started) + 1
-        hourly = 60 * 60 * finished / processing_time
+        # Hours from the first to the last one with completed tasks.
+        hours = (timestamp(throughput[-1][0]) - timestamp(throughput[0][0])) / 3600.0 + 1
+        hourly = finished / float(hours)
 
         report["estimate_hour"] = int(hourly)
         report["estimate_day"] = int(24 * hourly)
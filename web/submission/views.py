@@ -11,6 +11,7 @@ from django.template import RequestContext
 
 sys.path.append(settings.CUCKOO_PATH)
 
+from lib.cuckoo.common.objects import File
 from lib.cuckoo.core.database import Database
 
 def force_int(value):
@@ -33,33 +34,40 @@ def index(request):
         tags = request.POST.get("tags", None)
 
         if "sample" in request.FILES:
-            # Preventive checks.
-            if request.FILES["sample"].size == 0:
-                return render_to_response("error.html",
-                                          {"error": "You uploaded an empty file."},
-                                          context_instance=RequestContext(request))
-            elif request.FILES["sample"].size > settings.MAX_UPLOAD_SIZE:
-                return render_to_response("error.html",
-                                          {"error": "You uploaded a file that exceeds that maximum allowed upload size."},
-                                          context_instance=RequestContext(request))
+            samples = request.FILES.getlist("sample")
 
-            path = request.FILES["sample"].temporary_file_path()
+            # Preventive checks.
+            for sample in samples:
+                if sample.size == 0:
+                    return render_to_response("error.html",
+                                              {"error": "You uploaded an empty file."},
+                                              context_instance=RequestContext(request))
+                elif sample.size > settings.MAX_UPLOAD_SIZE:
+                    return render_to_response("error.html",
+                                              {"error": "You uploaded a file that exceeds that maximum allowed upload size."},
+                                              context_instance=RequestContext(request))
+
+            files = [File(sample.temporary_file_path()) for sample in samples]
 
             db = Database()
 
-            task_id = db.add_path(file_path=path,
-                                  package=package,
-                                  timeout=timeout,
-                                  options=options,
-                                  priority=priority,
-                                  custom=custom,
-                                  memory=memory,
-                                  enforce_timeout=enforce_timeout,
-                                  tags=tags)
-
-            if task_id:
+            task_ids = db.add_many(files,
+                                   package=package,
+                                   timeout=timeout,
+                                   options=options,
+                                   priority=priority,
+                                   custom=custom,
+                                   memory=memory,
+                                   enforce_timeout=enforce_timeout,
+                                   tags=tags)
+
+            if task_ids:
+                if len(task_ids) == 1:
+                    message = "The analysis task was successfully added with ID {0}.".format(task_ids[0])
+                else:
+                    message = "The analysis tasks were successfully added with IDs {0}.".format(", ".join(str(task_id) for task_id in task_ids))
                 return render_to_response("success.html",
-                                          {"message": "The analysis task was successfully added with ID {0}.".format(task_id)},
+                                          {"message": message},
                                           context_instance=RequestContext(request))
             else:
                 return render_to_response("error.html",